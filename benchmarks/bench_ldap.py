@@ -0,0 +1,184 @@
+"""
+Offline benchmark for the LDAP directory connector.
+
+Builds a synthetic directory in ldap3's in-process mock server (the MOCK_SYNC strategy), then times
+load_users_and_groups in several connector modes.  No LDAP server is needed, so changes to the connector can be
+checked for regressions anywhere.  For each mode it prints the wall time, the LDAP searches issued and entries
+received, and with --memory the peak memory allocated during the load (measured in a second run, as tracing
+allocations slows the load down a lot).
+
+    python benchmarks/bench_ldap.py [--users N] [--groups N] [--depth N] [--fanout N] [--mode MODE ...] [--memory]
+
+The directory has:
+- users with mail, givenName, sn and c attributes, and memberOf values for the groups they are in;
+- groups arranged in --depth levels, each group below the top level being a member of a group in the level above;
+- each user directly in --fanout groups.
+
+Note that the mock server evaluates every search filter against every entry, so searches cost much more than on
+a real server.  Compare runs of this benchmark with each other, not with a live directory.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+import ldap3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from user_sync.connector.directory_ldap import LDAPDirectoryConnector  # noqa: E402
+
+BASE_DN = 'dc=example,dc=com'
+PEOPLE_DN = 'ou=people,' + BASE_DN
+GROUPS_DN = 'ou=groups,' + BASE_DN
+
+
+def group_name(index):
+    return 'group%04d' % index
+
+
+def group_dn(index):
+    return 'cn=%s,%s' % (group_name(index), GROUPS_DN)
+
+
+def build_directory(user_count, group_count, depth, fanout):
+    """
+    :return: the entries (dict of DN to attributes) and the indexes of the top level groups
+    """
+    depth = max(1, min(depth, group_count))
+    levels = [[] for _ in range(depth)]
+    for index in range(group_count):
+        levels[index * depth // group_count].append(index)
+    members = dict((index, []) for index in range(group_count))
+    for level in range(1, depth):
+        parents = levels[level - 1]
+        for position, index in enumerate(levels[level]):
+            members[parents[position % len(parents)]].append(group_dn(index))
+
+    entries = {}
+    for i in range(user_count):
+        uid = 'user%06d' % i
+        dn = 'uid=%s,%s' % (uid, PEOPLE_DN)
+        groups = sorted(set((i * 7 + k * 13) % group_count for k in range(fanout)))
+        for index in groups:
+            members[index].append(dn)
+        entries[dn] = {
+            'objectClass': ['person'],
+            'uid': uid,
+            'mail': uid + '@example.com',
+            'givenName': 'Given%d' % i,
+            'sn': 'Surname%d' % i,
+            'c': 'US',
+            'memberOf': [group_dn(index) for index in groups],
+        }
+    for index in range(group_count):
+        entries[group_dn(index)] = {'objectClass': ['groupOfNames'], 'cn': group_name(index)}
+        if members[index]:
+            entries[group_dn(index)]['member'] = members[index]
+    return entries, levels[0]
+
+
+class MockDirectory(object):
+    """
+    Replaces ldap3.Connection while the connector connects, so that it talks to a mock server loaded with the
+    synthetic directory.  The entries are loaded once, and shared by all the connections.
+    """
+
+    def __init__(self, entries):
+        self.server = ldap3.Server('mock_ldap')
+        self.connection_class = ldap3.Connection
+        loader = self.connection_class(self.server, client_strategy=ldap3.MOCK_SYNC)
+        for dn, attributes in entries.items():
+            loader.strategy.add_entry(dn, attributes)
+
+    def connect(self, server, **kwargs):
+        for key in ('auto_bind', 'authentication', 'user', 'password'):
+            kwargs.pop(key, None)
+        connection = self.connection_class(self.server, client_strategy=ldap3.MOCK_SYNC, **kwargs)
+        connection.bind()
+        return connection
+
+    def create_connector(self, options):
+        ldap3.Connection = self.connect
+        try:
+            return LDAPDirectoryConnector(options)
+        finally:
+            ldap3.Connection = self.connection_class
+
+
+def get_modes(all_groups, top_groups):
+    """
+    :return: dict of mode name to (connector options, mapped groups, all users, additional group filters)
+    """
+    return {
+        'normal': ({'group_member_filter_format': '(memberOf={group_dn})'}, all_groups, False, None),
+        'normal-all-users': ({'group_member_filter_format': '(memberOf={group_dn})'}, all_groups, True, None),
+        'member-of': ({'member_of_lookup': True}, all_groups, False, None),
+        'two-step': ({'two_steps_lookup': {'group_member_attribute_name': 'member'}}, all_groups, False, None),
+        'nested': ({'two_steps_lookup': {'group_member_attribute_name': 'member', 'nested_group': True}},
+                   top_groups, False, None),
+        'dynamic': ({'dynamic_group_member_attribute': 'memberOf'}, [], True, ['group.*']),
+        'partitioned': ({'group_member_filter_format': '(memberOf={group_dn})', 'connection_pool_size': 4,
+                         'scan_partition_filters': ['(uid=user%d*)' % digit for digit in range(10)]},
+                        all_groups, True, None),
+    }
+
+
+def run_mode(directory, mode_options, groups, all_users, additional_group_filters, trace_memory):
+    options = {
+        'host': 'ldap://mock_ldap',
+        'base_dn': BASE_DN,
+        'all_users_filter': '(objectClass=person)',
+        'group_filter_format': '(&(objectClass=groupOfNames)(cn={group}))',
+    }
+    options.update(mode_options)
+    connector = directory.create_connector(options)
+    connector.additional_group_filters = additional_group_filters
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    users = list(connector.load_users_and_groups(groups, [], all_users))
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    searches, entries = connector.get_search_usage()
+    return elapsed, searches, entries, len(users), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=30)
+    parser.add_argument('--depth', type=int, default=3, help='levels of group nesting')
+    parser.add_argument('--fanout', type=int, default=4, help='groups each user is directly a member of')
+    parser.add_argument('--mode', action='append', help='mode to run (default: all)')
+    parser.add_argument('--memory', action='store_true', help='also measure peak memory')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    build_start = time.perf_counter()
+    entries, top_groups = build_directory(args.users, args.groups, args.depth, args.fanout)
+    directory = MockDirectory(entries)
+    print('Directory: %d users, %d groups (%d top level), built in %.1fs' % (
+        args.users, args.groups, len(top_groups), time.perf_counter() - build_start))
+
+    modes = get_modes([group_name(index) for index in range(args.groups)], [group_name(index) for index in top_groups])
+    print('%-18s %10s %10s %10s %8s %12s' % ('mode', 'time (s)', 'searches', 'entries', 'users', 'peak (MB)'))
+    for name in args.mode or sorted(modes):
+        if name not in modes:
+            parser.error('unknown mode %s (choose from %s)' % (name, ', '.join(sorted(modes))))
+        mode = modes[name]
+        elapsed, searches, entry_count, user_count, _ = run_mode(directory, *mode, trace_memory=False)
+        peak = '-'
+        if args.memory:
+            peak = '%.1f' % (run_mode(directory, *mode, trace_memory=True)[4] / 1e6)
+        print('%-18s %10.2f %10d %10d %8d %12s' % (name, elapsed, searches, entry_count, user_count, peak))
+
+
+if __name__ == '__main__':
+    main()
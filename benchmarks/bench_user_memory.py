@@ -0,0 +1,75 @@
+"""
+Memory benchmark for directory user records.
+
+Builds a number of synthetic users the way the directory connectors do, as plain dicts (the way users used to be
+built) and as DirectoryUser records, and prints the memory they take according to tracemalloc.
+
+    python benchmarks/bench_user_memory.py [--users N]
+"""
+
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from user_sync.connector.helper import create_blank_user  # noqa: E402
+
+
+def create_dict_user():
+    return {
+        "identity_type": None,
+        "username": None,
+        "domain": None,
+        "firstname": None,
+        "lastname": None,
+        "email": None,
+        "groups": [],
+        "country": None,
+    }
+
+
+def build_users(count, create_user):
+    users = {}
+    for i in range(count):
+        user = create_user()
+        email = 'user%d@example.com' % i
+        # values built at runtime, as when read from a directory, so that equal strings are separate objects
+        user['identity_type'] = ''.join(['federated', 'ID'])
+        user['email'] = email
+        user['username'] = email
+        user['domain'] = ''.join(['example', '.com'])
+        user['firstname'] = 'Given%d' % i
+        user['lastname'] = 'Surname%d' % i
+        user['country'] = ''.join(['U', 'S'])
+        user['groups'] = user['groups'] + type(user['groups'])(['group%d' % (i % 50), 'All Users'])
+        user['member_groups'] = []
+        user['source_attributes'] = {'email': email, 'givenName': user['firstname'], 'sn': user['lastname']}
+        users[email] = user
+    return users
+
+
+def measure(name, count, create_user):
+    tracemalloc.start()
+    users = build_users(count, create_user)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-15s %8.1f MB current %8.1f MB peak %6.0f bytes/user' % (
+        name, current / 1e6, peak / 1e6, current / float(count)))
+    del users
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    args = parser.parse_args()
+
+    before = measure('dict', args.users, create_dict_user)
+    after = measure('DirectoryUser', args.users, create_blank_user)
+    print('%-15s %8.0f%%' % ('saved', 100.0 * (before - after) / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Micro-benchmark for the value formatters of the LDAP and Okta connectors.
+
+Formats the seven user_* fields of a set of synthetic records, with the per-call format handling the formatters
+used to have and with the compiled formats, and prints records per second for each.
+
+    python benchmarks/bench_value_formatter.py [--records N]
+"""
+
+import argparse
+import os
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from user_sync.connector.directory_ldap import LDAPValueFormatter  # noqa: E402
+from user_sync.connector.directory_okta import OKTAValueFormatter  # noqa: E402
+from user_sync.connector.okta_client import OktaObject  # noqa: E402
+
+FORMATS = ['{mail}', '{sAMAccountName}', '{mail}', '{givenName}', '{sn}', '{c}', '{sAMAccountName}@example.com']
+
+
+class LegacyFormatter(object):
+    """
+    The formatters as they were: the format is re-applied to a dict of values for every record
+    """
+
+    def __init__(self, string_format, get_value):
+        self.string_format = string_format
+        self.attribute_names = [item[1] for item in string.Formatter().parse(string_format) if item[1]]
+        self.get_value = get_value
+
+    def generate_value(self, record):
+        result = None
+        attribute_name = None
+        values = {}
+        for attribute_name in self.attribute_names:
+            value = self.get_value(record, attribute_name)
+            if value is None:
+                values = None
+                break
+            values[attribute_name] = value
+        if values is not None:
+            result = self.string_format.format(**values)
+        return result, attribute_name
+
+
+def make_okta_record(attributes):
+    return OktaObject(id='00u1', profile=OktaObject(attributes))
+
+
+def make_attributes(i):
+    return {
+        'mail': 'user%d@example.com' % i,
+        'sAMAccountName': 'user%d' % i,
+        'givenName': 'Given%d' % i,
+        'sn': 'Surname%d' % i,
+        'c': 'US',
+    }
+
+
+def ldap_legacy_value(record, attribute_name):
+    return LDAPValueFormatter.get_attribute_value(record, attribute_name, first_only=True)
+
+
+def okta_legacy_value(record, attribute_name):
+    if hasattr(record.profile, attribute_name):
+        value = getattr(record.profile, attribute_name)
+        if value:
+            return value
+    return None
+
+
+def run(name, formatters, records):
+    start = time.perf_counter()
+    for record in records:
+        for formatter in formatters:
+            formatter.generate_value(record)
+    elapsed = time.perf_counter() - start
+    rate = len(records) / elapsed
+    print('%-20s %10.0f records/s' % (name, rate))
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=100000)
+    args = parser.parse_args()
+
+    ldap_records = [{k: [v] for k, v in make_attributes(i).items()} for i in range(args.records)]
+    okta_records = [make_okta_record(make_attributes(i)) for i in range(args.records)]
+
+    for record_type, records, legacy_value, formatter_class in (
+            ('ldap', ldap_records, ldap_legacy_value, LDAPValueFormatter),
+            ('okta', okta_records, okta_legacy_value, OKTAValueFormatter)):
+        before = run(record_type + ' before', [LegacyFormatter(f, legacy_value) for f in FORMATS], records)
+        after = run(record_type + ' after', [formatter_class(f) for f in FORMATS], records)
+        print('%-20s %10.2fx' % (record_type + ' speedup', after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -46,7 +46,7 @@ setup(name='user-sync',
       install_requires=[
           'keyring',
           'keyrings.cryptfile',
-          'okta==0.0.3.1',
+          'requests',
           'psutil',
           'pycryptodome==3.9.7',
           'ldap3',
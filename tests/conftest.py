@@ -1,4 +1,11 @@
+import gzip
+import http.server
+import json
 import os
+import re
+import socketserver
+import threading
+import urllib.parse
 
 import pytest
 
@@ -80,4 +87,108 @@ def resource_file():
         filepath = os.path.join(dirname, filename)
         open(filepath, 'a').close()
         return filepath
-    return _resource_file
\ No newline at end of file
+    return _resource_file
+
+class OktaStandIn(object):
+    """
+    A local HTTP server that stands in for the parts of the Okta API that the Okta connector uses: group search,
+    group members and users, returned in pages of page_size with Link headers, like Okta does.
+    """
+
+    def __init__(self):
+        self.groups = []
+        self.group_members = {}
+        self.users = []
+        self.page_size = 2
+        self.rate_limit_headers = {}
+        self.statuses = []
+        self.requests = []
+        self.connections = set()
+        handler = self.make_handler()
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_group(self, name, members):
+        group_id = '00g%d' % len(self.groups)
+        self.groups.append({'id': group_id, 'profile': {'name': name},
+                            'lastMembershipUpdated': '2020-01-01T00:00:00.000Z'})
+        self.group_members[group_id] = members
+        return group_id
+
+    def get_items(self, path, query):
+        parts = path.strip('/').split('/')[2:]
+        if parts == ['groups']:
+            return [group for group in self.groups if group['profile']['name'].startswith(query.get('q', ''))]
+        if len(parts) == 3 and parts[0] == 'groups' and parts[2] == 'users':
+            return self.group_members.get(parts[1])
+        if parts == ['users']:
+            # the searches supported are on lastUpdated, or one "eq" comparison
+            search = query.get('search', 'lastUpdated gt ""')
+            match = re.match(r'lastUpdated gt "(.*)"$', search)
+            if match:
+                return [user for user in self.users if user['lastUpdated'] > match.group(1)]
+            match = re.match(r'(profile\.)?(\w+) eq "(.*)"$', search)
+            return [user for user in self.users
+                    if (user['profile'] if match.group(1) else user).get(match.group(2)) == match.group(3)]
+        return None
+
+    def make_handler(self):
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                stand_in.requests.append((url.path, query, dict(self.headers)))
+                stand_in.connections.add(self.client_address)
+                status = stand_in.statuses.pop(0) if stand_in.statuses else 200
+                items = stand_in.get_items(url.path, query)
+                if items is None:
+                    status = 404
+                headers = dict(stand_in.rate_limit_headers)
+                if status != 200:
+                    body = {'errorCode': 'E0000001', 'errorSummary': 'Error %d' % status}
+                else:
+                    start = int(query.get('after', 0))
+                    body = items[start:start + stand_in.page_size]
+                    if start + stand_in.page_size < len(items):
+                        query['after'] = str(start + stand_in.page_size)
+                        headers['Link'] = '<%s%s?%s>; rel="next"' % (stand_in.url, url.path,
+                                                                      urllib.parse.urlencode(query))
+                content = json.dumps(body).encode('utf8')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    content = gzip.compress(content)
+                    headers['Content-Encoding'] = 'gzip'
+                self.send_response(status)
+                headers['Content-Type'] = 'application/json'
+                headers['Content-Length'] = str(len(content))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def okta_server():
+    stand_in = OktaStandIn()
+    yield stand_in
+    stand_in.close()
@@ -0,0 +1,60 @@
+import copy
+
+import pytest
+
+from user_sync.connector.helper import DirectoryUser, compile_value_format, create_blank_user
+
+
+def test_blank_user_is_mapping():
+    user = create_blank_user()
+    assert dict(user) == {
+        'identity_type': None,
+        'username': None,
+        'domain': None,
+        'firstname': None,
+        'lastname': None,
+        'email': None,
+        'groups': (),
+        'country': None,
+    }
+    assert 'source_attributes' not in user
+    assert user.get('member_groups', []) == []
+
+
+def test_directory_user_fields():
+    user = create_blank_user()
+    user['groups'] = ['a']
+    user.add_group('b')
+    assert user['groups'] == ('a', 'b')
+
+    user.update({'email': 'user@example.com', 'country': 'US', 'custom': 1})
+    assert user['email'] == 'user@example.com'
+    assert user['custom'] == 1
+    assert list(user)[-1] == 'custom'
+    assert len(user) == 9
+
+    user['source_attributes'] = {'email': 'user@example.com'}
+    del user['source_attributes']
+    assert 'source_attributes' not in user
+    with pytest.raises(KeyError):
+        del user['email']
+    with pytest.raises(KeyError):
+        user['missing']
+
+
+def test_directory_user_copy():
+    user = DirectoryUser(email='user@example.com', groups=['a'], uid='1234')
+    for duplicate in (user.copy(), copy.deepcopy(user)):
+        assert duplicate == user
+        assert isinstance(duplicate, DirectoryUser)
+        duplicate.add_group('b')
+        assert user['groups'] == ('a',)
+
+
+def test_compile_value_format():
+    def get_value(record, name):
+        return record.get(name)
+
+    format_record = compile_value_format('{first}.{last}@example.com', get_value)
+    assert format_record({'first': 'Jo', 'last': 'Doe'}) == ('Jo.Doe@example.com', 'last')
+    assert format_record({'last': 'Doe'}) == (None, 'first')
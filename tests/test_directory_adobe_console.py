@@ -0,0 +1,43 @@
+import logging
+
+from user_sync.connector.directory_adobe_console import AdobeConsoleConnector
+
+
+class PagedConnection(object):
+    """
+    Stands in for a UMAPI connection, returning users in pages like query_multiple does
+    """
+
+    def __init__(self, users, page_size=2):
+        self.pages = [users[i:i + page_size] for i in range(0, len(users), page_size)]
+
+    def query_multiple(self, object_type, page=0, url_params=None, query_params=None):
+        assert object_type == 'user'
+        # like UsersQuery, only the direct members of the groups are listed
+        assert query_params == {'directOnly': True}
+        return self.pages[page], page == len(self.pages) - 1
+
+
+def umapi_user(name, groups, identity_type='federatedID'):
+    return {'username': name, 'email': '%s@example.com' % name, 'domain': 'example.com', 'type': identity_type,
+            'firstname': name.upper(), 'lastname': 'User', 'country': 'US', 'groups': groups}
+
+
+def test_group_members_index():
+    connector = AdobeConsoleConnector.__new__(AdobeConsoleConnector)
+    connector.logger = logging.getLogger('test')
+    connector.user_by_usr_key = {}
+    connector.user_keys_by_group = {}
+    connector.connection = PagedConnection([
+        umapi_user('u1', ['g1', 'g2']),
+        umapi_user('u2', ['g2']),
+        umapi_user('u3', ['g1'], 'adobeID'),
+        umapi_user('u4', []),
+        umapi_user('u5', ['g1', 'g3']),
+    ])
+    connector.load_umapi_users('federatedID')
+    assert sorted(connector.user_by_usr_key) == ['federatedid,u1,example.com', 'federatedid,u2,example.com',
+                                                 'federatedid,u4,example.com', 'federatedid,u5,example.com']
+    assert list(connector.iter_group_members('g1')) == ['federatedid,u1,example.com', 'federatedid,u5,example.com']
+    assert list(connector.iter_group_members('g2')) == ['federatedid,u1,example.com', 'federatedid,u2,example.com']
+    assert list(connector.iter_group_members('missing')) == []
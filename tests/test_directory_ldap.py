@@ -0,0 +1,538 @@
+import ldap3
+import pytest
+
+from user_sync.connector.directory_ldap import LDAPDirectoryConnector, LDAPValueFormatter
+from user_sync.error import AssertionException
+
+BASE_DN = 'dc=example,dc=com'
+USERS_FILTER = '(objectClass=person)'
+GROUP_FILTER_FORMAT = '(&(objectClass=groupOfNames)(cn={group}))'
+
+
+def user_entry(uid, **attributes):
+    dn = 'uid=%s,ou=people,%s' % (uid, BASE_DN)
+    entry = {'objectClass': ['person'], 'uid': uid, 'mail': '%s@example.com' % uid,
+             'givenName': uid.capitalize(), 'sn': 'User'}
+    entry.update(attributes)
+    return dn, entry
+
+
+def group_entry(cn, member_dns, **attributes):
+    dn = 'cn=%s,ou=groups,%s' % (cn, BASE_DN)
+    entry = {'objectClass': ['groupOfNames'], 'cn': cn, 'member': member_dns}
+    entry.update(attributes)
+    return dn, entry
+
+
+@pytest.fixture
+def ldap_directory(monkeypatch):
+    """
+    Patch the connector to talk to an in-memory (MOCK_SYNC) directory.  Returns the dict of DN -> attributes
+    that is loaded into the directory when the connector connects.
+    """
+    entries = {}
+    base_connection = ldap3.Connection
+
+    def mock_connection(server, **kwargs):
+        kwargs.pop('auto_bind', None)
+        for key in ('authentication', 'user', 'password'):
+            kwargs.pop(key, None)
+        connection = base_connection(ldap3.Server('mock_ldap'), client_strategy=ldap3.MOCK_SYNC, **kwargs)
+        for dn, attributes in entries.items():
+            connection.strategy.add_entry(dn, attributes)
+        connection.bind()
+        return connection
+
+    monkeypatch.setattr(ldap3, 'Connection', mock_connection)
+    return entries
+
+
+@pytest.fixture
+def ldap_connector(ldap_directory):
+    def _ldap_connector(**options):
+        caller_options = {
+            'host': 'ldap://mock_ldap',
+            'base_dn': BASE_DN,
+            'all_users_filter': USERS_FILTER,
+            'group_filter_format': GROUP_FILTER_FORMAT,
+            'group_member_filter_format': '(memberOf={group_dn})',
+        }
+        caller_options.update(options)
+        # options given as None are left unset
+        caller_options = {k: v for k, v in caller_options.items() if v is not None}
+        return LDAPDirectoryConnector(caller_options)
+
+    return _ldap_connector
+
+
+def load_users(connector, groups, all_users):
+    return {u['email']: u for u in connector.load_users_and_groups(groups, [], all_users)}
+
+
+def test_all_users_single_scan(ldap_directory, ldap_connector):
+    alice_dn, alice = user_entry('alice')
+    bob_dn, bob = user_entry('bob')
+    carol_dn, carol = user_entry('carol')
+    group_dn, group = group_entry('staff', [alice_dn, bob_dn])
+    alice['memberOf'] = group_dn
+    bob['memberOf'] = group_dn
+    ldap_directory.update({alice_dn: alice, bob_dn: bob, carol_dn: carol, group_dn: group})
+
+    connector = ldap_connector(search_page_size=0)
+    users = load_users(connector, ['staff'], True)
+    assert sorted(users) == ['alice@example.com', 'bob@example.com', 'carol@example.com']
+    assert users['alice@example.com']['groups'] == ('staff',)
+    assert users['bob@example.com']['groups'] == ('staff',)
+    assert users['carol@example.com']['groups'] == ()
+    assert users['alice@example.com']['firstname'] == 'Alice'
+
+    # one scan of all users, one group DN lookup and one group member search
+    assert connector.connection.usage.search_operations == 3
+    assert connector.search_entry_count == 6
+
+
+def test_group_users_only(ldap_directory, ldap_connector):
+    alice_dn, alice = user_entry('alice')
+    bob_dn, bob = user_entry('bob')
+    group_dn, group = group_entry('staff', [alice_dn])
+    alice['memberOf'] = group_dn
+    ldap_directory.update({alice_dn: alice, bob_dn: bob, group_dn: group})
+
+    connector = ldap_connector()
+    users = load_users(connector, ['staff'], False)
+    assert list(users) == ['alice@example.com']
+    assert users['alice@example.com']['groups'] == ('staff',)
+
+
+def two_step_directory(ldap_directory):
+    users = [user_entry(uid) for uid in ('alice', 'bob', 'carol', 'dave')]
+    ldap_directory.update(users)
+    member_dns = [dn for dn, _ in users[:3]]
+    # a member outside of the base_dn and a member that isn't a user
+    member_dns.append('uid=erin,dc=elsewhere,dc=com')
+    other_dn, other = group_entry('other', [])
+    member_dns.append(other_dn)
+    group_dn, group = group_entry('staff', member_dns)
+    ldap_directory.update({other_dn: other, group_dn: group})
+
+
+@pytest.mark.parametrize('batch_size,member_searches', [(100, 1), (2, 2)])
+def test_two_steps_batched_lookup(ldap_directory, ldap_connector, batch_size, member_searches):
+    two_step_directory(ldap_directory)
+    connector = ldap_connector(group_member_filter_format=None,
+                               two_steps_lookup={'group_member_attribute_name': 'member',
+                                                 'member_batch_size': batch_size})
+    users = load_users(connector, ['staff'], False)
+    assert sorted(users) == ['alice@example.com', 'bob@example.com', 'carol@example.com']
+    assert all(u['groups'] == ('staff',) for u in users.values())
+    # group DN lookup, group member read, then the batched user searches
+    assert connector.connection.usage.search_operations == 2 + member_searches
+
+
+def test_two_steps_all_users_index(ldap_directory, ldap_connector):
+    two_step_directory(ldap_directory)
+    connector = ldap_connector(group_member_filter_format=None,
+                               two_steps_lookup={'group_member_attribute_name': 'member'})
+    users = load_users(connector, ['staff'], True)
+    assert len(users) == 4
+    assert users['dave@example.com']['groups'] == ()
+    assert users['alice@example.com']['groups'] == ('staff',)
+    # members are answered from the all users scan, so there are no per-member searches
+    assert connector.connection.usage.search_operations == 3
+
+
+def test_normalize_dn():
+    assert LDAPDirectoryConnector.normalize_dn('CN=Smith\\, John,OU=People, DC=example,DC=com') == \
+        LDAPDirectoryConnector.normalize_dn('cn=smith\\2C john,ou=people,dc=example,dc=com')
+    assert LDAPDirectoryConnector.format_rdn_filter('cn=J\\28x\\29+uid=jx,dc=example,dc=com') == \
+        '(&(cn=J\\28x\\29)(uid=jx))'
+
+
+def test_two_steps_nested_groups(ldap_directory, ldap_connector):
+    alice_dn, alice = user_entry('alice')
+    bob_dn, bob = user_entry('bob')
+    carol_dn, carol = user_entry('carol')
+    ops_dn = 'cn=ops,ou=groups,%s' % BASE_DN
+    eng_dn, eng = group_entry('eng', [bob_dn, ops_dn])
+    # ops and eng contain each other
+    ops_dn, ops = group_entry('ops', [carol_dn, eng_dn])
+    staff_dn, staff = group_entry('staff', [alice_dn, eng_dn])
+    ldap_directory.update({alice_dn: alice, bob_dn: bob, carol_dn: carol,
+                           eng_dn: eng, ops_dn: ops, staff_dn: staff})
+
+    connector = ldap_connector(group_member_filter_format=None,
+                               two_steps_lookup={'group_member_attribute_name': 'member', 'nested_group': True})
+    assert list(connector.iter_group_member_dns(staff_dn, 'member')) == \
+        [alice_dn, bob_dn, carol_dn, ops_dn, eng_dn]
+    # every object is read once, and the expansion of eng is shared with staff
+    assert connector.connection.usage.search_operations == 6
+    assert list(connector.iter_group_member_dns(eng_dn, 'member')) == [bob_dn, carol_dn, ops_dn]
+    assert connector.connection.usage.search_operations == 6
+
+    users = load_users(connector, ['staff', 'ops'], False)
+    assert users['alice@example.com']['groups'] == ('staff',)
+    assert users['bob@example.com']['groups'] == ('staff', 'ops')
+    assert users['carol@example.com']['groups'] == ('staff', 'ops')
+
+    # without all users, the members of each group are first looked up as users, in batched searches, so only
+    # the groups get a search of their own: one search for the group DNs, one for each group, and one batch of
+    # users for each group, however many users there are
+    extra_users = dict(user_entry('user%d' % i) for i in range(10))
+    ldap_directory.update(extra_users)
+    ldap_directory[staff_dn]['member'] = [alice_dn, eng_dn] + list(extra_users)
+    connector = ldap_connector(group_member_filter_format=None,
+                               two_steps_lookup={'group_member_attribute_name': 'member', 'nested_group': True})
+    users = load_users(connector, ['staff', 'ops'], False)
+    assert len(users) == 13
+    assert connector.connection.usage.search_operations == 7
+
+
+@pytest.mark.parametrize('all_users', [True, False])
+def test_connection_pool(ldap_directory, ldap_connector, all_users):
+    users = [user_entry('user%02d' % i) for i in range(20)]
+    group_names = ['group%d' % i for i in range(5)]
+    for i, name in enumerate(group_names):
+        group_dn, group = group_entry(name, [])
+        ldap_directory[group_dn] = group
+        for dn, user in users[i::5]:
+            user.setdefault('memberOf', []).append(group_dn)
+    ldap_directory.update(users)
+
+    connector = ldap_connector(connection_pool_size=3, additional_hosts=['ldap://mock_ldap_2'])
+    loaded = load_users(connector, group_names, all_users)
+    assert len(loaded) == 20
+    for i in range(20):
+        assert loaded['user%02d@example.com' % i]['groups'] == ('group%d' % (i % 5),)
+    # the main connection, plus one for each worker thread used, which is unbound once the users are loaded
+    assert 2 <= len(connector.connections) <= 4
+    assert connector.connections[0] is connector.connection and connector.connection.bound
+    assert not any(connection.bound for connection in connector.connections[1:])
+    assert connector.executor is None
+    # the group DNs are found with one search, then there is a search for the members of each group
+    assert connector.get_search_usage() == (6 + (1 if all_users else 0), 20 * (2 if all_users else 1) + 5)
+
+
+@pytest.mark.parametrize('options,searches', [
+    ({'scan_partition_attribute': 'uid'}, 37),
+    ({'scan_partition_filters': ['(uid=a*)', 'uid=a*', '(uid=b*)']}, 4),
+])
+def test_partitioned_user_scan(ldap_directory, ldap_connector, options, searches):
+    uids = ['alice', 'amy', 'bob', 'carol', '9lives', '_svc']
+    ldap_directory.update(user_entry(uid) for uid in uids)
+
+    connector = ldap_connector(connection_pool_size=3, **options)
+    loaded = load_users(connector, [], True)
+    # every user once, including those only matched by the remainder partition or by several partitions
+    assert sorted(loaded) == sorted('%s@example.com' % uid for uid in uids)
+    assert connector.get_search_usage() == (searches, len(uids) + (2 if 'scan_partition_filters' in options else 0))
+
+
+def test_partition_options_exclusive(ldap_directory, ldap_connector):
+    with pytest.raises(AssertionException):
+        ldap_connector(scan_partition_attribute='uid', scan_partition_filters=['(uid=a*)'])
+
+
+def test_all_hosts_unreachable(monkeypatch):
+    # the pool gives up after trying each server a few times, rather than retrying forever
+    monkeypatch.setattr(ldap3.utils.config, '_POOLING_LOOP_TIMEOUT', 0)
+    with pytest.raises(AssertionException, match='LDAP connection failure'):
+        LDAPDirectoryConnector({'host': 'ldap://127.0.0.1:1', 'additional_hosts': ['ldap://127.0.0.1:2'],
+                                'base_dn': BASE_DN})
+
+
+@pytest.mark.parametrize('drop_at_search,resumable', [(2, True), (2, False), (1, True)])
+def test_search_survives_connection_drop(ldap_directory, ldap_connector, drop_at_search, resumable):
+    uids = ['user%d' % i for i in range(5)]
+    ldap_directory.update(user_entry(uid) for uid in uids)
+    connector = ldap_connector(search_page_size=2, search_retry_delay=0)
+    connection = connector.connection
+    search = connection.search
+    calls = []
+
+    def flaky_search(*args, **kwargs):
+        calls.append(kwargs.get('paged_cookie'))
+        if len(calls) == drop_at_search:
+            raise ldap3.core.exceptions.LDAPSocketReceiveError('connection reset')
+        if len(calls) == drop_at_search + 1 and kwargs.get('paged_cookie') and not resumable:
+            connection.result = {'result': 53, 'description': 'unwillingToPerform'}
+            connection.response = []
+            return False
+        return search(*args, **kwargs)
+
+    connection.search = flaky_search
+    loaded = load_users(connector, [], True)
+    assert sorted(loaded) == sorted('%s@example.com' % uid for uid in uids)
+    # each entry is only returned once, even when the search had to start over
+    assert connector.search_entry_count == len(uids)
+    # the search is retried with the cookie of the last page received
+    assert calls[drop_at_search] == calls[drop_at_search - 1]
+    if not resumable and drop_at_search > 1:
+        assert calls[drop_at_search + 1] is None
+
+
+@pytest.mark.parametrize('drop_at_search', [1, 2])
+def test_search_reconnects_to_same_server(ldap_directory, ldap_connector, drop_at_search):
+    ldap_directory.update(user_entry('user%d' % i) for i in range(5))
+    connector = ldap_connector(search_page_size=2, search_retry_delay=0)
+    connection = connector.connection
+    search = connection.search
+    calls = []
+
+    class ServerPool(object):
+        # stands in for the pool of additional_hosts, which would pick the next server
+        servers_given = 0
+
+        def get_server(self, connection):
+            self.servers_given += 1
+            return connection.server
+
+    pool = connection.server_pool = ServerPool()
+
+    def flaky_search(*args, **kwargs):
+        calls.append(kwargs.get('paged_cookie'))
+        if len(calls) == drop_at_search:
+            raise ldap3.core.exceptions.LDAPSocketReceiveError('connection reset')
+        return search(*args, **kwargs)
+
+    connection.search = flaky_search
+    assert len(load_users(connector, [], True)) == 5
+    # the search only moves to another server of the pool before any page was received
+    assert pool.servers_given == (1 if drop_at_search == 1 else 0)
+    assert connection.server_pool is pool
+
+
+def test_search_gives_up_after_retries(ldap_directory, ldap_connector):
+    ldap_directory.update([user_entry('alice')])
+    connector = ldap_connector(search_retry_count=2, search_retry_delay=0)
+
+    def dropped_search(*args, **kwargs):
+        raise ldap3.core.exceptions.LDAPSocketReceiveError('connection reset')
+
+    connector.connection.search = dropped_search
+    with pytest.raises(AssertionException):
+        load_users(connector, [], True)
+
+
+def test_schema_cache(ldap_directory, ldap_connector, monkeypatch, tmpdir):
+    schema = ldap3.Server('slapd', get_info=ldap3.OFFLINE_SLAPD_2_4).schema
+    schema_reads = []
+
+    def read_server_schema(connector):
+        schema_reads.append(connector)
+        return schema
+
+    monkeypatch.setattr(LDAPDirectoryConnector, 'read_server_schema', read_server_schema)
+    ldap_directory.update([user_entry('alice')])
+    cache_file = str(tmpdir.join('schema.json'))
+    for _ in range(2):
+        connector = ldap_connector(schema_cache_file=cache_file, additional_hosts=['ldap://mock_ldap_2'])
+        # setting up the connector only binds; the schema is attached before the users are searched for
+        assert all(server.schema is None for server in connector.server.servers)
+        assert list(load_users(connector, [], True)) == ['alice@example.com']
+        for server in connector.server.servers:
+            assert server.schema is not None
+            assert server.get_info == ldap3.NONE
+    # the second connector reads the schema from the cache
+    assert len(schema_reads) == 1
+
+
+def test_incremental_sync(ldap_directory, ldap_connector, tmpdir):
+    snapshot_file = str(tmpdir.join('ldap-snapshot.json'))
+    for uid in ('alice', 'bob', 'carol'):
+        dn, user = user_entry(uid, modifyTimestamp='20200101000000Z')
+        ldap_directory[dn] = user
+    options = {'incremental_sync': {'snapshot_file': snapshot_file, 'change_attribute': 'modifyTimestamp'}}
+
+    connector = ldap_connector(**options)
+    users = load_users(connector, [], True)
+    assert sorted(users) == ['alice@example.com', 'bob@example.com', 'carol@example.com']
+
+    bob_dn, bob = user_entry('bob', givenName='Robert', modifyTimestamp='20200102000000Z')
+    carol_dn, carol = user_entry('carol', objectClass=['contact'], modifyTimestamp='20200102000000Z')
+    dave_dn, dave = user_entry('dave', modifyTimestamp='20200103000000Z')
+    ldap_directory.update({bob_dn: bob, carol_dn: carol, dave_dn: dave})
+
+    connector = ldap_connector(**options)
+    users = load_users(connector, [], True)
+    assert sorted(users) == ['alice@example.com', 'bob@example.com', 'dave@example.com']
+    assert users['bob@example.com']['firstname'] == 'Robert'
+    # one search for changed users and one for changed entries that are no longer users.  Entries changed in
+    # the same second as the high-water mark (alice) are read again.
+    assert connector.connection.usage.search_operations == 2
+    assert connector.search_entry_count == 4
+
+    # a change to the settings causes a full sync
+    connector = ldap_connector(user_given_name_format='{uid}', **options)
+    users = load_users(connector, [], True)
+    assert users['bob@example.com']['firstname'] == 'bob'
+    assert connector.search_entry_count == 3
+
+
+def test_incremental_sync_dynamic_groups(ldap_directory, ldap_connector, tmpdir):
+    connector = ldap_connector(dynamic_group_member_attribute='memberOf',
+                               incremental_sync={'snapshot_file': str(tmpdir.join('ldap-snapshot.json'))})
+    connector.additional_group_filters = ['team.*']
+    with pytest.raises(AssertionException, match='additional_groups'):
+        load_users(connector, [], True)
+
+
+def test_incremental_sync_with_schema(ldap_directory, ldap_connector, tmpdir):
+    # with the schema, ldap3 returns modifyTimestamp as a single datetime rather than a list of strings
+    schema = ldap3.Server('slapd', get_info=ldap3.OFFLINE_SLAPD_2_4).schema
+    for uid in ('alice', 'bob'):
+        dn, user = user_entry(uid, modifyTimestamp='20200101000000Z')
+        ldap_directory[dn] = user
+    options = {'incremental_sync': {'snapshot_file': str(tmpdir.join('ldap-snapshot.json')),
+                                    'change_attribute': 'modifyTimestamp'}}
+
+    def schema_connector():
+        connector = ldap_connector(**options)
+        # the mock connection doesn't use the connector's servers, so the schema is attached to its own
+        connector.connection.server.attach_schema_info(schema)
+        connector.schema_loaded = True
+        return connector
+
+    connector = schema_connector()
+    assert sorted(load_users(connector, [], True)) == ['alice@example.com', 'bob@example.com']
+    bob_dn, bob = user_entry('bob', givenName='Robert', modifyTimestamp='20200102000000Z')
+    ldap_directory[bob_dn] = bob
+    connector = schema_connector()
+    users = load_users(connector, [], True)
+    assert users['bob@example.com']['firstname'] == 'Robert'
+    # the entries changed since the high-water mark are read, including alice, changed in the same second
+    assert connector.search_entry_count == 2
+
+
+def test_incremental_sync_usn_server(ldap_directory, ldap_connector, monkeypatch, tmpdir):
+    ldap_directory.update(user_entry(uid, uSNChanged=i) for i, uid in enumerate(['alice', 'bob', 'carol']))
+    monkeypatch.setattr(LDAPDirectoryConnector, 'get_highest_usn', lambda connector: 10)
+    connector = ldap_connector(connection_pool_size=3, scan_partition_attribute='uid',
+                               additional_hosts=['ldap://mock_ldap_2'],
+                               incremental_sync={'snapshot_file': str(tmpdir.join('ldap-snapshot.json')),
+                                                 'change_attribute': 'uSNChanged'})
+    servers = []
+    connection_class = connector.connection_class
+
+    def make_connection(server, **kwargs):
+        servers.append(server)
+        return connection_class(server, **kwargs)
+
+    connector.connection_class = make_connection
+    users = load_users(connector, [], True)
+    assert sorted(users) == ['alice@example.com', 'bob@example.com', 'carol@example.com']
+    # the partitions are all searched on the server the high-water mark was read from
+    assert servers and all(server is connector.connection.server for server in servers)
+    assert connector.worker_server is None
+
+
+@pytest.mark.parametrize('all_users', [True, False])
+def test_member_of_lookup(ldap_directory, ldap_connector, all_users):
+    staff_dn, staff = group_entry('staff', [])
+    eng_dn, eng = group_entry('eng', [])
+    alice_dn, alice = user_entry('alice', memberOf=[staff_dn, eng_dn])
+    bob_dn, bob = user_entry('bob', memberOf=[staff_dn.upper()])
+    carol_dn, carol = user_entry('carol')
+    ldap_directory.update({staff_dn: staff, eng_dn: eng, alice_dn: alice, bob_dn: bob, carol_dn: carol})
+
+    connector = ldap_connector(member_of_lookup=True)
+    users = load_users(connector, ['staff', 'eng', 'missing'], all_users)
+    assert sorted(users['alice@example.com']['groups']) == ['eng', 'staff']
+    assert users['bob@example.com']['groups'] == ('staff',)
+    assert ('carol@example.com' in users) == all_users
+    # one search for the group DNs (and one more for the missing group), and a single user search
+    assert connector.connection.usage.search_operations == 3
+
+
+def test_member_of_lookup_options(ldap_directory, ldap_connector):
+    # the default member filter is allowed, as it's what the memberOf values say anyway
+    ldap_connector(member_of_lookup=True, group_member_filter_format='(memberOf={group_dn})')
+    with pytest.raises(AssertionException):
+        ldap_connector(member_of_lookup=True, group_member_filter_format='(isMemberOf={group_dn})')
+
+
+def test_dynamic_group_dn_cache(ldap_directory, ldap_connector):
+    group_dns = ['cn=team%d,ou=groups,%s' % (i, BASE_DN) for i in range(3)]
+    other_dn = 'cn=other,ou=lists,%s' % BASE_DN
+    for uid in ('alice', 'bob', 'carol'):
+        dn, user = user_entry(uid, memberOf=group_dns + [other_dn])
+        ldap_directory[dn] = user
+
+    connector = ldap_connector(dynamic_group_member_attribute='memberOf',
+                               dynamic_group_base_dn='ou=groups,%s' % BASE_DN)
+    connector.additional_group_filters = ['team.*']
+    users = load_users(connector, [], True)
+    for user in users.values():
+        assert sorted(user['member_groups']) == ['team0', 'team1', 'team2']
+    cache_info = connector.cached_cn_from_dn.cache_info()
+    assert (cache_info.hits, cache_info.misses) == (8, 4)
+
+
+@pytest.mark.parametrize('string_format,expected', [
+    ('{mail}', ('alice@example.com', 'mail')),
+    ('{givenName}.{sn}@example.com', ('Alice.User@example.com', 'sn')),
+    ('{givenName!r}', ("'Alice'", 'givenName')),
+    ('{uidNumber:05d}', ('00042', 'uidNumber')),
+    ('{givenName}{c}', (None, 'c')),
+    ('fixed', ('fixed', None)),
+    (None, (None, None)),
+])
+def test_value_formatter(string_format, expected):
+    record = {'mail': ['alice@example.com'], 'givenName': 'Alice', 'sn': ['User'], 'uidNumber': [42], 'c': []}
+    assert LDAPValueFormatter(string_format).generate_value(record) == expected
+
+
+def test_bulk_group_dn_lookup(ldap_directory, ldap_connector, tmpdir):
+    for name in ('staff', 'eng', 'ops'):
+        dn, group = group_entry(name, [])
+        ldap_directory[dn] = group
+    cache_file = str(tmpdir.join('group-dns.json'))
+    options = {'group_lookup_batch_size': 2, 'group_dn_cache_file': cache_file}
+
+    connector = ldap_connector(**options)
+    connector.find_ldap_group_dns(['staff', 'ENG', 'ops', 'missing'])
+    assert connector.group_dn_by_name == {
+        'staff': 'cn=staff,ou=groups,%s' % BASE_DN,
+        'ENG': 'cn=eng,ou=groups,%s' % BASE_DN,
+        'ops': 'cn=ops,ou=groups,%s' % BASE_DN,
+        'missing': None,
+    }
+    # two batches, then a search of its own for the group that wasn't matched
+    assert connector.connection.usage.search_operations == 3
+
+    # groups are read from the cache next time, including the one that wasn't found
+    connector = ldap_connector(**options)
+    connector.find_ldap_group_dns(['staff', 'ENG', 'ops', 'missing'])
+    assert connector.find_ldap_group_dn('ops') == 'cn=ops,ou=groups,%s' % BASE_DN
+    assert connector.group_dn_by_name['missing'] is None
+    assert connector.connection.usage.search_operations == 0
+
+
+def test_bulk_group_dn_lookup_unmatched_name(ldap_directory, ldap_connector):
+    dn, group = group_entry('Sales  Team', [])
+    ldap_directory[dn] = group
+
+    # the server matches the name, but it doesn't compare equal to the cn read back
+    connector = ldap_connector()
+    connector.find_ldap_group_dns([' sales  team ', 'missing'])
+    assert connector.group_dn_by_name == {' sales  team ': dn, 'missing': None}
+
+
+def test_bulk_group_dn_lookup_ambiguous(ldap_directory, ldap_connector):
+    for dn in ('cn=staff,ou=groups,%s' % BASE_DN, 'cn=staff,ou=lists,%s' % BASE_DN):
+        ldap_directory[dn] = {'objectClass': ['groupOfNames'], 'cn': 'staff'}
+
+    connector = ldap_connector()
+    with pytest.raises(AssertionException, match='Multiple LDAP groups found for: staff'):
+        connector.find_ldap_group_dns(['staff'])
+
+
+def test_group_dn_lookup_fallback(ldap_directory, ldap_connector):
+    for name in ('staff', 'eng'):
+        dn, group = group_entry(name, [])
+        ldap_directory[dn] = group
+
+    # the group name isn't matched by a simple (attribute={group}) clause, so each group is searched for
+    connector = ldap_connector(group_filter_format='(&(objectClass=groupOfNames)(|(cn={group})(cn={group}-x)))')
+    connector.find_ldap_group_dns(['staff', 'eng'])
+    assert connector.group_dn_by_name['eng'] == 'cn=eng,ou=groups,%s' % BASE_DN
+    assert connector.connection.usage.search_operations == 2
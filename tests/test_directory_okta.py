@@ -0,0 +1,160 @@
+import pytest
+
+from user_sync.connector.directory_okta import OktaDirectoryConnector, OKTAUserFilter
+from user_sync.connector.okta_client import OktaClient
+from user_sync.error import AssertionException
+
+
+class Profile(object):
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class User(object):
+    def __init__(self, status, **profile):
+        self.id = '00u1'
+        self.status = status
+        self.profile = Profile(**profile)
+
+
+@pytest.mark.parametrize('filter_string,expected', [
+    ('user.status == "ACTIVE"', 'status eq "ACTIVE"'),
+    ('"ACTIVE" == user.status', 'status eq "ACTIVE"'),
+    ('user.status == "ACTIVE" and user.profile.department == \'R"D\'',
+     '(status eq "ACTIVE" and profile.department eq "R\\"D")'),
+    ('user.status == "ACTIVE" and len(user.profile.login) > 3', 'status eq "ACTIVE"'),
+    ('user.status == "ACTIVE" or user.status == "STAGED"', '(status eq "ACTIVE" or status eq "STAGED")'),
+    ('user.status == "ACTIVE" or len(user.profile.login) > 3', None),
+    ('user.status != "ACTIVE"', None),
+    ('user.lastUpdated == "2020"', None),
+])
+def test_user_filter_search_expression(filter_string, expected):
+    assert OKTAUserFilter(filter_string).search_expression == expected
+
+
+def test_user_filter_matches():
+    user_filter = OKTAUserFilter('user.status == "ACTIVE" and len(user.profile.login) > 3')
+    assert user_filter.matches(User('ACTIVE', login='alice'))
+    assert not user_filter.matches(User('ACTIVE', login='bob'))
+    assert not user_filter.matches(User('SUSPENDED', login='alice'))
+
+
+def test_user_filter_errors():
+    with pytest.raises(AssertionException):
+        OKTAUserFilter('user.status ==')
+    with pytest.raises(AssertionException):
+        OKTAUserFilter('user.status == "ACTIVE") or (True')
+    with pytest.raises(AssertionException):
+        OKTAUserFilter('open("x")').matches(User('ACTIVE'))
+
+
+def okta_user(uid, **profile):
+    profile.setdefault('email', '%s@example.com' % uid)
+    return {'id': uid, 'status': 'ACTIVE', 'lastUpdated': '2020-01-01T00:00:00.000Z', 'profile': profile,
+            '_links': {'self': {'href': 'https://example.okta.com/api/v1/users/%s' % uid}}}
+
+
+@pytest.fixture
+def okta_connector(okta_server):
+    def _okta_connector(**options):
+        caller_options = {'host': 'example.okta.com', 'api_token': 'token'}
+        caller_options.update(options)
+        connector = OktaDirectoryConnector(caller_options)
+        # the stand-in server doesn't use https
+        connector.client = OktaClient(okta_server.url, 'token', connector.rate_limiter,
+                                      pool_size=connector.options['concurrent_requests'])
+        return connector
+
+    return _okta_connector
+
+
+@pytest.mark.parametrize('concurrent_requests', [1, 3])
+def test_load_group_members(okta_server, okta_connector, concurrent_requests):
+    okta_server.add_group('g1', [okta_user('u1', dept='R&D'), okta_user('u2'), okta_user('u3')])
+    okta_server.add_group('g2', [okta_user('u3'), okta_user('u4')])
+    okta_server.add_group('g3', [okta_user('u1', dept='R&D')] + [okta_user('u%d' % i) for i in range(5, 9)])
+    suspended = okta_user('u9')
+    suspended['status'] = 'SUSPENDED'
+    okta_server.group_members['00g2'].append(suspended)
+
+    connector = okta_connector(concurrent_requests=concurrent_requests)
+    users = dict((user['uid'], user) for user in connector.load_users_and_groups(['g1', 'g2', 'g3'], ['dept'], False))
+    assert sorted(users) == ['u%d' % i for i in range(1, 9)]
+    assert users['u1']['groups'] == ('g1', 'g3')
+    assert users['u3']['groups'] == ('g1', 'g2')
+    assert users['u1']['email'] == 'u1@example.com'
+    assert users['u1']['source_attributes']['dept'] == 'R&D'
+    assert connector.client_filtered_count == 1
+    # one group search for each group, then the pages of members
+    assert len(okta_server.requests) == 3 + 2 + 1 + 3
+
+
+def test_load_group_members_error(okta_server, okta_connector):
+    for i in range(10):
+        okta_server.add_group('g%d' % i, [okta_user('u%d' % i)])
+    okta_server.statuses = [500]
+    connector = okta_connector(concurrent_requests=2)
+    with pytest.raises(AssertionException):
+        list(connector.load_users_and_groups(['g%d' % i for i in range(10)], [], False))
+    # the groups that weren't being fetched when the error came are dropped
+    assert len(okta_server.requests) < 10
+
+
+def test_load_all_users(okta_server, okta_connector):
+    users = [okta_user('u%d' % i, dept='R&D' if i % 2 else 'Sales') for i in range(1, 8)]
+    users[6]['status'] = 'SUSPENDED'
+    okta_server.users = users
+    okta_server.add_group('g1', users[:3])
+    okta_server.add_group('g2', users[2:5] + users[6:])
+    okta_server.add_group('unmapped', users)
+
+    connector = okta_connector(all_users_filter='user.status == "ACTIVE" and user.profile.dept != "Sales"')
+    loaded = dict((user['uid'], user) for user in connector.load_users_and_groups(['g1', 'g2'], [], True))
+    assert sorted(loaded) == ['u1', 'u3', 'u5']
+    assert loaded['u1']['groups'] == ('g1',)
+    assert loaded['u3']['groups'] == ('g1', 'g2')
+    assert loaded['u5']['groups'] == ('g2',)
+    # the users are listed once, with the part of the filter that Okta can search for
+    user_requests = [(path, query.get('search')) for path, query, _ in okta_server.requests[:3]]
+    assert user_requests == [('/api/v1/users', 'status eq "ACTIVE"')] * 3
+    # then the mapped groups are searched and their members listed
+    assert [path for path, _, _ in okta_server.requests[3:]] == [
+        '/api/v1/groups', '/api/v1/groups/00g0/users', '/api/v1/groups/00g0/users',
+        '/api/v1/groups', '/api/v1/groups/00g1/users', '/api/v1/groups/00g1/users']
+
+
+def test_incremental_sync(okta_server, okta_connector, tmpdir):
+    users = dict((uid, okta_user(uid, firstName=uid.upper())) for uid in ('u1', 'u2', 'u3', 'u4'))
+    okta_server.users = list(users.values())
+    okta_server.add_group('g1', [users['u1'], users['u2']])
+    okta_server.add_group('g2', [users['u2'], users['u3']])
+    options = {'incremental_sync': {'snapshot_file': str(tmpdir.join('okta-snapshot.json'))}}
+
+    def load():
+        del okta_server.requests[:]
+        connector = okta_connector(**options)
+        return dict((user['uid'], user) for user in connector.load_users_and_groups(['g1', 'g2'], [], False))
+
+    loaded = load()
+    assert sorted(loaded) == ['u1', 'u2', 'u3']
+    # a full sync: the group searches and their members
+    assert [path for path, _, _ in okta_server.requests] == [
+        '/api/v1/groups', '/api/v1/groups', '/api/v1/groups/00g0/users', '/api/v1/groups/00g1/users']
+
+    users['u1']['profile']['firstName'] = 'Changed'
+    users['u1']['lastUpdated'] = '2099-01-01T00:00:00.000Z'
+    okta_server.group_members['00g1'].append(users['u4'])
+    okta_server.groups[1]['lastMembershipUpdated'] = '2099-01-01T00:00:00.000Z'
+    loaded = load()
+    assert sorted(loaded) == ['u1', 'u2', 'u3', 'u4']
+    assert loaded['u1']['firstname'] == 'Changed'
+    assert loaded['u2']['groups'] == ('g1', 'g2')
+    assert loaded['u4']['groups'] == ('g2',)
+    # the updated users, the group searches and the members of the group that changed (in 2 pages)
+    assert [path for path, _, _ in okta_server.requests] == [
+        '/api/v1/users', '/api/v1/groups', '/api/v1/groups', '/api/v1/groups/00g1/users', '/api/v1/groups/00g1/users']
+
+    # a periodic full sync fetches everything again
+    options['incremental_sync']['full_sync_interval'] = -1
+    assert sorted(load()) == ['u1', 'u2', 'u3', 'u4']
+    assert '/api/v1/users' not in [path for path, _, _ in okta_server.requests]
@@ -0,0 +1,95 @@
+import logging
+import time
+
+import pytest
+
+from user_sync.connector.okta_client import OktaClient, OktaClientError, OktaObject, RateLimiter
+
+
+@pytest.fixture
+def okta_client(okta_server):
+    return OktaClient(okta_server.url, 'token', RateLimiter(10, logging.getLogger('test')))
+
+
+def test_paged_group_members(okta_server, okta_client):
+    group_id = okta_server.add_group('staff', [{'id': 'u%d' % i, 'profile': {'email': 'u%d@example.com' % i}}
+                                               for i in range(5)])
+    pages = list(okta_client.iter_group_member_pages(group_id))
+    assert [[user.id for user in page] for page in pages] == [['u0', 'u1'], ['u2', 'u3'], ['u4']]
+    assert isinstance(pages[0][0].profile, OktaObject)
+    assert pages[0][0].profile.email == 'u0@example.com'
+    with pytest.raises(AttributeError):
+        pages[0][0].profile.department
+    # one kept-alive connection, gzipped responses and the API token on every request
+    assert len(okta_server.connections) == 1
+    for _, _, headers in okta_server.requests:
+        assert 'gzip' in headers['Accept-Encoding']
+        assert headers['Authorization'] == 'SSWS token'
+
+
+def test_group_search_and_users(okta_server, okta_client):
+    okta_server.add_group('staff', [])
+    okta_server.add_group('students', [])
+    okta_server.users = [{'id': 'u0', 'lastUpdated': '2020-01-01T00:00:00.000Z', 'profile': {}},
+                         {'id': 'u1', 'lastUpdated': '2020-02-01T00:00:00.000Z', 'profile': {}}]
+    assert [group.profile.name for group in okta_client.get_groups('sta')] == ['staff']
+    assert okta_client.get_groups('x') == []
+    search = 'lastUpdated gt "2020-01-15T00:00:00.000Z"'
+    assert [[user.id for user in page] for page in okta_client.iter_user_pages(search)] == [['u1']]
+    assert okta_server.requests[-1][1] == {'search': search}
+
+
+def test_errors_and_retries(okta_server, okta_client, monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    okta_server.add_group('staff', [])
+    okta_server.statuses = [429, 200]
+    assert len(okta_client.get_groups('staff')) == 1
+    okta_server.statuses = [403]
+    with pytest.raises(OktaClientError) as error:
+        okta_client.get_groups('staff')
+    assert 'Error 403' in str(error.value)
+
+
+def test_retry_after_reset(okta_server, okta_client, monkeypatch):
+    sleeps = []
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(time, 'sleep', sleep)
+    okta_server.add_group('staff', [])
+    okta_server.rate_limit_headers = {'X-Rate-Limit-Limit': '100', 'X-Rate-Limit-Remaining': '0',
+                                      'X-Rate-Limit-Reset': '1030'}
+    okta_server.statuses = [429, 200]
+    assert len(okta_client.get_groups('staff')) == 1
+    # the retry waited for the window given by the headers to reset
+    assert sleeps == [31]
+    assert len(okta_server.requests) == 2
+
+
+def test_rate_limiter_waits_for_reset(monkeypatch):
+    sleeps = []
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(time, 'sleep', sleep)
+    limiter = RateLimiter(10, logging.getLogger('test'))
+    limiter.acquire()
+    limiter.update({'X-Rate-Limit-Limit': '100', 'X-Rate-Limit-Remaining': '12', 'X-Rate-Limit-Reset': '1030'})
+    limiter.acquire()
+    limiter.acquire()
+    assert sleeps == []
+    # 10 requests left is the headroom
+    limiter.acquire()
+    assert sleeps == [31]
+    # a later response of the same window can't raise the count
+    limiter.update({'X-Rate-Limit-Limit': '100', 'X-Rate-Limit-Remaining': '90', 'X-Rate-Limit-Reset': '1090'})
+    limiter.acquire()
+    assert sleeps == [31]
@@ -0,0 +1,97 @@
+import logging
+import threading
+
+import pytest
+
+from user_sync.connector.umapi import ActionManager
+from user_sync.rules import RuleProcessor, UmapiConnectors
+from util import BatchConnection, add_actions
+
+
+class StandInUmapiConnector(object):
+    """
+    Stands in for a UmapiConnector, with its actions sent by a BatchConnection.  Given a barrier, reading the
+    users waits at it first, so that the users of several umapis must be read at the same time.
+    """
+
+    def __init__(self, name, users, barrier=None):
+        self.name = name
+        self.users = users
+        self.barrier = barrier
+        self.threads = set()
+        self.action_manager = ActionManager(BatchConnection(), 'org', logging.getLogger('test'), 1)
+
+    def iter_users(self, in_group=None):
+        self.threads.add(threading.current_thread().name)
+        if self.barrier is not None:
+            self.barrier.wait(5)
+        for user in self.users:
+            yield user
+
+    def get_action_manager(self):
+        return self.action_manager
+
+
+def make_connectors(count):
+    secondaries = dict(('org%d' % i, StandInUmapiConnector('umapi.org%d' % i, [{'email': 'u%d' % i}]))
+                       for i in range(count))
+    return UmapiConnectors(StandInUmapiConnector('umapi', []), secondaries)
+
+
+@pytest.mark.parametrize('include_primary', [False, True])
+def test_prefetch_umapi_users(include_primary):
+    # the umapis being read wait for each other, so they can only all be read if they are read at the same time
+    names = ['org0', 'org1', 'org3']
+    umapi_connectors = make_connectors(4)
+    barrier = threading.Barrier(len(names) + (1 if include_primary else 0))
+    for connector in umapi_connectors.connectors:
+        connector.barrier = barrier
+    processor = RuleProcessor({'concurrent_orgs': 5})
+    for name in names:
+        processor.get_umapi_info(name).add_mapped_group('group')
+    processor.prefetch_umapi_users(umapi_connectors, include_primary)
+    assert sorted(processor.umapi_prefetch.users, key=str) == ([None] if include_primary else []) + names
+    assert [processor.umapi_prefetch.get_users(name) for name in names] == [[{'email': 'u0'}], [{'email': 'u1'}],
+                                                                            [{'email': 'u3'}]]
+    assert not barrier.broken
+    assert threading.current_thread().name not in umapi_connectors.get_secondary_connectors()['org0'].threads
+    # the users are handed over once; those not prefetched are read when their umapi is synced
+    assert processor.umapi_prefetch.get_users('org0') is None
+    assert processor.umapi_prefetch.get_users('org2') is None
+    processor.umapi_prefetch.stop()
+
+
+def test_prefetch_stops():
+    first_read, resume = threading.Event(), threading.Event()
+
+    def iter_users(in_group=None):
+        for i in range(100):
+            yield {'email': 'u%d' % i}
+            first_read.set()
+            resume.wait(5)
+
+    connector = StandInUmapiConnector('umapi', [])
+    connector.iter_users = iter_users
+    processor = RuleProcessor({})
+    processor.prefetch_umapi_users(UmapiConnectors(connector, {}), True)
+    assert first_read.wait(5)
+    future = processor.umapi_prefetch.users[None]
+    processor.umapi_prefetch.stop()
+    # stopping doesn't wait for the reading to finish, and the reading ends at the next user
+    assert not future.done()
+    resume.set()
+    assert future.result() == [{'email': 'u0'}]
+
+
+def test_execute_actions_in_parallel():
+    # each umapi's batch waits for the others' at the barrier, so the umapis must send them at the same time
+    barrier = threading.Barrier(4)
+    umapi_connectors = make_connectors(3)
+    for connector in umapi_connectors.connectors:
+        connector.get_action_manager().connection.barrier = barrier
+        add_actions(connector.get_action_manager(), 2)
+    umapi_connectors.execute_actions()
+    assert not barrier.broken
+    for connector in umapi_connectors.connectors:
+        assert connector.get_action_manager().get_statistics() == (2, 0)
+        assert not connector.get_action_manager().has_work()
@@ -0,0 +1,233 @@
+import logging
+import threading
+import time
+
+import pytest
+import umapi_client
+
+import user_sync.connector.umapi
+
+from user_sync.connector.umapi import ActionManager, Commands, PageFetcher
+from user_sync.error import AssertionException
+from util import BatchConnection, add_actions
+
+
+@pytest.mark.parametrize('send_threads', [0, 1, 3])
+def test_send_batches(send_threads):
+    connection = BatchConnection(delay=0.01)
+    action_manager = ActionManager(connection, 'org', logging.getLogger('test'), send_threads, 2)
+    results = []
+    request_ids = add_actions(action_manager, 8, results.append)
+    action_manager.flush()
+    assert not action_manager.has_work()
+    assert sorted(connection.batches) == sorted([request_ids[0:3], request_ids[3:6], request_ids[6:8]])
+    assert sorted(result['action'].frame['requestID'] for result in results) == sorted(request_ids)
+    assert all(result['is_success'] for result in results)
+    assert action_manager.get_statistics() == (8, 0)
+    if send_threads:
+        assert threading.current_thread().name not in connection.threads
+    else:
+        assert connection.threads == {threading.current_thread().name}
+    # the sending threads take turns with a shared connection
+    assert connection.max_active == 1
+
+
+def test_send_connection_per_thread():
+    connections = []
+
+    def make_connection():
+        connections.append(BatchConnection(delay=0.01))
+        return connections[-1]
+
+    action_manager = ActionManager(BatchConnection(), 'org', logging.getLogger('test'), 3, 2,
+                                   connection_factory=make_connection)
+    request_ids = add_actions(action_manager, 12)
+    action_manager.flush()
+    assert not action_manager.connection.batches
+    assert 1 <= len(connections) <= 3
+    assert all(len(connection.threads) == 1 for connection in connections)
+    assert sorted(batch for connection in connections for batch in connection.batches) == \
+        sorted(request_ids[i:i + 3] for i in range(0, 12, 3))
+    # each action manager numbers its own actions
+    assert request_ids[0] == 'action_1'
+
+
+def test_send_batch_errors():
+    error = umapi_client.BatchError([Exception('bad response')], 0, 3, 0)
+    action_manager = ActionManager(BatchConnection(error=error), 'org', logging.getLogger('test'), 2, 2)
+    results = []
+    add_actions(action_manager, 4, results.append)
+    action_manager.flush()
+    assert action_manager.get_statistics() == (4, 4)
+    assert [result['is_success'] for result in results] == [False] * 4
+
+    error = umapi_client.UnavailableError(3, 10, None)
+    action_manager = ActionManager(BatchConnection(error=error), 'org', logging.getLogger('test'), 2, 2)
+    with pytest.raises(AssertionException):
+        add_actions(action_manager, 4)
+        action_manager.flush()
+
+
+class PageConnection(object):
+    """
+    Stands in for a UMAPI connection, returning pages of users like query_multiple does.  The first request for
+    each of the throttled pages is refused with a 429 response.
+    """
+
+    class Response(object):
+        status_code = 429
+
+        def __init__(self, retry_after):
+            self.headers = {'Retry-After': str(retry_after)}
+
+    def __init__(self, users, page_size=2, throttled_pages=(), always_throttled=False, clock=time.time):
+        self.pages = [users[i:i + page_size] for i in range(0, len(users), page_size)]
+        self.throttled_pages = set(throttled_pages)
+        self.always_throttled = always_throttled
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.requests = []
+
+    def query_multiple(self, object_type, page=0, url_params=None, query_params=None):
+        with self.lock:
+            if self.always_throttled or page in self.throttled_pages:
+                self.throttled_pages.discard(page)
+                self.requests.append((page, self.clock(), 429))
+                raise umapi_client.UnavailableError(1, 0, self.Response(1))
+            self.requests.append((page, self.clock(), 200))
+        # later pages take less time, so they would arrive first
+        time.sleep(0.02 * (len(self.pages) - page) / len(self.pages))
+        values = self.pages[page] if page < len(self.pages) else []
+        return values, page >= len(self.pages) - 1, 0, len(self.pages), page + 1, 2
+
+
+def fetch_users(connection, width, max_attempts=4):
+    fetcher = PageFetcher(connection, width, max_attempts, logging.getLogger('test'))
+    return [[user['email'] for user in page] for page, _ in fetcher.iter_pages('user')]
+
+
+@pytest.mark.parametrize('width', [1, 4])
+def test_fetch_pages_in_order(width):
+    users = [{'email': 'user%d@example.com' % i} for i in range(11)]
+    pages = fetch_users(PageConnection(users), width)
+    assert pages == [[user['email'] for user in users[i:i + 2]] for i in range(0, 11, 2)]
+
+
+class FakeClock(object):
+    """
+    Stands in for the time module in the page fetcher: time only moves when a thread sleeps, and the delays
+    asked for are recorded
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+        self.lock = threading.Lock()
+
+    def time(self):
+        with self.lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+
+def test_fetch_pages_back_off(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(user_sync.connector.umapi, 'time', clock)
+    users = [{'email': 'user%d@example.com' % i} for i in range(20)]
+    connection = PageConnection(users, throttled_pages=[2], clock=clock.time)
+    pages = fetch_users(connection, 4)
+    assert [email for page in pages for email in page] == [user['email'] for user in users]
+    # the fetcher paused for the Retry-After of the 429; any other thread waited for the same pause rather than
+    # backing off on its own
+    assert clock.sleeps and clock.sleeps[0] == 1
+    assert all(0 < seconds <= 1 for seconds in clock.sleeps)
+    # the throttled page was requested again once the pause was over
+    throttle_time = [t for page, t, status in connection.requests if status == 429][0]
+    assert [t - throttle_time >= 1 for page, t, status in connection.requests if page == 2] == [False, True]
+
+    clock = FakeClock()
+    monkeypatch.setattr(user_sync.connector.umapi, 'time', clock)
+    with pytest.raises(umapi_client.UnavailableError):
+        fetch_users(PageConnection(users, always_throttled=True, clock=clock.time), 4, max_attempts=2)
+
+
+def user_commands(i, identity_type='federatedID', add=(), remove=(), update=None, create=False):
+    commands = Commands(identity_type, 'user%d@example.com' % i, 'user%d@example.com' % i, 'example.com')
+    if create:
+        commands.add_user({'email': commands.email})
+    commands.update_user(update)
+    commands.remove_groups(set(remove))
+    commands.add_groups(set(add))
+    return commands
+
+
+def test_group_actions():
+    connection = BatchConnection()
+    connection.throttle_actions = 10
+    connection.throttle_groups = 2
+    connection.throttle_commands = 2
+    action_manager = ActionManager(connection, 'org', logging.getLogger('test'), 1, 2, group_action_threshold=3)
+    results = {}
+
+    def callback(i):
+        return lambda result: results.setdefault(i, []).append(result)
+
+    for i in range(6):
+        action_manager.add_commands(user_commands(i, add=['big'] + (['small'] if i == 0 else []),
+                                                  update={'firstname': 'F'} if i == 1 else None), callback(i))
+    for i in range(6, 9):
+        action_manager.add_commands(user_commands(i, remove=['old']), callback(i))
+    # users being created, and Adobe IDs, keep their own actions
+    action_manager.add_commands(user_commands(9, add=['big'], create=True), callback(9))
+    action_manager.add_commands(user_commands(10, 'adobeID', add=['big']), callback(10))
+    # only the attribute update and the actions that can't be held have been added yet
+    assert action_manager.get_statistics() == (3, 0)
+    action_manager.flush()
+
+    # 3 not held back, 1 for user0's small group, 2 for the 6 users added to big (4 per action), 1 to remove from old
+    assert action_manager.get_statistics() == (7, 0)
+    assert sum(len(batch) for batch in connection.batches) == 7
+    # each user's callback is called once, when all its changes are sent
+    assert sorted(results) == list(range(11))
+    assert all(len(result) == 1 and result[0]['is_success'] for result in results.values())
+
+
+def test_group_action_commands():
+    connection = BatchConnection()
+    connection.throttle_groups = 2
+    connection.throttle_commands = 2
+    action_manager = ActionManager(connection, 'org', logging.getLogger('test'), 0, group_action_threshold=2)
+    sent = []
+    action_manager.add_action = lambda action, callback=None, parts=None: sent.append(action)
+    for i in range(5):
+        action_manager.add_commands(user_commands(i, add=['big']))
+    action_manager.add_commands(user_commands(5, add=['small']))
+    action_manager.flush()
+    assert [action.frame.get('usergroup') for action in sent] == [None, 'big', 'big']
+    assert sent[0].frame['user'] == 'user5@example.com'
+    assert [command['add']['user'] for command in sent[1].commands] == [
+        ['user0@example.com', 'user1@example.com'], ['user2@example.com', 'user3@example.com']]
+    assert [command['add']['user'] for command in sent[2].commands] == [['user4@example.com']]
+
+
+def test_group_action_email_change():
+    connection = BatchConnection()
+    connection.throttle_groups = 5
+    connection.throttle_commands = 5
+    action_manager = ActionManager(connection, 'org', logging.getLogger('test'), 0, group_action_threshold=2)
+    sent = []
+    action_manager.add_action = lambda action, callback=None, parts=None: sent.append(action)
+    for i in range(2):
+        action_manager.add_commands(user_commands(i, add=['big']))
+    # the user changing email keeps its group change in its own action, after the update
+    action_manager.add_commands(user_commands(2, add=['big'], update={'email': 'new2@example.com'}))
+    assert len(sent) == 1
+    assert sent[0].frame['user'] == 'user2@example.com'
+    assert [list(command) for command in sent[0].commands] == [['update'], ['add']]
+    action_manager.flush()
+    assert [action.frame.get('usergroup') for action in sent] == [None, 'big']
+    assert [command['add']['user'] for command in sent[1].commands] == [['user0@example.com', 'user1@example.com']]
@@ -1,4 +1,8 @@
 import collections
+import threading
+import time
+
+from user_sync.connector.umapi import Commands
 
 
 def update_dict(d, ks, u):
@@ -9,3 +13,47 @@ def update_dict(d, ks, u):
     else:
         d[k] = u
     return d
+
+
+class BatchConnection(object):
+    """
+    Stands in for a UMAPI connection, recording the batches it is asked to execute.  Given a barrier, each batch
+    waits at it before it is recorded, so that the batches of several connections must be sent at the same time.
+    """
+    throttle_actions = 3
+
+    def __init__(self, delay=0.0, error=None, barrier=None):
+        self.delay = delay
+        self.error = error
+        self.barrier = barrier
+        self.batches = []
+        self.threads = set()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def execute_multiple(self, actions, immediate=True):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        if self.barrier is not None:
+            self.barrier.wait(5)
+        with self.lock:
+            self.active -= 1
+        self.threads.add(threading.current_thread().name)
+        self.batches.append([action.frame['requestID'] for action in actions])
+        if self.error is not None:
+            raise self.error
+        return 0, len(actions), len(actions)
+
+
+def add_actions(action_manager, count, callback=None):
+    request_ids = []
+    for i in range(count):
+        commands = Commands('federatedID', 'user%d@example.com' % i, 'user%d@example.com' % i, 'example.com')
+        commands.add_groups({'group'})
+        action = action_manager.create_action(commands)
+        request_ids.append(action.frame['requestID'])
+        action_manager.add_action(action, callback)
+    return request_ids
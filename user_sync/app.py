@@ -435,7 +435,10 @@ def begin_work(config_loader):
         # specify the default user_identity_type if it's not already specified in the options
         if 'user_identity_type' not in directory_connector_options:
             directory_connector_options['user_identity_type'] = rule_config['new_account_type']
+        connect_stats = user_sync.helper.JobStats('Set up Directory Connector (%s)' % directory_connector.name)
+        connect_stats.log_start(logger)
         directory_connector.initialize(directory_connector_options)
+        connect_stats.log_end(logger)
 
     additional_group_filters = None
     additional_groups = rule_config.get('additional_groups', None)
@@ -188,10 +188,7 @@ class ConfigLoader(object):
         # --users
         if users_spec:
             users_action = user_sync.helper.normalize_string(users_spec[0])
-            if users_action == 'all':
-                if options['directory_connector_type'] == 'okta':
-                    raise AssertionException('Okta connector module does not support "--users all"')
-            elif users_action == 'file':
+            if users_action == 'file':
                 if options['directory_connector_type'] == 'csv':
                     raise AssertionException('You cannot specify file input with both "users" and "connector" options')
                 if len(users_spec) != 2:
@@ -204,7 +201,7 @@ class ConfigLoader(object):
                 if len(users_spec) != 2:
                     raise AssertionException('You must specify the groups to read when using the users "group" option')
                 options['directory_group_filter'] = users_spec[1].split(',')
-            else:
+            elif users_action != 'all':
                 raise AssertionException('Unknown option "%s" for users' % users_action)
 
         # --adobe-only-user-list
@@ -557,6 +554,14 @@ class ConfigLoader(object):
                     raise AssertionException(validation_message)
                 exclude_groups.append(group.get_group_name())
             options['exclude_groups'] = exclude_groups
+        concurrent_orgs = adobe_config.get_int('concurrent_orgs', True)
+        if concurrent_orgs is not None:
+            if concurrent_orgs < 1:
+                raise AssertionException("concurrent_orgs must be at least 1")
+            options['concurrent_orgs'] = concurrent_orgs
+        prefetch_users = adobe_config.get_bool('prefetch_users', True)
+        if prefetch_users is not None:
+            options['prefetch_users'] = prefetch_users
 
         # get the limits
         limits_config = self.main_config.get_dict_config('limits')
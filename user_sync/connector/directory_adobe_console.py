@@ -127,8 +127,8 @@ class AdobeConsoleConnector(object):
         except Exception as e:
             raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
         logger.debug('%s: connection established', self.name)
-        self.umapi_users = []
         self.user_by_usr_key = {}
+        self.user_keys_by_group = {}
 
     def load_users_and_groups(self, groups, extended_attributes, all_users):
         """
@@ -158,7 +158,7 @@ class AdobeConsoleConnector(object):
                 for user_key in grouped_users:
                     if user_key in self.user_by_usr_key:
                         user = self.user_by_usr_key[user_key]
-                        user['groups'].append(group)
+                        user.add_group(group)
                         self.user_by_usr_key[user_key] = grouped_user_records[user_key] = user
                         group_users_count = group_users_count + 1
                 self.logger.debug('Count of users in group "%s": %d', group, group_users_count)
@@ -203,7 +203,7 @@ class AdobeConsoleConnector(object):
 
         source_attributes['country'] = user['country'] = record['country']
 
-        user['source_attributes'] = source_attributes.copy()
+        user['source_attributes'] = source_attributes
         return user
 
     def iter_umapi_groups(self):
@@ -215,25 +215,44 @@ class AdobeConsoleConnector(object):
             raise AssertionException("Error to query groups from Adobe Console: %s" % e)
 
     def iter_group_members(self, group):
-        umapi_users = self.umapi_users
-        members = filter(lambda u: ('groups' in u and group in u['groups']), umapi_users)
-        for member in members:
-            user_key = self.generate_user_key(member['type'], member['username'], member['domain'])
-            yield (user_key)
+        return iter(self.user_keys_by_group.get(group, ()))
+
+    def iter_umapi_user_pages(self):
+        """
+        Yield the users of the org one page at a time, so that the records of a page can be dropped once they
+        are converted (UsersQuery keeps every record it has fetched)
+        :rtype iterator(list(dict))
+        """
+        page_index = 0
+        while True:
+            # older clients return (users, last page), newer ones add the counts
+            result = self.connection.query_multiple('user', page_index, query_params={'directOnly': True})
+            yield result[0]
+            if result[1] or not result[0]:
+                return
+            page_index += 1
 
     def load_umapi_users(self, identity_type):
+        """
+        Convert the users of the org (of the identity type, unless it's 'all'), and index their keys by group,
+        in one pass over the users
+        :type identity_type: str
+        """
+        user_by_usr_key = self.user_by_usr_key
+        user_keys_by_group = self.user_keys_by_group
         try:
-            u_query = umapi_client.UsersQuery(self.connection)
-            umapi_users = u_query.all_results()
-
-            if not identity_type == 'all':
-                umapi_users = list(filter(lambda usr: usr['type'] == identity_type, umapi_users))
-
-            self.umapi_users = umapi_users
-            for user in umapi_users:
-                # Generate unique user key because Username/Email is a bad unique identifier
-                user_key = self.generate_user_key(user['type'], user['username'], user['domain'])
-                self.user_by_usr_key[user_key] = self.convert_user(user)
+            for page in self.iter_umapi_user_pages():
+                for record in page:
+                    if not identity_type == 'all' and record['type'] != identity_type:
+                        continue
+                    # Generate unique user key because Username/Email is a bad unique identifier
+                    user_key = self.generate_user_key(record['type'], record['username'], record['domain'])
+                    user = self.convert_user(record)
+                    if user is None:
+                        continue
+                    user_by_usr_key[user_key] = user
+                    for group in record.get('groups', ()):
+                        user_keys_by_group.setdefault(group, []).append(user_key)
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
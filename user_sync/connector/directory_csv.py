@@ -163,7 +163,8 @@ class CSVDirectoryConnector(object):
 
             groups = self.get_column_value(row, groups_column_name)
             if groups is not None:
-                user['groups'].extend(groups.split(','))
+                for group in groups.split(','):
+                    user.add_group(group)
 
             username = self.get_column_value(row, username_column_name)
             if username is None:
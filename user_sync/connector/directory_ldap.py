@@ -18,19 +18,35 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import functools
+import re
 import six
 import string
+import time
 
 import ldap3
 
 import user_sync.config
 import user_sync.connector.helper
+import user_sync.connector.snapshot
 import user_sync.error
 import user_sync.identity_type
 from user_sync.error import AssertionException
 
 import platform
 import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+USN_CHANGED = 'uSNChanged'
+MODIFY_TIMESTAMP = 'modifyTimestamp'
+CHANGE_ATTRIBUTES = (USN_CHANGED, MODIFY_TIMESTAMP)
+# first characters of the values of scan_partition_attribute that get a partition of their own
+SCAN_PARTITION_PREFIXES = 'abcdefghijklmnopqrstuvwxyz0123456789'
+DEFAULT_MEMBER_FILTER = six.text_type('(memberOf={group_dn})')
+# times a server pool tries all its servers before giving up (ldap3 waits POOLING_LOOP_TIMEOUT between tries)
+SERVER_POOL_TRIES = 2
+
 
 def connector_metadata():
     metadata = {
@@ -126,17 +142,51 @@ class LDAPDirectoryConnector(object):
         auto_bind = ldap3.AUTO_BIND_NO_TLS
         if options['require_tls_cert']:
             tls = ldap3.Tls(validate=ssl.CERT_REQUIRED, version=ssl.PROTOCOL_TLSv1_2)
+        self.connection_class = Connection
+        self.auth = auth
+        self.connections = []
+        self.worker_connections = []
+        self.worker_server = None
+        self.executor = None
+        self.thread_state = threading.local()
+        self.stats_lock = threading.Lock()
         try:
-            server = ldap3.Server(host=options['host'], allowed_referral_hosts=True, tls=tls)
-            if server.ssl is False and tls is not None:
+            hosts = [options['host']] + options['additional_hosts']
+            # the server info and schema aren't read on bind; the schema is attached once by load_server_schema
+            servers = [ldap3.Server(host=host, allowed_referral_hosts=True, tls=tls, get_info=ldap3.NONE)
+                       for host in hosts]
+            if servers[0].ssl is False and tls is not None:
                 auto_bind = ldap3.AUTO_BIND_TLS_BEFORE_BIND
-            connection = Connection(server, auto_bind=auto_bind, read_only=True, **auth)
+            if len(servers) > 1:
+                self.server = ldap3.ServerPool(servers, ldap3.ROUND_ROBIN, active=SERVER_POOL_TRIES, exhaust=False)
+            else:
+                self.server = servers[0]
+            self.auto_bind = auto_bind
+            connect_start = time.time()
+            connection = self.create_connection()
         except Exception as e:
             raise AssertionException('LDAP connection failure: %s' % e)
         self.connection = connection
-        logger.debug('Connected as %s', connection.extend.standard.who_am_i())
+        self.main_thread = threading.current_thread()
+        logger.debug('Connected to %s in %.2fs', connection.server.name, time.time() - connect_start)
+        # the schema is read when user attributes are first searched for (see get_user_attribute_names)
+        self.schema_loaded = False
         self.user_by_dn = {}
         self.additional_group_filters = None
+        self.search_entry_count = 0
+        self.user_dn_index = None
+        self.non_user_dns = set()
+        self.direct_members_by_dn = {}
+        self.nested_members_by_dn = {}
+        self.member_of_groups = None
+        self.member_of_cache = {}
+        self.user_attribute_names_cache = {}
+        self.group_dn_by_name = {}
+        # group CNs of memberOf values, for dynamic group mappings; each distinct DN is only parsed once
+        self.cached_cn_from_dn = functools.lru_cache(maxsize=options['dn_cache_size'] or None)(self.get_group_cn)
+        group_base_dn = options['dynamic_group_base_dn']
+        self.group_base_dn = six.text_type(group_base_dn) if group_base_dn else None
+        self.group_base_suffix = six.text_type(',') + self.group_base_dn.lower() if group_base_dn else None
 
     @staticmethod
     def get_options(caller_config):
@@ -148,6 +198,8 @@ class LDAPDirectoryConnector(object):
         builder.set_string_value('group_member_filter_format', None)
         builder.set_bool_value('require_tls_cert', False)
         builder.set_dict_value('two_steps_lookup', None)
+        builder.set_dict_value('incremental_sync', None)
+        builder.set_bool_value('member_of_lookup', False)
         builder.set_string_value('string_encoding', 'utf8')
         builder.set_string_value('user_identity_type_format', None)
         builder.set_string_value('user_email_format', six.text_type('{mail}'))
@@ -157,14 +209,58 @@ class LDAPDirectoryConnector(object):
         builder.set_string_value('user_surname_format', six.text_type('{sn}'))
         builder.set_string_value('user_country_code_format', six.text_type('{c}'))
         builder.set_string_value('dynamic_group_member_attribute', None)
+        builder.set_string_value('dynamic_group_base_dn', None)
+        builder.set_int_value('dn_cache_size', 10000)
         builder.set_string_value('user_identity_type', None)
         builder.set_int_value('search_page_size', 200)
+        builder.set_int_value('search_retry_count', 3)
+        builder.set_int_value('search_retry_delay', 5)
+        builder.set_int_value('connection_pool_size', 1)
+        builder.set_int_value('group_lookup_batch_size', 50)
+        builder.set_string_value('group_dn_cache_file', None)
+        builder.set_int_value('group_dn_cache_ttl', 24)
+        builder.set_string_value('schema_cache_file', None)
+        builder.set_int_value('schema_cache_ttl', 24)
+        builder.set_value('additional_hosts', list, [])
+        builder.set_string_value('scan_partition_attribute', None)
+        builder.set_value('scan_partition_filters', list, [])
         builder.set_string_value('logger_name', LDAPDirectoryConnector.name)
         builder.set_string_value('authentication_method', six.text_type('simple'))
         builder.set_string_value('username', None)
         builder.require_string_value('host')
         builder.require_string_value('base_dn')
         options = builder.get_options()
+        if options['connection_pool_size'] < 1:
+            raise AssertionException("'connection_pool_size' must be at least 1")
+        if options['group_lookup_batch_size'] < 1:
+            raise AssertionException("'group_lookup_batch_size' must be at least 1")
+        options['additional_hosts'] = [six.text_type(host) for host in options['additional_hosts']]
+        if options['scan_partition_attribute'] and options['scan_partition_filters']:
+            raise AssertionException("Cannot define both 'scan_partition_attribute' and 'scan_partition_filters' "
+                                     "in config")
+        options['scan_partition_filters'] = [six.text_type(f) if six.text_type(f).startswith('(')
+                                             else six.text_type('(%s)') % f
+                                             for f in options['scan_partition_filters']]
+
+        if options['incremental_sync'] is not None:
+            inc_config = caller_config.get_dict_config('incremental_sync', True)
+            inc_builder = user_sync.config.OptionsBuilder(inc_config)
+            inc_builder.require_string_value('snapshot_file')
+            inc_builder.set_string_value('change_attribute', None)
+            inc_builder.set_int_value('full_sync_interval', 24)
+            options['incremental_sync'] = inc_builder.get_options()
+            change_attribute = options['incremental_sync']['change_attribute']
+            if change_attribute is not None and change_attribute not in CHANGE_ATTRIBUTES:
+                raise AssertionException("'change_attribute' in 'incremental_sync' must be one of: %s" %
+                                         ', '.join(CHANGE_ATTRIBUTES))
+
+        if options['member_of_lookup'] and options['incremental_sync'] is not None:
+            # a change of group membership doesn't change the member entries, so memberOf can't be tracked
+            raise AssertionException("Cannot use both 'incremental_sync' and 'member_of_lookup' in config")
+        if options['member_of_lookup'] and options['group_member_filter_format'] not in (None, DEFAULT_MEMBER_FILTER):
+            # group membership is read from the users' entries, so a custom member filter would be ignored
+            raise AssertionException(
+                "Cannot define both 'group_member_filter_format' and 'member_of_lookup' in config")
 
         options['two_steps_enabled'] = False
         if options['two_steps_lookup'] is not None:
@@ -172,17 +268,35 @@ class LDAPDirectoryConnector(object):
             ts_builder = user_sync.config.OptionsBuilder(ts_config)
             ts_builder.require_string_value('group_member_attribute_name')
             ts_builder.set_bool_value('nested_group', False)
+            ts_builder.set_int_value('member_batch_size', 100)
             options['two_steps_enabled'] = True
             options['two_steps_lookup'] = ts_builder.get_options()
+            if options['two_steps_lookup']['member_batch_size'] < 1:
+                raise AssertionException("'member_batch_size' in 'two_steps_lookup' must be at least 1")
             if options['group_member_filter_format']:
                 raise AssertionException(
                     "Cannot define both 'group_member_attribute_name' and 'group_member_filter_format' in config")
+            if options['member_of_lookup']:
+                raise AssertionException("Cannot use both 'two_steps_lookup' and 'member_of_lookup' in config")
         else:
             if not options['group_member_filter_format']:
-                options['group_member_filter_format'] = six.text_type('(memberOf={group_dn})')
+                options['group_member_filter_format'] = DEFAULT_MEMBER_FILTER
         return options
 
     def load_users_and_groups(self, groups, extended_attributes, all_users):
+        """
+        Load the users, then stop the worker threads and unbind their connections
+        :type groups: list(str)
+        :type extended_attributes: list(str)
+        :type all_users: bool
+        :rtype iterable(dict)
+        """
+        try:
+            return self.load_directory_users(groups, extended_attributes, all_users)
+        finally:
+            self.close_pool()
+
+    def load_directory_users(self, groups, extended_attributes, all_users):
         """
         :type groups: list(str)
         :type extended_attributes: list(str)
@@ -193,84 +307,625 @@ class LDAPDirectoryConnector(object):
         user = {}
         base_dn = six.text_type(options['base_dn'])
         all_users_filter = six.text_type(options['all_users_filter'])
-        group_member_filter_format = six.text_type(options['group_member_filter_format'])
         grouped_user_records = {}
         if options['two_steps_enabled']:
             group_member_attribute_name = six.text_type(options['two_steps_lookup']['group_member_attribute_name'])
 
-        # save all the users to memory for faster 2-steps lookup or all_users process
-        if all_users:
+        if options['member_of_lookup']:
+            return self.load_users_by_member_of(groups, extended_attributes, all_users)
+
+        # when all users are requested, a single scan loads every user record up front.  The group searches
+        # that follow then only need the DNs of their members, which are matched against the loaded users.
+        # In incremental mode, all the users are always loaded (from the snapshot and the changes since).
+        users_loaded = all_users or options['incremental_sync'] is not None
+        if options['incremental_sync'] is not None:
+            if self.additional_group_filters:
+                # a change of group membership doesn't change the member entries (as with member_of_lookup), so
+                # the groups that dynamic mappings read from them would stay as they were in the snapshot
+                raise AssertionException("Cannot use both 'incremental_sync' and dynamic group mappings "
+                                         "('additional_groups') in config")
+            usage = self.get_search_usage()
+            self.load_incremental_users(extended_attributes)
+            self.log_search_usage('incremental users', usage)
+        elif all_users:
+            usage = self.get_search_usage()
             try:
-                all_users_records = dict(self.iter_users(base_dn, all_users_filter, extended_attributes))
+                for _ in self.iter_users(base_dn, all_users_filter, extended_attributes):
+                    pass
             except Exception as e:
                 raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
+            self.log_search_usage('all users', usage)
 
         # for each group that's required, do one search for the users of that group
-        for group in groups:
-            group_users = 0
-            group_dn = self.find_ldap_group_dn(group)
+        usage = self.get_search_usage()
+        self.find_ldap_group_dns(groups)
+        user_attribute_names, extended_attributes = self.get_user_attribute_names(extended_attributes)
+        for group, group_dn, records in self.iter_group_searches(groups, users_loaded, user_attribute_names):
             if not group_dn:
                 self.logger.warning("No group found for: %s", group)
                 continue
-            group_member_subfilter = self.format_ldap_query_string(group_member_filter_format, group_dn=group_dn)
-            if not group_member_subfilter.startswith('('):
-                group_member_subfilter = six.text_type('(') + group_member_subfilter + six.text_type(')')
-            user_subfilter = all_users_filter
-            if not user_subfilter.startswith('('):
-                user_subfilter = six.text_type('(') + user_subfilter + six.text_type(')')
-            group_user_filter = six.text_type('(&') + group_member_subfilter + user_subfilter + six.text_type(')')
             group_users = 0
             try:
                 if options['two_steps_enabled']:
-                    for user_dn in self.iter_group_member_dns(group_dn, group_member_attribute_name):
-                        # check to make sure user_dn are within the base_dn scope
-                        if self.is_dn_within_base_dn_scope(base_dn, user_dn):
-                            # replace base_dn with user_dn and filter with all_users_filter to do user lookup based on DN
-                            result = list(self.iter_users(user_dn, all_users_filter, extended_attributes))
-                            if result:
-                                # iter_users should only return 1 user when doing two_steps lookup.
-                                if len(result) > 1:
-                                    raise AssertionException(
-                                        "Unexpected multiple LDAP object found in 'two_steps_lookup' mode for: %s" % user_dn)
-                                else:
-                                    user = result[0][1]
-                                    user['groups'].append(group)
-                                    group_users += 1
-                                    grouped_user_records[user_dn] = user
+                    # only DNs within the base_dn scope can be users
+                    member_dns = (dn for dn in self.iter_group_member_dns(group_dn, group_member_attribute_name,
+                                                                          None if users_loaded else extended_attributes)
+                                  if self.is_dn_within_base_dn_scope(base_dn, dn))
+                    group_user_iter = self.iter_users_by_dn(member_dns, extended_attributes,
+                                                            search_missing=not users_loaded)
+                elif users_loaded:
+                    # the all users scan may have skipped some of the entries (e.g. those without email)
+                    group_user_iter = ((dn, self.user_by_dn[dn]) for dn, _ in records if dn in self.user_by_dn)
                 else:
-                    for user_dn, user in self.iter_users(base_dn, group_user_filter, extended_attributes):
-                        user['groups'].append(group)
-                        group_users += 1
-                        grouped_user_records[user_dn] = user
+                    group_user_iter = self.iter_converted_users(records, extended_attributes)
+                for user_dn, user in group_user_iter:
+                    user.add_group(group)
+                    group_users += 1
+                    grouped_user_records[user_dn] = user
             except Exception as e:
                 raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
             self.logger.debug('Count of users in group "%s": %d', group, group_users)
+        if groups:
+            self.log_search_usage('group members', usage)
 
-        # if all users are requested, do an additional search for all of them
-        if all_users:
-            ungrouped_users = 0
-            grouped_users = 0
-            try:
-                for user_dn, user in self.iter_users(base_dn, all_users_filter, extended_attributes):
-                    if not user['groups']:
-                        ungrouped_users += 1
-                    else:
-                        grouped_users += 1
-                if groups:
-                    self.logger.debug('Count of users in any groups: %d', grouped_users)
-                    self.logger.debug('Count of users not in any groups: %d', ungrouped_users)
-            except Exception as e:
-                raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
+        if all_users and groups:
+            grouped_users = len(grouped_user_records)
+            self.logger.debug('Count of users in any groups: %d', grouped_users)
+            self.logger.debug('Count of users not in any groups: %d', len(self.user_by_dn) - grouped_users)
+
+        self.log_dn_cache_usage()
+        if not all_users and users_loaded:
+            # only the group members were asked for
+            self.logger.debug('Total users loaded: %d', len(grouped_user_records))
+            return six.itervalues(grouped_user_records)
+        self.logger.debug('Total users loaded: %d', len(self.user_by_dn))
+        return six.itervalues(self.user_by_dn)
+
+    def load_users_by_member_of(self, groups, extended_attributes, all_users):
+        """
+        Load users and their group membership with a single search.  The DN of each mapped group is found first,
+        then the groups of each user are taken from its memberOf values (or the dynamic_group_member_attribute).
+        Without all_users, the search only returns users that are a member of at least one of the groups.
+        :type groups: list(str)
+        :type extended_attributes: list(str)
+        :type all_users: bool
+        :rtype iterable(dict)
+        """
+        self.member_of_groups = {}
+        group_filters = []
+        member_of_attribute = self.get_member_of_attribute()
+        usage = self.get_search_usage()
+        self.find_ldap_group_dns(groups)
+        for group in groups:
+            group_dn = self.find_ldap_group_dn(group)
+            if not group_dn:
+                self.logger.warning("No group found for: %s", group)
+                continue
+            self.member_of_groups.setdefault(self.normalize_dn(group_dn), []).append(group)
+            group_filters.append(self.format_ldap_query_string(
+                six.text_type('(%s={group_dn})') % member_of_attribute, group_dn=group_dn))
+        self.log_search_usage('group DNs', usage)
+
+        users_filter = six.text_type(self.options['all_users_filter'])
+        if not users_filter.startswith('('):
+            users_filter = six.text_type('(') + users_filter + six.text_type(')')
+        if not all_users:
+            if not group_filters:
+                return six.itervalues(self.user_by_dn)
+            users_filter = six.text_type('(&%s(|%s))') % (users_filter, six.text_type('').join(group_filters))
+
+        usage = self.get_search_usage()
+        try:
+            for _ in self.iter_users(six.text_type(self.options['base_dn']), users_filter, extended_attributes):
+                pass
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading users: %s' % e)
+        self.log_search_usage('users', usage)
 
+        group_users = dict((group, 0) for group in groups)
+        grouped_users = 0
+        for user in six.itervalues(self.user_by_dn):
+            for group in user['groups']:
+                group_users[group] += 1
+            if user['groups']:
+                grouped_users += 1
+        for group in groups:
+            self.logger.debug('Count of users in group "%s": %d', group, group_users[group])
+        if all_users and groups:
+            self.logger.debug('Count of users in any groups: %d', grouped_users)
+            self.logger.debug('Count of users not in any groups: %d', len(self.user_by_dn) - grouped_users)
+        self.log_dn_cache_usage()
         self.logger.debug('Total users loaded: %d', len(self.user_by_dn))
         return six.itervalues(self.user_by_dn)
 
-    def find_ldap_group_dn(self, group):
+    def get_member_of_attribute(self):
+        """
+        :rtype str
+        """
+        return six.text_type(self.options['dynamic_group_member_attribute'] or 'memberOf')
+
+    def get_member_of_groups(self, record):
+        """
+        Return the mapped groups a user is a member of, according to its memberOf values.  There are few distinct
+        memberOf values across all users, so the group names for each value are cached.
+        :type record: dict
+        :rtype list(str)
+        """
+        group_dns = LDAPValueFormatter.get_attribute_value(record, self.get_member_of_attribute())
+        if not group_dns:
+            return []
+        if isinstance(group_dns, six.string_types):
+            group_dns = [group_dns]
+        groups = []
+        for group_dn in group_dns:
+            group_names = self.member_of_cache.get(group_dn)
+            if group_names is None:
+                group_names = self.member_of_cache[group_dn] = \
+                    self.member_of_groups.get(self.normalize_dn(group_dn), [])
+            for group in group_names:
+                if group not in groups:
+                    groups.append(group)
+        return groups
+
+    def load_incremental_users(self, extended_attributes):
+        """
+        Load all users into user_by_dn from the snapshot of the previous run, updated with the entries that changed
+        since then.  Changes are found with a high-water mark: the highest update sequence number of the server
+        (uSNChanged, Active Directory) or the latest modification time seen (modifyTimestamp).  Deleted entries
+        aren't visible to these searches, so a full sync is done every full_sync_interval hours (and whenever there
+        is no usable snapshot).  The updated snapshot is saved for the next run.
+        :type extended_attributes: list(str)
+        """
+        inc_options = self.options['incremental_sync']
+        snapshot_file = inc_options['snapshot_file']
+        fingerprint = self.get_snapshot_fingerprint(extended_attributes)
+        snapshot = user_sync.connector.snapshot.load_snapshot(snapshot_file, fingerprint, self.logger)
+        server_name = self.connection.server.name
+        now = time.time()
+        if snapshot is not None:
+            full_sync_interval = inc_options['full_sync_interval'] * 3600
+            if full_sync_interval and now - snapshot['full_sync_time'] >= full_sync_interval:
+                self.logger.info('Doing a full sync: the last one was more than %d hours ago',
+                                 inc_options['full_sync_interval'])
+                snapshot = None
+            elif snapshot['change_attribute'] == USN_CHANGED and snapshot['server'] != server_name:
+                # update sequence numbers are specific to each server
+                self.logger.info('Doing a full sync: the last sync was done with server %s', snapshot['server'])
+                snapshot = None
+
+        change_attribute = snapshot['change_attribute'] if snapshot else self.get_change_attribute()
+        high_water_mark = None
+        if change_attribute == USN_CHANGED:
+            # read before searching, so that changes made during the search are picked up next time
+            high_water_mark = self.get_highest_usn()
+            # update sequence numbers are specific to each server, so the partitions of the scan are searched
+            # on the server the mark was read from, rather than on any server of the pool
+            self.worker_server = self.connection.server
+        all_users_filter = self.options['all_users_filter']
+        if not all_users_filter.startswith('('):
+            all_users_filter = six.text_type('(') + all_users_filter + six.text_type(')')
+        try:
+            if snapshot is None:
+                users, _, latest_change = self.scan_users(all_users_filter, extended_attributes, change_attribute,
+                                                          partitioned=True)
+                full_sync_time = now
+                self.logger.info('Full sync loaded %d users', len(users))
+            else:
+                if change_attribute == USN_CHANGED:
+                    change_filter = six.text_type('(%s>=%d)') % (USN_CHANGED, snapshot['high_water_mark'] + 1)
+                else:
+                    change_filter = six.text_type('(%s>=%s)') % (MODIFY_TIMESTAMP, snapshot['high_water_mark'])
+                users = dict((dn, user_sync.connector.helper.DirectoryUser(user))
+                             for dn, user in six.iteritems(snapshot['users']))
+                changed_users, rejected_dns, latest_change = self.scan_users(
+                    six.text_type('(&%s%s)') % (all_users_filter, change_filter), extended_attributes,
+                    change_attribute)
+                # entries that changed and no longer match the all users filter (such as disabled accounts)
+                removed_dns = list(rejected_dns)
+                result_iter = self.iter_search_result(six.text_type(self.options['base_dn']), ldap3.SUBTREE,
+                                                      six.text_type('(&(!%s)%s)') % (all_users_filter, change_filter),
+                                                      [six.text_type(change_attribute)])
+                for dn, record in result_iter:
+                    if dn is not None:
+                        removed_dns.append(dn)
+                        latest_change = self.get_latest_change(latest_change, record, change_attribute)
+                removed_users = 0
+                for dn in removed_dns:
+                    if users.pop(dn, None) is not None:
+                        removed_users += 1
+                users.update(changed_users)
+                full_sync_time = snapshot['full_sync_time']
+                self.logger.info('Incremental sync: %d users changed, %d users removed, %d users in total',
+                                 len(changed_users), removed_users, len(users))
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
+
+        if change_attribute == MODIFY_TIMESTAMP:
+            high_water_mark = latest_change
+            if snapshot is not None and (high_water_mark is None or high_water_mark < snapshot['high_water_mark']):
+                high_water_mark = snapshot['high_water_mark']
+        if high_water_mark is None:
+            self.logger.warning('No %s value found; the next sync will be a full sync', change_attribute)
+            full_sync_time = 0
+            high_water_mark = 0 if change_attribute == USN_CHANGED else ''
+
+        self.user_by_dn = users
+        user_sync.connector.snapshot.save_snapshot(snapshot_file, fingerprint, {
+            'change_attribute': change_attribute,
+            'server': server_name,
+            'high_water_mark': high_water_mark,
+            'full_sync_time': full_sync_time,
+            'users': users,
+        })
+
+    def scan_users(self, users_filter, extended_attributes, change_attribute, partitioned=False):
+        """
+        Search for users, also reading their change attribute.  Returns the users by DN, the DNs of entries that
+        matched but couldn't be used as users, and the latest modification timestamp seen (if that's the change
+        attribute).  With partitioned, the search is split into the configured scan partitions.
+        :type users_filter: str
+        :type extended_attributes: list(str)
+        :type change_attribute: str
+        :type partitioned: bool
+        :rtype (dict(str, dict), list(str), str)
+        """
+        user_attribute_names, extended_attributes = self.get_user_attribute_names(extended_attributes)
+        user_attribute_names.append(six.text_type(change_attribute))
+        users = {}
+        rejected_dns = []
+        latest_change = None
+        base_dn = six.text_type(self.options['base_dn'])
+        if partitioned:
+            result_iter = self.iter_user_search(base_dn, users_filter, user_attribute_names)
+        else:
+            result_iter = self.iter_search_result(base_dn, ldap3.SUBTREE, users_filter, user_attribute_names)
+        for dn, record in result_iter:
+            if dn is None:
+                continue
+            latest_change = self.get_latest_change(latest_change, record, change_attribute)
+            user = self.convert_user(dn, record, extended_attributes)
+            if user is None:
+                rejected_dns.append(dn)
+            else:
+                users[dn] = user
+        return users, rejected_dns, latest_change
+
+    @staticmethod
+    def get_latest_change(latest_change, record, change_attribute):
+        """
+        Return the later of latest_change and the modification timestamp of the record, as a generalized time
+        string (YYYYmmddHHMMSSZ, in UTC, which sorts in time order).  Only used for the modifyTimestamp attribute.
+        :type latest_change: str
+        :type record: dict
+        :type change_attribute: str
+        :rtype str
+        """
+        if change_attribute != MODIFY_TIMESTAMP:
+            return latest_change
+        value = LDAPValueFormatter.get_attribute_value(record, change_attribute, first_only=True)
+        if value is None:
+            return latest_change
+        if hasattr(value, 'strftime'):
+            if value.tzinfo is not None:
+                value = value.astimezone(user_sync.connector.snapshot.UTC)
+            value = value.strftime('%Y%m%d%H%M%SZ')
+        else:
+            value = six.text_type(value)[:14] + 'Z'
+        if latest_change is None or value > latest_change:
+            return value
+        return latest_change
+
+    def get_change_attribute(self):
+        """
+        The configured change attribute, or uSNChanged if the server has update sequence numbers (Active
+        Directory does), and modifyTimestamp if not.
+        :rtype str
+        """
+        change_attribute = self.options['incremental_sync']['change_attribute']
+        if change_attribute is None:
+            change_attribute = USN_CHANGED if self.get_highest_usn() is not None else MODIFY_TIMESTAMP
+            self.logger.debug('Using %s to find changed entries', change_attribute)
+        return change_attribute
+
+    def get_highest_usn(self):
+        """
+        Read the highest update sequence number committed by the server from its root DSE.  Returns None if
+        the server doesn't have one.
+        :rtype int
+        """
+        try:
+            self.connection.search(six.text_type(''), six.text_type('(objectClass=*)'), ldap3.BASE,
+                                   attributes=[six.text_type('highestCommittedUSN')])
+            if not self.connection.entries:
+                return None
+            record = self.connection.entries[0].entry_attributes_as_dict
+            value = LDAPValueFormatter.get_attribute_value(record, 'highestCommittedUSN', first_only=True)
+            return int(value) if value is not None else None
+        except Exception as e:
+            self.logger.debug('Unable to read highestCommittedUSN: %s', e)
+            return None
+
+    def get_snapshot_fingerprint(self, extended_attributes):
+        """
+        :type extended_attributes: list(str)
+        :rtype str
+        """
+        options = self.options
+        values = {key: options[key] for key in ('base_dn', 'all_users_filter', 'string_encoding',
+                                                'user_identity_type', 'user_identity_type_format',
+                                                'user_email_format', 'user_username_format', 'user_domain_format',
+                                                'user_given_name_format', 'user_surname_format',
+                                                'user_country_code_format', 'dynamic_group_member_attribute',
+                                                'dynamic_group_base_dn')}
+        values['change_attribute'] = options['incremental_sync']['change_attribute']
+        values['extended_attributes'] = sorted(six.text_type(attr) for attr in extended_attributes)
+        return user_sync.connector.snapshot.options_fingerprint(values)
+
+    def iter_group_searches(self, groups, all_users, user_attribute_names):
+        """
+        Find the DN of each group and search for its members.  When connection_pool_size is more than 1, the
+        searches for different groups run concurrently, each on its own connection.  Either way the results are
+        returned in the order of the groups, so the users are always merged in the same order.
+        In two-step mode only the group DN is looked up here; in all users mode only the member DNs are fetched.
+        :type groups: list(str)
+        :type all_users: bool
+        :type user_attribute_names: list(str)
+        :rtype iterable(str, str, iterable(list))
+        """
+        def search_group(group):
+            connection = self.get_thread_connection()
+            group_dn = self.find_ldap_group_dn(group, connection)
+            if not group_dn or self.options['two_steps_enabled']:
+                return group, group_dn, None
+            group_user_filter = self.format_group_user_filter(group_dn)
+            attributes = [six.text_type('1.1')] if all_users else user_attribute_names
+            try:
+                records = self.iter_search_result(six.text_type(self.options['base_dn']), ldap3.SUBTREE,
+                                                  group_user_filter, attributes, connection)
+                if pooled:
+                    records = list(records)
+            except Exception as e:
+                raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
+            return group, group_dn, records
+
+        pool_size = min(self.options['connection_pool_size'], len(groups))
+        pooled = pool_size > 1
+        if not pooled:
+            for group in groups:
+                yield search_group(group)
+            return
+        self.logger.debug('Searching %d groups over %d connections', len(groups), pool_size)
+        for result in self.get_executor().map(search_group, groups):
+            yield result
+
+    def load_server_schema(self):
+        """
+        Attach the schema of the server, which ldap3 uses to convert attribute values (such as timestamps and
+        GUIDs) to Python types.  Servers are defined without reading their info and schema on bind, so that
+        setting up the connector, extra connections and reconnects only bind; instead the schema is attached
+        here, once, before the first search for user attributes.  It is read from the schema_cache_file when that
+        was saved less than schema_cache_ttl hours ago, and otherwise read from the server (and saved to the
+        schema_cache_file, if set).
+        """
+        self.schema_loaded = True
+        options = self.options
+        cache_file = options['schema_cache_file']
+        fingerprint = user_sync.connector.snapshot.options_fingerprint({'host': options['host']})
+        now = time.time()
+        schema = None
+        if cache_file:
+            snapshot = user_sync.connector.snapshot.load_snapshot(cache_file, fingerprint, self.logger)
+            if snapshot is not None and now - snapshot['time'] < options['schema_cache_ttl'] * 3600:
+                try:
+                    schema = ldap3.protocol.rfc4512.SchemaInfo.from_json(snapshot['schema'])
+                except Exception as e:
+                    self.logger.warning('Unable to read the cached schema from %s: %s', cache_file, e)
+        if schema is None:
+            schema = self.read_server_schema()
+            if schema is None:
+                self.logger.debug('No schema read from the server')
+                return
+            if cache_file:
+                user_sync.connector.snapshot.save_snapshot(cache_file, fingerprint,
+                                                           {'time': now, 'schema': schema.to_json()})
+        servers = self.server.servers if isinstance(self.server, ldap3.ServerPool) else [self.server]
+        for server in servers:
+            server.attach_schema_info(schema)
+
+    def read_server_schema(self):
+        """
+        Read the schema from the server of the main connection
+        :rtype ldap3.protocol.rfc4512.SchemaInfo
+        """
+        server = self.connection.server
+        server.get_info = ldap3.SCHEMA
+        try:
+            self.connection.refresh_server_info()
+        except Exception as e:
+            self.logger.warning('Unable to read the server schema: %s', e)
+        finally:
+            server.get_info = ldap3.NONE
+        return server.schema
+
+    def create_connection(self, server=None):
+        """
+        Open and bind a new connection to the LDAP server (or the next server of the pool)
+        :type server: ldap3.Server # a server of the pool to connect to, instead of the next one
+        :rtype ldap3.Connection
+        """
+        connection = self.connection_class(server or self.server, auto_bind=self.auto_bind, read_only=True,
+                                           collect_usage=True, **self.auth)
+        with self.stats_lock:
+            self.connections.append(connection)
+        return connection
+
+    def get_thread_connection(self):
+        """
+        Return the connection for the current thread.  The thread that created the connector uses the main
+        connection; the worker threads of the pool each open their own (to the worker_server, if set), which they
+        keep until close_pool.
+        :rtype ldap3.Connection
+        """
+        if threading.current_thread() is self.main_thread:
+            return self.connection
+        connection = getattr(self.thread_state, 'connection', None)
+        if connection is None:
+            try:
+                connection = self.thread_state.connection = self.create_connection(self.worker_server)
+            except Exception as e:
+                raise AssertionException('LDAP connection failure: %s' % e)
+            with self.stats_lock:
+                self.worker_connections.append(connection)
+        return connection
+
+    def get_executor(self):
+        """
+        Return the pool of worker threads that run concurrent searches, at most connection_pool_size at a time.
+        It is made on first use and shared by all the searches of a load, so there is never more than one
+        connection per worker thread.
+        :rtype ThreadPoolExecutor
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.options['connection_pool_size'])
+        return self.executor
+
+    def close_pool(self):
+        """
+        Stop the worker threads and unbind their connections
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.worker_server = None
+        with self.stats_lock:
+            connections, self.worker_connections = self.worker_connections, []
+        for connection in connections:
+            try:
+                connection.unbind()
+            except Exception as e:
+                self.logger.debug('Unable to unbind LDAP connection: %s', e)
+
+    def get_search_usage(self):
+        """
+        Return the count of LDAP search round trips issued and entries received so far
+        :rtype (int, int)
+        """
+        searches = sum(c.usage.search_operations for c in self.connections if c.usage)
+        return searches, self.search_entry_count
+
+    def log_search_usage(self, phase, start_usage):
+        """
+        Log the LDAP round trips and entries used by a load phase
+        :type phase: str
+        :type start_usage: (int, int)
+        """
+        searches, entries = self.get_search_usage()
+        self.logger.debug('LDAP usage for %s: %d round trips, %d entries', phase,
+                          searches - start_usage[0], entries - start_usage[1])
+
+    def find_ldap_group_dns(self, groups):
+        """
+        Find the DNs of many groups at once, and keep them for find_ldap_group_dn.  DNs found (or not found) in
+        recent runs are read from the group_dn_cache_file (if set).  The others are found with searches that each OR together the
+        group_filter_format of group_lookup_batch_size groups, as long as the group name can be read back from
+        the results: the format must contain a (attribute={group}) clause.  Otherwise each group gets its own
+        search, as find_ldap_group_dn does.
+        :type groups: list(str)
+        """
+        groups = [group for group in groups if group not in self.group_dn_by_name]
+        if not groups:
+            return
+        options = self.options
+        cache_file = options['group_dn_cache_file']
+        now = time.time()
+        cache = {}
+        fingerprint = None
+        if cache_file:
+            fingerprint = user_sync.connector.snapshot.options_fingerprint(
+                {key: options[key] for key in ('host', 'base_dn', 'group_filter_format')})
+            snapshot = user_sync.connector.snapshot.load_snapshot(cache_file, fingerprint, self.logger)
+            if snapshot is not None:
+                ttl = options['group_dn_cache_ttl'] * 3600
+                cache = dict((group, entry) for group, entry in six.iteritems(snapshot['groups'])
+                             if now - entry['time'] < ttl)
+            for group in groups:
+                if group in cache:
+                    self.group_dn_by_name[group] = cache[group]['dn']
+            cached = len(groups)
+            groups = [group for group in groups if group not in cache]
+            self.logger.debug('Group DNs read from cache: %d', cached - len(groups))
+
+        name_attribute = self.get_group_name_attribute()
+        if name_attribute is None:
+            for group in groups:
+                self.group_dn_by_name[group] = self.find_ldap_group_dn(group)
+        else:
+            batch_size = options['group_lookup_batch_size']
+            for i in range(0, len(groups), batch_size):
+                self.search_group_dns(groups[i:i + batch_size], name_attribute)
+
+        if cache_file:
+            # groups that weren't found are cached too (with no DN), so they aren't searched for on every run
+            for group in groups:
+                cache[group] = {'dn': self.group_dn_by_name[group], 'time': now}
+            user_sync.connector.snapshot.save_snapshot(cache_file, fingerprint, {'groups': cache})
+
+    def search_group_dns(self, groups, name_attribute):
+        """
+        Find the DNs of a batch of groups with one search, then look up those it didn't match one at a time
+        :type groups: list(str)
+        :type name_attribute: str
+        """
+        group_filter_format = six.text_type(self.options['group_filter_format'])
+        groups_by_name = {}
+        for group in groups:
+            groups_by_name.setdefault(group.lower(), []).append(group)
+            self.group_dn_by_name[group] = None
+        filter_string = six.text_type('(|%s)') % six.text_type('').join(
+            self.format_ldap_query_string(group_filter_format, group=group) for group in groups)
+        try:
+            result = list(self.iter_search_result(six.text_type(self.options['base_dn']), ldap3.SUBTREE,
+                                                  filter_string, [name_attribute]))
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading group info: %s' % e)
+        for dn, record in result:
+            if dn is None:
+                continue
+            names = LDAPValueFormatter.get_attribute_value(record, name_attribute) or []
+            if isinstance(names, six.string_types):
+                names = [names]
+            for name in set(six.text_type(name).lower() for name in names):
+                for group in groups_by_name.get(name, []):
+                    if self.group_dn_by_name[group] is not None:
+                        raise AssertionException("Multiple LDAP groups found for: %s" % group)
+                    self.group_dn_by_name[group] = dn
+        # the server's matching rules can match names that compare differently here (such as names with extra
+        # spaces), so a group is only missing if a search of its own doesn't find it either
+        for group in groups:
+            if self.group_dn_by_name[group] is None:
+                del self.group_dn_by_name[group]
+                self.group_dn_by_name[group] = self.find_ldap_group_dn(group)
+
+    def get_group_name_attribute(self):
+        """
+        Return the attribute that group_filter_format matches group names against, or None if it can't be
+        told from the format
+        :rtype str
+        """
+        matches = re.findall(r'\(([\w.;-]+)=\{group\}\)', self.options['group_filter_format'])
+        if len(matches) != 1 or self.options['group_filter_format'].count('{group}') != 1:
+            return None
+        return six.text_type(matches[0])
+
+    def find_ldap_group_dn(self, group, connection=None):
         """
         :type group: str
+        :type connection: ldap3.Connection
         :rtype str
         """
-        connection = self.connection
+        if group in self.group_dn_by_name:
+            return self.group_dn_by_name[group]
+        connection = connection or self.connection
         options = self.options
         base_dn = six.text_type(options['base_dn'])
         group_filter_format = six.text_type(options['group_filter_format'])
@@ -289,143 +944,409 @@ class LDAPDirectoryConnector(object):
                     group_dn = result[0].entry_dn
         return group_dn
 
-    def iter_group_member_dns(self, group_dn, member_attribute, searched_dns=None):
+    def iter_group_member_dns(self, group_dn, member_attribute, extended_attributes=None):
         """
-        return group memberships dns from specified membership attribute in LDAP group object
-        :type group: str
+        return group memberships dns from specified membership attribute in LDAP group object.  If nested group
+        search is enabled, the members of nested groups are returned (before the nested group itself).  Given
+        extended_attributes (when the users aren't all loaded), the members that are users are then loaded with
+        batched searches, so only the members that aren't users need a search of their own.
+        :type group_dn: str
         :type member_attribute: str
+        :type extended_attributes: list(str)
         :rtype iterable(str)
         """
-        if searched_dns is None:
-            searched_dns = []
-        connection = self.connection
-        nested_group_search = self.options['two_steps_lookup']['nested_group']
+        if self.options['two_steps_lookup']['nested_group']:
+            members = self.get_nested_member_dns(group_dn, member_attribute, {}, extended_attributes)[0]
+        else:
+            members = self.get_direct_member_dns(group_dn, member_attribute)
+        seen = set()
+        for key, member_dn in members:
+            if key not in seen:
+                seen.add(key)
+                yield member_dn
+
+    def get_direct_member_dns(self, group_dn, member_attribute):
+        """
+        Read the member attribute of a group.  Results are cached for the run, so a group that is nested in
+        several mapped groups is only read once.  Objects that aren't groups (such as users) have no members.
+        :type group_dn: str
+        :type member_attribute: str
+        :rtype list(tuple(str, str))
+        """
+        key = self.normalize_dn(group_dn)
+        members = self.direct_members_by_dn.get(key)
+        if members is not None:
+            return members
+        members = []
+        if self.user_dn_index is not None and key in self.user_dn_index:
+            # a known user, not a group
+            self.direct_members_by_dn[key] = members
+            return members
         try:
-            connection.search(search_base=group_dn, search_filter='(objectClass=*)', search_scope=ldap3.SUBTREE,
-                              attributes=member_attribute)
-            result = connection.entries
-            if result is not None:
+            self.connection.search(search_base=group_dn, search_filter='(objectClass=*)', search_scope=ldap3.BASE,
+                                   attributes=member_attribute)
+            result = self.connection.entries
+            if result:
                 record = result[0].entry_attributes_as_dict
                 member_dns = LDAPValueFormatter.get_attribute_value(record, member_attribute)
-                for member_dn in member_dns or []:
-                    # if nested_group search enabled, look up DN and see if group member attribute exist in that object
-                    # This will recurse through until there is no nested group.
-                    if member_dn not in searched_dns:
-                        searched_dns.append(member_dn)
-                        if nested_group_search:
-                            nested_members = self.iter_group_member_dns(member_dn, member_attribute, searched_dns)
-                            for nested_member_dn in nested_members:
-                                yield nested_member_dn
-                        yield member_dn
+                if isinstance(member_dns, six.string_types):
+                    member_dns = [member_dns]
+                members = [(self.normalize_dn(member_dn), member_dn) for member_dn in member_dns or []]
         except Exception as e:
             self.logger.warning('Error lookup %s : %s', group_dn, e)
-            pass
+        self.direct_members_by_dn[key] = members
+        return members
+
+    def get_nested_member_dns(self, group_dn, member_attribute, path, extended_attributes=None):
+        """
+        Expand the membership of a group through all of its nested groups.  The expansion of each group is
+        cached once it is complete, and shared by every mapped group that contains it.  path maps the groups
+        being expanded to their nesting depth, and is used to detect membership cycles.  A group inside a cycle
+        can't be fully expanded until the expansion returns to the group where the cycle starts, so only that
+        group's expansion is cached.  Returns the members and the depth of the outermost group the expansion
+        cycled back to (None if there was no cycle).
+        :type group_dn: str
+        :type member_attribute: str
+        :type path: dict(str, int)
+        :type extended_attributes: list(str) # if set, load the members that are users, see iter_group_member_dns
+        :rtype (list(tuple(str, str)), int)
+        """
+        key = self.normalize_dn(group_dn)
+        members = self.nested_members_by_dn.get(key)
+        if members is not None:
+            return members, None
+        depth = len(path)
+        path[key] = depth
+        members = []
+        seen = set()
+        cycle_depth = None
+        direct_members = self.get_direct_member_dns(group_dn, member_attribute)
+        if extended_attributes is not None:
+            # once the users among the members are known, get_direct_member_dns doesn't search for their members
+            unknown_dns = (member_dn for member_key, member_dn in direct_members
+                           if member_key not in self.direct_members_by_dn and member_key not in path)
+            for _ in self.iter_users_by_dn(unknown_dns, extended_attributes):
+                pass
+        for member_key, member_dn in direct_members:
+            if member_key in path:
+                self.logger.warning('Nested group cycle: %s is a member of %s, which is one of its own members',
+                                    member_dn, group_dn)
+                if cycle_depth is None or path[member_key] < cycle_depth:
+                    cycle_depth = path[member_key]
+                continue
+            if member_key in seen:
+                continue
+            nested_members, nested_cycle_depth = self.get_nested_member_dns(member_dn, member_attribute, path,
+                                                                            extended_attributes)
+            if nested_cycle_depth is not None and (cycle_depth is None or nested_cycle_depth < cycle_depth):
+                cycle_depth = nested_cycle_depth
+            for nested_member in nested_members:
+                if nested_member[0] not in seen:
+                    seen.add(nested_member[0])
+                    members.append(nested_member)
+            if member_key not in seen:
+                seen.add(member_key)
+                members.append((member_key, member_dn))
+        del path[key]
+        if cycle_depth is not None and cycle_depth >= depth:
+            cycle_depth = None
+        if cycle_depth is None:
+            self.nested_members_by_dn[key] = members
+        return members, cycle_depth
+
+    def get_user_attribute_names(self, extended_attributes):
+        """
+        Return the attributes to fetch for each user, and the extended attributes that are not already among them
+        :type extended_attributes: list(str)
+        :rtype (list(str), list(str))
+        """
+        if not self.schema_loaded:
+            # the attribute values are about to be read, and the schema tells how to convert them
+            schema_start = time.time()
+            self.load_server_schema()
+            self.logger.debug('Server schema loaded in %.2fs', time.time() - schema_start)
+        cache_key = tuple(extended_attributes)
+        cached = self.user_attribute_names_cache.get(cache_key)
+        if cached is None:
+            dynamic_group_member_attribute = self.options['dynamic_group_member_attribute']
+
+            user_attribute_names = []
+            user_attribute_names.extend(self.user_given_name_formatter.get_attribute_names())
+            user_attribute_names.extend(self.user_surname_formatter.get_attribute_names())
+            user_attribute_names.extend(self.user_country_code_formatter.get_attribute_names())
+            user_attribute_names.extend(self.user_identity_type_formatter.get_attribute_names())
+            user_attribute_names.extend(self.user_email_formatter.get_attribute_names())
+            user_attribute_names.extend(self.user_username_formatter.get_attribute_names())
+            user_attribute_names.extend(self.user_domain_formatter.get_attribute_names())
+            if dynamic_group_member_attribute is not None:
+                user_attribute_names.append(six.text_type(dynamic_group_member_attribute))
+            elif self.options['member_of_lookup']:
+                user_attribute_names.append(self.get_member_of_attribute())
+
+            extended_attributes = [six.text_type(attr) for attr in extended_attributes]
+            extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
+            user_attribute_names.extend(extended_attributes)
+            cached = self.user_attribute_names_cache[cache_key] = (user_attribute_names, extended_attributes)
+        # copies, so callers can add to them
+        return list(cached[0]), list(cached[1])
 
     def iter_users(self, base_dn, users_filter, extended_attributes):
-        options = self.options
-        dynamic_group_member_attribute = options['dynamic_group_member_attribute']
-
-        user_attribute_names = []
-        user_attribute_names.extend(self.user_given_name_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_surname_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_country_code_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_identity_type_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_email_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_username_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_domain_formatter.get_attribute_names())
-        if dynamic_group_member_attribute is not None:
-            user_attribute_names.append(six.text_type(dynamic_group_member_attribute))
-
-        extended_attributes = [six.text_type(attr) for attr in extended_attributes]
-        extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
-        user_attribute_names.extend(extended_attributes)
-
-        result_iter = self.iter_search_result(base_dn, ldap3.SUBTREE, users_filter, user_attribute_names)
+        user_attribute_names, extended_attributes = self.get_user_attribute_names(extended_attributes)
+        result_iter = self.iter_user_search(base_dn, users_filter, user_attribute_names)
+        return self.iter_converted_users(result_iter, extended_attributes)
+
+    def get_scan_partitions(self):
+        """
+        Return the filters that split a user scan into partitions, or None if scans aren't partitioned.  The
+        partitions are either the configured scan_partition_filters, or one for each first character (a-z, 0-9)
+        of the scan_partition_attribute.  A last partition matches whatever the others don't, so no user is
+        missed even if the partitions don't cover the whole directory.
+        :rtype list(str)
+        """
+        partition_filters = self.options['scan_partition_filters']
+        partition_attribute = self.options['scan_partition_attribute']
+        if partition_attribute:
+            partition_filters = [six.text_type('(%s=%s*)') % (partition_attribute, prefix)
+                                 for prefix in SCAN_PARTITION_PREFIXES]
+        if not partition_filters:
+            return None
+        remainder = six.text_type('(&%s)') % six.text_type('').join(six.text_type('(!%s)') % partition_filter
+                                                                 for partition_filter in partition_filters)
+        return partition_filters + [remainder]
+
+    def iter_user_search(self, base_dn, users_filter, attributes):
+        """
+        Search for users.  If scan partitions are configured, the search is split into one search per partition,
+        and when connection_pool_size is more than 1 the partitions are paged through concurrently, each on its
+        own connection.  The results are returned in partition order, and entries matched by more than one
+        partition are only returned once.
+        :type base_dn: str
+        :type users_filter: str
+        :type attributes: list(str)
+        :rtype iterable(list)
+        """
+        partitions = self.get_scan_partitions()
+        if not partitions:
+            for result in self.iter_search_result(base_dn, ldap3.SUBTREE, users_filter, attributes):
+                yield result
+            return
+        if not users_filter.startswith('('):
+            users_filter = six.text_type('(') + users_filter + six.text_type(')')
+        partition_user_filters = [six.text_type('(&%s%s)') % (users_filter, partition) for partition in partitions]
+
+        def search_partition(partition_filter):
+            connection = self.get_thread_connection()
+            return list(self.iter_search_result(base_dn, ldap3.SUBTREE, partition_filter, attributes, connection))
+
+        pool_size = min(self.options['connection_pool_size'], len(partitions))
+        self.logger.debug('Searching users in %d partitions over %d connections', len(partitions), pool_size)
+        seen_dns = set()
+        if pool_size > 1:
+            futures = [self.get_executor().submit(search_partition, partition_filter)
+                       for partition_filter in partition_user_filters]
+            results_iter = (future.result() for future in futures)
+        else:
+            futures = []
+            results_iter = (self.iter_search_result(base_dn, ldap3.SUBTREE, partition_filter, attributes)
+                            for partition_filter in partition_user_filters)
+        try:
+            for results in results_iter:
+                for dn, record in results:
+                    if dn is None or dn in seen_dns:
+                        continue
+                    seen_dns.add(dn)
+                    yield [dn, record]
+        finally:
+            # the pool outlives the scan, so the partitions not searched yet are dropped here
+            for future in futures:
+                future.cancel()
+
+    def iter_converted_users(self, result_iter, extended_attributes):
+        """
+        Convert search results to users, adding them to user_by_dn.  Users that are already known are reused.
+        :type result_iter: iterable(list)
+        :type extended_attributes: list(str)
+        :rtype iterable(str, dict)
+        """
         for dn, record in result_iter:
             if dn is None:
                 continue
             if dn in self.user_by_dn:
                 yield (dn, self.user_by_dn[dn])
                 continue
-
-            email, last_attribute_name = self.user_email_formatter.generate_value(record)
-            email = email.strip() if email else None
-            if not email:
-                if last_attribute_name is not None:
-                    self.logger.warning('Skipping user with dn %s: empty email attribute (%s)', dn, last_attribute_name)
+            user = self.convert_user(dn, record, extended_attributes)
+            if user is None:
                 continue
+            self.add_user(dn, user)
+            yield (dn, user)
 
-            source_attributes = {}
-
-            user = user_sync.connector.helper.create_blank_user()
-            source_attributes['email'] = email
-            user['email'] = email
+    def iter_users_by_dn(self, user_dns, extended_attributes, search_missing=True):
+        """
+        Look up the users with the given distinguished names.  DNs of users that are already loaded are answered
+        from memory; the rest are looked up with searches that each match a batch of DNs at once (an OR of their
+        RDNs, and-ed with the all_users_filter).  Set search_missing to False when all users have already been
+        loaded, so that a DN which isn't known is taken to be a non-user (e.g. a group or a filtered-out account).
+        :type user_dns: iterable(str)
+        :type extended_attributes: list(str)
+        :type search_missing: bool
+        :rtype iterable(str, dict)
+        """
+        if self.user_dn_index is None:
+            self.user_dn_index = {self.normalize_dn(dn): dn for dn in self.user_by_dn}
+        batch_size = self.options['two_steps_lookup']['member_batch_size']
+        batch = {}
+        for user_dn in user_dns:
+            key = self.normalize_dn(user_dn)
+            if key in self.user_dn_index:
+                dn = self.user_dn_index[key]
+                yield (dn, self.user_by_dn[dn])
+            elif search_missing and key not in self.non_user_dns and key not in batch:
+                batch[key] = user_dn
+                if len(batch) >= batch_size:
+                    for result in self.search_users_by_dn(batch, extended_attributes):
+                        yield result
+                    batch = {}
+        if batch:
+            for result in self.search_users_by_dn(batch, extended_attributes):
+                yield result
 
-            identity_type, last_attribute_name = self.user_identity_type_formatter.generate_value(record)
-            if last_attribute_name and not identity_type:
-                self.logger.warning('No identity_type attribute (%s) for user with dn: %s, defaulting to %s',
-                                    last_attribute_name, dn, self.user_identity_type)
-            source_attributes['identity_type'] = identity_type
-            if not identity_type:
-                user['identity_type'] = self.user_identity_type
+    def search_users_by_dn(self, dn_by_key, extended_attributes):
+        """
+        Run one search for a batch of user DNs, keyed by their normalized form.  Entries the search returns that
+        weren't asked for (other objects that share an RDN with a requested DN) are ignored.
+        :type dn_by_key: dict(str, str)
+        :type extended_attributes: list(str)
+        :rtype iterable(str, dict)
+        """
+        rdn_filters = []
+        for key, user_dn in six.iteritems(dn_by_key):
+            rdn_filter = self.format_rdn_filter(user_dn)
+            if rdn_filter is None:
+                self.logger.warning('Unable to parse member DN: %s', user_dn)
+                self.non_user_dns.add(key)
             else:
-                try:
-                    user['identity_type'] = user_sync.identity_type.parse_identity_type(identity_type)
-                except AssertionException as e:
-                    self.logger.warning('Skipping user with dn %s: %s', dn, e)
+                rdn_filters.append(rdn_filter)
+        if not rdn_filters:
+            return
+        user_subfilter = self.options['all_users_filter']
+        if not user_subfilter.startswith('('):
+            user_subfilter = six.text_type('(') + user_subfilter + six.text_type(')')
+        users_filter = six.text_type('(&%s(|%s))') % (user_subfilter, six.text_type('').join(rdn_filters))
+        base_dn = six.text_type(self.options['base_dn'])
+
+        user_attribute_names, extended_attributes = self.get_user_attribute_names(extended_attributes)
+        found = set()
+        for dn, record in self.iter_search_result(base_dn, ldap3.SUBTREE, users_filter, user_attribute_names):
+            if dn is None:
+                continue
+            key = self.normalize_dn(dn)
+            if key not in dn_by_key or key in found:
+                continue
+            found.add(key)
+            user = self.user_by_dn.get(dn)
+            if user is None:
+                user = self.convert_user(dn, record, extended_attributes)
+                if user is None:
                     continue
+                self.add_user(dn, user)
+            yield (dn, user)
+        self.non_user_dns.update(key for key in dn_by_key if key not in found)
 
-            username, last_attribute_name = self.user_username_formatter.generate_value(record)
-            username = username.strip() if username else None
-            source_attributes['username'] = username
-            if username:
-                user['username'] = username
-            else:
-                if last_attribute_name:
-                    self.logger.warning('No username attribute (%s) for user with dn: %s, default to email (%s)',
-                                        last_attribute_name, dn, email)
-                user['username'] = email
-
-            domain, last_attribute_name = self.user_domain_formatter.generate_value(record)
-            domain = domain.strip() if domain else None
-            source_attributes['domain'] = domain
-            if domain:
-                user['domain'] = domain
-            elif username != email:
-                user['domain'] = email[email.find('@') + 1:]
-            elif last_attribute_name:
-                self.logger.warning('No domain attribute (%s) for user with dn: %s', last_attribute_name, dn)
-
-            given_name_value, last_attribute_name = self.user_given_name_formatter.generate_value(record)
-            source_attributes['givenName'] = given_name_value
-            if given_name_value is not None:
-                user['firstname'] = given_name_value
-            elif last_attribute_name:
-                self.logger.warning('No given name attribute (%s) for user with dn: %s', last_attribute_name, dn)
-            sn_value, last_attribute_name = self.user_surname_formatter.generate_value(record)
-            source_attributes['sn'] = sn_value
-            if sn_value is not None:
-                user['lastname'] = sn_value
-            elif last_attribute_name:
-                self.logger.warning('No surname attribute (%s) for user with dn: %s', last_attribute_name, dn)
-            c_value, last_attribute_name = self.user_country_code_formatter.generate_value(record)
-            source_attributes['c'] = c_value
-            if c_value is not None:
-                user['country'] = c_value.upper()
-
-            user['member_groups'] = self.get_member_groups(record, dynamic_group_member_attribute) if self.additional_group_filters else []
-
-            if extended_attributes is not None:
-                for extended_attribute in extended_attributes:
-                    extended_attribute_value = LDAPValueFormatter.get_attribute_value(record, extended_attribute)
-                    source_attributes[extended_attribute] = extended_attribute_value
-
-            user['source_attributes'] = source_attributes.copy()
-            if 'groups' not in user:
-                user['groups'] = []
-            self.user_by_dn[dn] = user
+    def add_user(self, dn, user):
+        """
+        :type dn: str
+        :type user: dict
+        """
+        self.user_by_dn[dn] = user
+        if self.user_dn_index is not None:
+            self.user_dn_index[self.normalize_dn(dn)] = dn
 
-            yield (dn, user)
+    def convert_user(self, dn, record, extended_attributes):
+        """
+        Build a user from a search result record.  Returns None if the record doesn't describe a usable user.
+        :type dn: str
+        :type record: dict
+        :type extended_attributes: list(str)
+        :rtype dict
+        """
+        dynamic_group_member_attribute = self.options['dynamic_group_member_attribute']
+
+        email, last_attribute_name = self.user_email_formatter.generate_value(record)
+        email = email.strip() if email else None
+        if not email:
+            if last_attribute_name is not None:
+                self.logger.warning('Skipping user with dn %s: empty email attribute (%s)', dn, last_attribute_name)
+            return None
+
+        source_attributes = {}
+
+        user = user_sync.connector.helper.create_blank_user()
+        source_attributes['email'] = email
+        user['email'] = email
+
+        identity_type, last_attribute_name = self.user_identity_type_formatter.generate_value(record)
+        if last_attribute_name and not identity_type:
+            self.logger.warning('No identity_type attribute (%s) for user with dn: %s, defaulting to %s',
+                                last_attribute_name, dn, self.user_identity_type)
+        source_attributes['identity_type'] = identity_type
+        if not identity_type:
+            user['identity_type'] = self.user_identity_type
+        else:
+            try:
+                user['identity_type'] = user_sync.identity_type.parse_identity_type(identity_type)
+            except AssertionException as e:
+                self.logger.warning('Skipping user with dn %s: %s', dn, e)
+                return None
+
+        username, last_attribute_name = self.user_username_formatter.generate_value(record)
+        username = username.strip() if username else None
+        source_attributes['username'] = username
+        if username:
+            user['username'] = username
+        else:
+            if last_attribute_name:
+                self.logger.warning('No username attribute (%s) for user with dn: %s, default to email (%s)',
+                                    last_attribute_name, dn, email)
+            user['username'] = email
+
+        domain, last_attribute_name = self.user_domain_formatter.generate_value(record)
+        domain = domain.strip() if domain else None
+        source_attributes['domain'] = domain
+        if domain:
+            user['domain'] = domain
+        elif username != email:
+            user['domain'] = email[email.find('@') + 1:]
+        elif last_attribute_name:
+            self.logger.warning('No domain attribute (%s) for user with dn: %s', last_attribute_name, dn)
+
+        given_name_value, last_attribute_name = self.user_given_name_formatter.generate_value(record)
+        source_attributes['givenName'] = given_name_value
+        if given_name_value is not None:
+            user['firstname'] = given_name_value
+        elif last_attribute_name:
+            self.logger.warning('No given name attribute (%s) for user with dn: %s', last_attribute_name, dn)
+        sn_value, last_attribute_name = self.user_surname_formatter.generate_value(record)
+        source_attributes['sn'] = sn_value
+        if sn_value is not None:
+            user['lastname'] = sn_value
+        elif last_attribute_name:
+            self.logger.warning('No surname attribute (%s) for user with dn: %s', last_attribute_name, dn)
+        c_value, last_attribute_name = self.user_country_code_formatter.generate_value(record)
+        source_attributes['c'] = c_value
+        if c_value is not None:
+            user['country'] = c_value.upper()
+
+        user['member_groups'] = self.get_member_groups(record, dynamic_group_member_attribute) if self.additional_group_filters else []
+
+        if extended_attributes is not None:
+            for extended_attribute in extended_attributes:
+                extended_attribute_value = LDAPValueFormatter.get_attribute_value(record, extended_attribute)
+                source_attributes[extended_attribute] = extended_attribute_value
+
+        user['source_attributes'] = source_attributes
+        if self.member_of_groups is not None:
+            user['groups'] = self.get_member_of_groups(record)
+        return user
 
     def get_member_groups(self, user, dynamic_group_member_attribute):
         """
@@ -443,11 +1364,32 @@ class LDAPDirectoryConnector(object):
             groups = [groups]
 
         for group_dn in groups:
-            group_cn = self.get_cn_from_dn(group_dn)
+            group_cn = self.cached_cn_from_dn(group_dn)
             if group_cn:
                 group_names.append(group_cn)
         return group_names
 
+    def get_group_cn(self, group_dn):
+        """
+        Return the common name of a group, or None if the group is outside the dynamic_group_base_dn (if set)
+        :type group_dn: str
+        :rtype str
+        """
+        if self.group_base_dn is not None and not group_dn.lower().endswith(self.group_base_suffix):
+            # the quick test may fail for DNs that are spelled differently (e.g. with spaces after commas)
+            if not self.is_dn_within_base_dn_scope(self.group_base_dn, group_dn):
+                return None
+        return self.get_cn_from_dn(group_dn)
+
+    def log_dn_cache_usage(self):
+        """
+        Log the hits and misses of the group DN cache used for dynamic group mappings
+        """
+        cache_info = self.cached_cn_from_dn.cache_info()
+        if cache_info.hits or cache_info.misses:
+            self.logger.debug('Group DN cache: %d hits, %d misses, %d entries', cache_info.hits, cache_info.misses,
+                              cache_info.currsize)
+
     @staticmethod
     def get_cn_from_dn(group_dn):
         """
@@ -462,28 +1404,97 @@ class LDAPDirectoryConnector(object):
             return rdn[0][3:]
         return None
 
-    def iter_search_result(self, base_dn, scope, filter_string, attributes):
+    def iter_search_result(self, base_dn, scope, filter_string, attributes, connection=None):
         """
+        Search, returning [dn, attributes] for each entry found.  Paged searches are read one page at a time,
+        keeping the cookie of the last page received.  If the connection drops, it is reopened and rebound, and
+        the search resumes from that page; if the server won't resume it, the search starts over, skipping the
+        entries already returned.  This is attempted up to search_retry_count times for each drop.
         type: filter_string: str
         type: attributes: list(str)
+        type: connection: ldap3.Connection
         """
-        connection = self.connection
+        connection = connection or self.connection
         search_page_size = self.options['search_page_size']
-        if search_page_size == 0:
-            connection.search(base_dn, filter_string, scope, attributes=attributes)
-            entries = connection.entries
-            for entry in entries:
-                yield [entry.entry_dn, entry.entry_attributes_as_dict]
-        else:
-            entry_generator = connection.extend.standard.paged_search(search_base=base_dn,
-                                                                      search_filter=filter_string,
-                                                                      search_scope=scope,
-                                                                      attributes=attributes,
-                                                                      paged_size=search_page_size,
-                                                                      generator=True)
-            for entry in entry_generator:
-                if entry['type'] != 'searchResRef':
-                    yield [entry['dn'], entry['attributes']]
+        retry_count = self.options['search_retry_count']
+        paged_search_options = {}
+        if search_page_size != 0:
+            paged_search_options['paged_size'] = search_page_size
+        received_dns = set()
+        entry_count = 0
+        cookie = None
+        failures = 0
+        try:
+            while True:
+                try:
+                    if failures:
+                        # page cookies and update sequence numbers (see load_incremental_users) only mean
+                        # something on the server that issued them
+                        self.reconnect(connection, same_server=cookie is not None or self.worker_server is not None)
+                    if cookie is not None:
+                        paged_search_options['paged_cookie'] = cookie
+                    connection.search(base_dn, filter_string, scope, attributes=attributes, **paged_search_options)
+                except ldap3.core.exceptions.LDAPCommunicationError as e:
+                    failures += 1
+                    if failures > retry_count:
+                        raise
+                    self.logger.warning('LDAP connection lost after %d entries (%s); reconnecting (attempt %d of %d)',
+                                        len(received_dns), e, failures, retry_count)
+                    time.sleep(self.options['search_retry_delay'] * failures)
+                    continue
+                result = connection.result
+                if failures and cookie is not None and result['result'] != ldap3.core.results.RESULT_SUCCESS:
+                    # the page cookie isn't valid on the new connection
+                    self.logger.info('Unable to resume the search (%s); restarting it', result['description'])
+                    cookie = None
+                    paged_search_options.pop('paged_cookie', None)
+                    continue
+                failures = 0
+                for entry in connection.response or []:
+                    if entry['type'] == 'searchResRef':
+                        continue
+                    dn = entry['dn']
+                    if retry_count:
+                        if dn in received_dns:
+                            continue
+                        received_dns.add(dn)
+                    entry_count += 1
+                    yield [dn, entry['attributes']]
+                try:
+                    cookie = result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
+                except (KeyError, TypeError):
+                    cookie = None
+                if not cookie:
+                    break
+        finally:
+            with self.stats_lock:
+                self.search_entry_count += entry_count
+
+    def reconnect(self, connection, same_server=False):
+        """
+        Reopen and rebind a connection that was lost.  With a server pool, this may be another server, unless
+        same_server is set.
+        :type connection: ldap3.Connection
+        :type same_server: bool
+        """
+        try:
+            connection.unbind()
+        except Exception:
+            pass
+        server_pool = connection.server_pool
+        if same_server:
+            # without its pool, the connection reopens to the server it was on
+            connection.server_pool = None
+        try:
+            connection.open()
+            if self.auto_bind == ldap3.AUTO_BIND_TLS_BEFORE_BIND:
+                connection.start_tls()
+            if not connection.bind():
+                raise AssertionException('LDAP rebind failure: %s' % connection.result['description'])
+        except ldap3.core.exceptions.LDAPServerPoolExhaustedError as e:
+            raise AssertionException('LDAP connection failure: %s' % e)
+        finally:
+            connection.server_pool = server_pool
 
     @staticmethod
     def format_ldap_query_string(query, **kwargs):
@@ -547,6 +1558,70 @@ class LDAPDirectoryConnector(object):
         return False
 
 
+    @classmethod
+    def normalize_dn(cls, dn):
+        """
+        Return a form of the DN that can be compared with others: attribute types and values are lower-cased,
+        escapes in values are resolved, and spacing around separators is dropped.
+        :type dn: str
+        :rtype str
+        """
+        try:
+            components = ldap3.utils.dn.parse_dn(dn, strip=True)
+        except Exception:
+            return dn.strip().lower()
+        parts = []
+        for attribute, value, separator in components:
+            value = ldap3.utils.dn.escape_rdn(cls.unescape_dn_value(value).lower())
+            parts.append(attribute.lower() + '=' + value + separator)
+        return six.text_type('').join(parts)
+
+    @classmethod
+    def format_rdn_filter(cls, dn):
+        """
+        Return a filter that matches the RDN (the leftmost component) of the given DN, or None if it can't be parsed
+        :type dn: str
+        :rtype str
+        """
+        try:
+            components = ldap3.utils.dn.parse_dn(dn, strip=True)
+        except Exception:
+            return None
+        clauses = []
+        for attribute, value, separator in components:
+            value = ldap3.utils.conv.escape_filter_chars(cls.unescape_dn_value(value))
+            clauses.append(six.text_type('(%s=%s)') % (attribute, value))
+            if separator != '+':
+                break
+        if len(clauses) == 1:
+            return clauses[0]
+        return six.text_type('(&') + six.text_type('').join(clauses) + six.text_type(')')
+
+    @staticmethod
+    def unescape_dn_value(value):
+        """
+        Resolve the backslash escapes (both \\c and \\hh forms) in an attribute value taken from a DN
+        :type value: str
+        :rtype str
+        """
+        if '\\' not in value:
+            return value
+        result = bytearray()
+        i = 0
+        while i < len(value):
+            c = value[i]
+            if c == '\\' and i + 1 < len(value):
+                pair = value[i + 1:i + 3]
+                if len(pair) == 2 and all(h in string.hexdigits for h in pair):
+                    result.append(int(pair, 16))
+                    i += 3
+                    continue
+                c = value[i + 1]
+                i += 1
+            result.extend(c.encode('utf8'))
+            i += 1
+        return result.decode('utf8', 'replace')
+
 class LDAPValueFormatter(object):
     encoding = 'utf8'
 
@@ -562,6 +1637,7 @@ class LDAPValueFormatter(object):
             attribute_names = [six.text_type(item[1]) for item in formatter.parse(string_format) if item[1]]
         self.string_format = string_format
         self.attribute_names = attribute_names
+        self.format_record = user_sync.connector.helper.compile_value_format(string_format, self.get_first_value)
 
     def get_attribute_names(self):
         """
@@ -574,19 +1650,22 @@ class LDAPValueFormatter(object):
         :type record: dict
         :rtype (unicode, unicode)
         """
-        result = None
-        attribute_name = None
-        if self.string_format is not None:
-            values = {}
-            for attribute_name in self.attribute_names:
-                value = self.get_attribute_value(record, attribute_name, first_only=True)
-                if value is None:
-                    values = None
-                    break
-                values[attribute_name] = value
-            if values is not None:
-                result = self.string_format.format(**values)
-        return result, attribute_name
+        return self.format_record(record)
+
+    @staticmethod
+    def get_first_value(attributes, attribute_name):
+        """
+        Same as get_attribute_value with first_only
+        :type attributes: dict
+        :type attribute_name: unicode
+        """
+        attribute_values = attributes.get(attribute_name)
+        if attribute_values:
+            if not isinstance(attribute_values, (list, tuple)):
+                # a string, or a single-valued attribute converted by the schema (such as a datetime)
+                return attribute_values
+            return attribute_values[0]
+        return None
 
     @classmethod
     def get_attribute_value(cls, attributes, attribute_name, first_only=False):
@@ -599,7 +1678,8 @@ class LDAPValueFormatter(object):
         attribute_values = attributes.get(attribute_name)
         if attribute_values:
             try:
-                if isinstance(attribute_values, six.string_types):
+                if not isinstance(attribute_values, (list, tuple)):
+                    # with the schema, single-valued attributes (such as timestamps) aren't in a list
                     return attribute_values
                 else:
                     if first_only:
@@ -18,18 +18,27 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import okta
+import ast
+import datetime
 import six
 import string
-from okta.framework.OktaError import OktaError
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import user_sync.config
 import user_sync.connector.helper
+import user_sync.connector.okta_client
+import user_sync.connector.snapshot
 import user_sync.helper
 import user_sync.identity_type
 from user_sync.error import AssertionException
 
 
+# how long before the start of an incremental sync the next one looks for updated users
+SYNC_TIME_MARGIN = datetime.timedelta(minutes=5)
+
+
 def connector_metadata():
     metadata = {
         'name': OktaDirectoryConnector.name
@@ -76,11 +85,24 @@ class OktaDirectoryConnector(object):
         builder.set_string_value('user_surname_format', six.text_type('{lastName}'))
         builder.set_string_value('user_country_code_format', six.text_type('{countryCode}'))
         builder.set_string_value('user_identity_type', None)
+        builder.set_int_value('concurrent_requests', 1)
+        builder.set_int_value('rate_limit_headroom', 10)
+        builder.set_dict_value('incremental_sync', None)
         builder.set_string_value('logger_name', self.name)
         host = builder.require_string_value('host')
         api_token = builder.require_string_value('api_token')
 
         options = builder.get_options()
+        if options['concurrent_requests'] < 1:
+            raise AssertionException("'concurrent_requests' must be at least 1")
+        if not 0 <= options['rate_limit_headroom'] < 100:
+            raise AssertionException("'rate_limit_headroom' must be a percentage from 0 to 99")
+        if options['incremental_sync'] is not None:
+            inc_config = caller_config.get_dict_config('incremental_sync', True)
+            inc_builder = user_sync.config.OptionsBuilder(inc_config)
+            inc_builder.require_string_value('snapshot_file')
+            inc_builder.set_int_value('full_sync_interval', 24)
+            options['incremental_sync'] = inc_builder.get_options()
 
         OKTAValueFormatter.encoding = options['string_encoding']
         self.user_identity_type = user_sync.identity_type.parse_identity_type(options['user_identity_type'])
@@ -92,8 +114,7 @@ class OktaDirectoryConnector(object):
         self.user_surname_formatter = OKTAValueFormatter(options['user_surname_format'])
         self.user_country_code_formatter = OKTAValueFormatter(options['user_country_code_format'])
 
-        self.users_client = None
-        self.groups_client = None
+        self.client = None
         self.logger = logger = user_sync.connector.helper.create_logger(options)
         self.user_identity_type = user_sync.identity_type.parse_identity_type(options['user_identity_type'])
         self.options = options
@@ -105,17 +126,17 @@ class OktaDirectoryConnector(object):
             host = "https://" + host
 
         self.user_by_uid = {}
+        self.user_filter = OKTAUserFilter(options['all_users_filter'])
+        self.rate_limiter = user_sync.connector.okta_client.RateLimiter(options['rate_limit_headroom'], logger)
+        self.client_filtered_count = 0
 
         logger.debug('%s initialized with options: %s', self.name, options)
+        if self.user_filter.search_expression is not None:
+            logger.debug('all_users_filter as an Okta search expression: %s', self.user_filter.search_expression)
 
         logger.info('Connecting to: %s', host)
-
-        try:
-            self.users_client = okta.UsersClient(host, api_token)
-            self.groups_client = okta.UserGroupsClient(host, api_token)
-        except OktaError as e:
-            raise AssertionException("Error connecting to Okta: %s" % e)
-
+        self.client = user_sync.connector.okta_client.OktaClient(host, api_token, self.rate_limiter,
+                                                                 pool_size=options['concurrent_requests'])
         logger.info('Connected')
 
     def load_users_and_groups(self, groups, extended_attributes, all_users):
@@ -125,34 +146,81 @@ class OktaDirectoryConnector(object):
         :type all_users: bool
         :rtype (bool, iterable(dict))
         """
-        if all_users:
-            raise AssertionException("Okta connector has no notion of all users, please specify a --users group")
-
-        options = self.options
-        all_users_filter = options['all_users_filter']
-
         self.logger.info('Loading users...')
         self.user_by_uid = user_by_uid = {}
+        self.client_filtered_count = 0
+        group_members = dict((group, 0) for group in groups)
+        group_users = dict((group, 0) for group in groups)
 
+        if all_users:
+            if self.options['incremental_sync'] is not None:
+                self.logger.info('Incremental sync is not used when loading all users')
+            self.load_all_users(groups, extended_attributes, group_members, group_users)
+            return six.itervalues(user_by_uid)
+
+        if self.options['incremental_sync'] is not None:
+            member_iter = self.iter_snapshot_members(groups, self.user_filter, extended_attributes)
+        else:
+            member_iter = self.iter_groups_members(groups, self.user_filter, extended_attributes)
+        for group, user in member_iter:
+            group_members[group] += 1
+            uid = user.get('uid')
+            if user and uid:
+                if uid not in user_by_uid:
+                    user_by_uid[uid] = user
+                group_users[group] += 1
+                if group not in user_by_uid[uid]['groups']:
+                    user_by_uid[uid].add_group(group)
+
+        # the members of different groups may have arrived in any order
+        group_order = dict((group, index) for index, group in enumerate(groups))
+        for user in six.itervalues(user_by_uid):
+            if len(user['groups']) > 1:
+                user['groups'] = sorted(user['groups'], key=group_order.get)
         for group in groups:
-            total_group_members = 0
-            total_group_users = 0
-            for user in self.iter_group_members(group, all_users_filter, extended_attributes):
-                total_group_members += 1
-
-                uid = user.get('uid')
-                if user and uid:
-                    if uid not in user_by_uid:
-                        user_by_uid[uid] = user
-                    total_group_users += 1
-                    user_groups = user_by_uid[uid]['groups']
-                    if group not in user_groups:
-                        user_groups.append(group)
-
-            self.logger.debug('Group %s members: %d users: %d', group, total_group_members, total_group_users)
+            self.logger.debug('Group %s members: %d users: %d', group, group_members[group], group_users[group])
 
+        # group members can't be filtered by Okta, so all_users_filter is always applied here
+        self.logger.debug('Users filtered out by all_users_filter: %d client-side', self.client_filtered_count)
         return six.itervalues(user_by_uid)
 
+    def load_all_users(self, groups, extended_attributes, group_members, group_users):
+        """
+        Load every user that matches the filter into user_by_uid, listing the users once (with the search
+        expression translated from the filter, if any), then attach the groups of the loaded users from the
+        members of the mapped groups, which are not converted again.
+        :type groups: list(str)
+        :type extended_attributes: list(str)
+        :type group_members: dict(str, int)
+        :type group_users: dict(str, int)
+        """
+        user_by_uid = self.user_by_uid
+        user_filter = self.user_filter
+        extended_attributes = self.get_extended_attributes(extended_attributes)
+        for page in self.iter_search_result(user_filter.search_expression):
+            for record in self.filter_users(page, user_filter):
+                user = self.convert_user(record, extended_attributes)
+                if user:
+                    user_by_uid[user['uid']] = user
+        self.logger.debug('Users loaded: %d', len(user_by_uid))
+
+        for group, _, page in self.iter_group_pages(groups):
+            group_members[group] += len(page)
+            for record in page:
+                user = user_by_uid.get(record.id)
+                if user is not None:
+                    group_users[group] += 1
+                    if group not in user['groups']:
+                        user.add_group(group)
+
+        group_order = dict((group, index) for index, group in enumerate(groups))
+        for user in six.itervalues(user_by_uid):
+            if len(user['groups']) > 1:
+                user['groups'] = sorted(user['groups'], key=group_order.get)
+        for group in groups:
+            self.logger.debug('Group %s members: %d users: %d', group, group_members[group], group_users[group])
+        self.logger.debug('Users filtered out by all_users_filter: %d client-side', self.client_filtered_count)
+
     def find_group(self, group):
         """
         :type group: str
@@ -162,10 +230,10 @@ class OktaDirectoryConnector(object):
         options = self.options
         group_filter_format = options['group_filter_format']
         try:
-            results = self.groups_client.get_groups(query=group_filter_format.format(group=group))
+            results = self.client.get_groups(group_filter_format.format(group=group))
         except KeyError as e:
             raise AssertionException("Bad format key in group query (%s): %s" % (group_filter_format, e))
-        except OktaError as e:
+        except user_sync.connector.okta_client.OktaClientError as e:
             self.logger.warning("Unable to query group")
             raise AssertionException("Okta error querying for group: %s" % e)
 
@@ -178,14 +246,193 @@ class OktaDirectoryConnector(object):
 
         return None
 
-    def iter_group_members(self, group, filter_string, extended_attributes):
+    def iter_groups_members(self, groups, user_filter, extended_attributes):
         """
-        :type group: str
-        :type filter_string: str
-        :type extended_attributes: list
-        :rtype iterator(str, str)
+        Yield (group, user) for the members of each group that match the filter.  Each page of members is
+        converted as soon as it arrives; with concurrent_requests more than 1, the members of different groups
+        come in any order.
+        :type groups: list(str)
+        :type user_filter: OKTAUserFilter
+        :type extended_attributes: list(str)
+        :rtype iterator(str, dict)
         """
+        extended_attributes = self.get_extended_attributes(extended_attributes)
+        for group, _, page in self.iter_group_pages(groups):
+            # Filtering users based all_users_filter query in config
+            for member in self.filter_users(page, user_filter):
+                user = self.convert_user(member, extended_attributes)
+                if user:
+                    yield group, user
 
+    def iter_group_pages(self, groups, okta_groups=None):
+        """
+        Find each group, and yield (group, Okta group, page of members) for each page of its members (at least
+        one page, which may be empty).  With concurrent_requests more than 1, several groups are fetched at once,
+        so the pages of different groups come in any order.
+        :type groups: list(str)
+        :type okta_groups: dict(str, OktaObject)
+        :rtype iterator(str, OktaObject, list(OktaObject))
+        """
+        def find_group(group):
+            if okta_groups is not None and group in okta_groups:
+                return okta_groups[group]
+            res_group = self.find_group(group)
+            if res_group is None:
+                self.logger.warning("No group found for: %s", group)
+            return res_group
+
+        concurrency = min(self.options['concurrent_requests'], len(groups))
+        if concurrency <= 1:
+            for group in groups:
+                res_group = find_group(group)
+                if res_group is not None:
+                    for page in self.iter_member_pages(res_group.id):
+                        yield group, res_group, page
+            return
+
+        # fetcher threads put (group, Okta group, page, error) for each page of members, and
+        # (group, None, None, error) when done
+        pages = six.moves.queue.Queue()
+        cancelled = threading.Event()
+
+        def fetch_group(group):
+            error = None
+            try:
+                res_group = find_group(group)
+                if res_group is None:
+                    return
+                for page in self.iter_member_pages(res_group.id):
+                    if cancelled.is_set():
+                        return
+                    pages.put((group, res_group, page, None))
+            except Exception as e:
+                error = e
+            finally:
+                pages.put((group, None, None, error))
+
+        self.logger.debug('Fetching the members of %d groups with %d concurrent requests', len(groups), concurrency)
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = []
+        try:
+            for group in groups:
+                futures.append(executor.submit(fetch_group, group))
+            groups_left = len(groups)
+            while groups_left:
+                group, res_group, page, error = pages.get()
+                if error is not None:
+                    if isinstance(error, AssertionException):
+                        raise error
+                    raise AssertionException("Okta error querying for group users: %s" % error)
+                if page is None:
+                    groups_left -= 1
+                    continue
+                yield group, res_group, page
+        finally:
+            # on an error (or if the caller stops early) the groups not started yet aren't fetched at all
+            cancelled.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def iter_snapshot_members(self, groups, user_filter, extended_attributes):
+        """
+        Yield (group, user) for the members of each group that match the filter, like iter_groups_members, but
+        using the snapshot of the previous run.  Only the users updated since then are fetched (with a
+        lastUpdated search), and only the groups whose membership changed since then (according to their
+        lastMembershipUpdated) have their members fetched again.  Every full_sync_interval hours (and when there
+        is no usable snapshot) everything is fetched.  The updated snapshot is saved for the next run.
+        :type groups: list(str)
+        :type user_filter: OKTAUserFilter
+        :type extended_attributes: list(str)
+        :rtype iterator(str, dict)
+        """
+        inc_options = self.options['incremental_sync']
+        snapshot_file = inc_options['snapshot_file']
+        fingerprint = user_sync.connector.snapshot.options_fingerprint(
+            {key: self.options[key] for key in ('host', 'group_filter_format')})
+        snapshot = user_sync.connector.snapshot.load_snapshot(snapshot_file, fingerprint, self.logger)
+        now = time.time()
+        if snapshot is not None:
+            full_sync_interval = inc_options['full_sync_interval'] * 3600
+            if full_sync_interval and now - snapshot['full_sync_time'] >= full_sync_interval:
+                self.logger.info('Doing a full sync: the last one was more than %d hours ago',
+                                 inc_options['full_sync_interval'])
+                snapshot = None
+        # users updated while this sync runs are fetched again by the next one
+        sync_time = (datetime.datetime.fromtimestamp(now, tz=user_sync.connector.snapshot.UTC) -
+                     SYNC_TIME_MARGIN).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+        if snapshot is None:
+            records, group_members, full_sync_time = {}, {}, now
+        else:
+            records = dict((uid, user_sync.connector.okta_client.OktaObject.from_value(record))
+                           for uid, record in six.iteritems(snapshot['records']))
+            group_members = snapshot['groups']
+            full_sync_time = snapshot['full_sync_time']
+            changed_users = 0
+            for page in self.iter_search_result('lastUpdated gt "%s"' % snapshot['sync_time']):
+                for record in page:
+                    if record.id in records:
+                        records[record.id] = record
+                        changed_users += 1
+            self.logger.info('Incremental sync: %d users changed', changed_users)
+
+        okta_groups = {}
+        changed_groups = []
+        for group in groups:
+            res_group = self.find_group(group)
+            if res_group is None:
+                self.logger.warning("No group found for: %s", group)
+                continue
+            okta_groups[group] = res_group
+            known = group_members.get(group)
+            if known is None or known['id'] != res_group.id or not res_group.get('lastMembershipUpdated') or \
+                    known['lastMembershipUpdated'] != res_group.get('lastMembershipUpdated'):
+                changed_groups.append(group)
+        if snapshot is not None:
+            self.logger.info('Incremental sync: fetching the members of %d of %d groups', len(changed_groups),
+                             len(okta_groups))
+
+        group_members = dict((group, group_members[group]) for group in okta_groups if group not in changed_groups)
+        for group in changed_groups:
+            res_group = okta_groups[group]
+            group_members[group] = {'id': res_group.id, 'lastMembershipUpdated': res_group.get('lastMembershipUpdated'),
+                                    'members': []}
+        for group, _, page in self.iter_group_pages(changed_groups, okta_groups):
+            for record in page:
+                records[record.id] = record
+                group_members[group]['members'].append(record.id)
+
+        # users that are no longer in any of the groups aren't kept
+        member_ids = set()
+        for members in six.itervalues(group_members):
+            member_ids.update(members['members'])
+        records = dict((uid, record) for uid, record in six.iteritems(records) if uid in member_ids)
+        user_sync.connector.snapshot.save_snapshot(snapshot_file, fingerprint, {
+            'sync_time': sync_time,
+            'full_sync_time': full_sync_time,
+            'groups': group_members,
+            'records': records,
+        })
+
+        extended_attributes = self.get_extended_attributes(extended_attributes)
+        user_by_id = {}
+        for group in groups:
+            if group not in group_members:
+                continue
+            for uid in group_members[group]['members']:
+                if uid not in user_by_id:
+                    record = records[uid]
+                    user_by_id[uid] = self.convert_user(record, extended_attributes) \
+                        if next(self.filter_users([record], user_filter), None) is not None else None
+                if user_by_id[uid] is not None:
+                    yield group, user_by_id[uid]
+
+    def get_extended_attributes(self, extended_attributes):
+        """
+        :type extended_attributes: list(str)
+        :rtype list(str)
+        """
         user_attribute_names = []
         user_attribute_names.extend(self.user_given_name_formatter.get_attribute_names())
         user_attribute_names.extend(self.user_surname_formatter.get_attribute_names())
@@ -194,25 +441,20 @@ class OktaDirectoryConnector(object):
         user_attribute_names.extend(self.user_email_formatter.get_attribute_names())
         user_attribute_names.extend(self.user_username_formatter.get_attribute_names())
         user_attribute_names.extend(self.user_domain_formatter.get_attribute_names())
-        extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
-        user_attribute_names.extend(extended_attributes)
+        return list(set(extended_attributes) - set(user_attribute_names))
 
-        res_group = self.find_group(group)
-        if res_group:
-            try:
-                attr_dict = OKTAValueFormatter.get_extended_attribute_dict(user_attribute_names)
-                members = self.groups_client.get_group_all_users(res_group.id, attr_dict)
-            except OktaError as e:
-                self.logger.warning("Unable to get_group_users")
-                raise AssertionException("Okta error querying for group users: %s" % e)
-            # Filtering users based all_users_filter query in config
-            for member in self.filter_users(members, filter_string):
-                user = self.convert_user(member, extended_attributes)
-                if not user:
-                    continue
-                yield (user)
-        else:
-            self.logger.warning("No group found for: %s", group)
+    def iter_member_pages(self, group_id):
+        """
+        Yield the members of a group, one page at a time
+        :type group_id: str
+        :rtype iterator(list(OktaObject))
+        """
+        try:
+            for page in self.client.iter_group_member_pages(group_id):
+                yield page
+        except user_sync.connector.okta_client.OktaClientError as e:
+            self.logger.warning("Unable to get_group_users")
+            raise AssertionException("Okta error querying for group users: %s" % e)
 
     def convert_user(self, record, extended_attributes):
 
@@ -286,42 +528,138 @@ class OktaDirectoryConnector(object):
                 extended_attribute_value = OKTAValueFormatter.get_profile_value(record, extended_attribute)
                 source_attributes[extended_attribute] = extended_attribute_value
 
-        user['source_attributes'] = source_attributes.copy()
+        user['source_attributes'] = source_attributes
         return user
 
-    def iter_search_result(self, filter_string, attributes):
+    def iter_search_result(self, search_expression):
         """
-        type: filter_string: str
-        type: attributes: list(str)
+        Yield the users found by an Okta search expression (all users if it's None), one page at a time
+        type: search_expression: str
+        :rtype iterator(list(OktaObject))
         """
-
-        attr_dict = OKTAValueFormatter.get_extended_attribute_dict(attributes)
-
         try:
-            self.logger.info("Calling okta SDK get_users with the following %s", filter_string)
-            if attr_dict:
-                users = self.users_client.get_all_users(query=filter_string, extended_attribute=attr_dict)
-            else:
-                users = self.users_client.get_all_users(query=filter_string)
-        except OktaError as e:
+            self.logger.info("Listing Okta users with search: %s", search_expression)
+            for page in self.client.iter_user_pages(search_expression):
+                yield page
+        except user_sync.connector.okta_client.OktaClientError as e:
             self.logger.warning("Unable to query users")
             raise AssertionException("Okta error querying for users: %s" % e)
-        return users
 
-    def filter_users(self, users, filter_string):
-        # Allow the following builtin functions to be used in eval()
-        whitelist = {
-            "len": len, "int": int, "float": float, "str": str, "enumerate": enumerate, "filter": filter,
-            "getattr": getattr, "hasattr": hasattr, "list": list, "map": map, "max": max, "min": min,
-            "range": range, "sorted": sorted, "sum": sum, "tuple": tuple, "zip": zip
-        }
+    def filter_users(self, users, user_filter):
+        """
+        Yield the users that match the filter, counting those that don't
+        :type users: iterable(OktaObject)
+        :type user_filter: OKTAUserFilter
+        :rtype iterable(OktaObject)
+        """
+        for user in users:
+            if user_filter.matches(user):
+                yield user
+            else:
+                self.client_filtered_count += 1
+
+
+class OKTAUserFilter(object):
+    """
+    A compiled all_users_filter: a Python expression about a user, which can use a restricted set of builtins.
+    The expression is compiled once, into a function.  Comparisons of user.status, user.id or user.profile
+    attributes with strings, combined with and/or, are also translated to an Okta search expression
+    (search_expression) that user listings can send to Okta.  The search expression may match more users than
+    the filter (parts of an and that can't be translated are left out), so the filter is still applied to
+    the users that Okta returns.
+    """
+    # Allow the following builtin functions to be used in the filter
+    whitelist = {
+        "len": len, "int": int, "float": float, "str": str, "enumerate": enumerate, "filter": filter,
+        "getattr": getattr, "hasattr": hasattr, "list": list, "map": map, "max": max, "min": min,
+        "range": range, "sorted": sorted, "sum": sum, "tuple": tuple, "zip": zip
+    }
+    search_attributes = ('status', 'id')
 
+    def __init__(self, filter_string):
+        """
+        :type filter_string: str
+        """
+        self.filter_string = filter_string
         try:
-            return list(filter(lambda user: eval(filter_string, {"__builtins__": whitelist}, {"user": user}), users))
-        except SyntaxError as e:
+            tree = ast.parse(filter_string.strip(), mode='eval')
+            # the expression parses on its own, so it is the whole body of the lambda
+            self.predicate = eval(compile('lambda user: (\n%s\n)' % filter_string.strip(), '<all_users_filter>',
+                                          'eval'), {"__builtins__": self.whitelist})
+        except SyntaxError:
             raise AssertionException("Invalid syntax in predicate (%s): cannot evaluate" % filter_string)
+        self.search_expression = self.to_search_expression(tree.body)
+
+    def matches(self, user):
+        """
+        :type user: OktaObject
+        :rtype bool
+        """
+        try:
+            return bool(self.predicate(user))
         except Exception as e:
-            raise AssertionException("Error filtering with predicate (%s): %s" % (filter_string, e))
+            raise AssertionException("Error filtering with predicate (%s): %s" % (self.filter_string, e))
+
+    @classmethod
+    def to_search_expression(cls, node):
+        """
+        Translate an expression to an Okta search expression, or return None if that's not possible
+        :type node: ast.AST
+        :rtype str
+        """
+        if isinstance(node, ast.BoolOp):
+            parts = [cls.to_search_expression(value) for value in node.values]
+            if isinstance(node.op, ast.And):
+                # the parts that can be translated still narrow the search
+                parts = [part for part in parts if part is not None]
+                operator = ' and '
+            elif None in parts:
+                return None
+            else:
+                operator = ' or '
+            if not parts:
+                return None
+            return parts[0] if len(parts) == 1 else '(%s)' % operator.join(parts)
+        if not isinstance(node, ast.Compare) or len(node.ops) != 1 or not isinstance(node.ops[0], ast.Eq):
+            return None
+        left, right = node.left, node.comparators[0]
+        if cls.get_string(left) is not None:
+            left, right = right, left
+        attribute = cls.get_user_attribute(left)
+        value = cls.get_string(right)
+        if attribute is None or value is None:
+            return None
+        return '%s eq "%s"' % (attribute, value.replace('\\', '\\\\').replace('"', '\\"'))
+
+    @classmethod
+    def get_user_attribute(cls, node):
+        """
+        Return the Okta name of a user.<attribute> or user.profile.<attribute> expression, or None
+        :type node: ast.AST
+        :rtype str
+        """
+        if not isinstance(node, ast.Attribute) or not isinstance(node.value, (ast.Name, ast.Attribute)):
+            return None
+        if isinstance(node.value, ast.Name):
+            if node.value.id == 'user' and node.attr in cls.search_attributes:
+                return node.attr
+            return None
+        parent = node.value
+        if parent.attr == 'profile' and isinstance(parent.value, ast.Name) and parent.value.id == 'user':
+            return 'profile.%s' % node.attr
+        return None
+
+    @staticmethod
+    def get_string(node):
+        """
+        :type node: ast.AST
+        :rtype str
+        """
+        if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+            return node.value if isinstance(node.value, six.string_types) else None
+        if hasattr(ast, 'Str') and isinstance(node, ast.Str):
+            return node.s
+        return None
 
 
 class OKTAValueFormatter(object):
@@ -339,6 +677,7 @@ class OKTAValueFormatter(object):
             attribute_names = [six.text_type(item[1]) for item in formatter.parse(string_format) if item[1]]
         self.string_format = string_format
         self.attribute_names = attribute_names
+        self.format_record = user_sync.connector.helper.compile_value_format(string_format, self.get_profile_value)
 
     def get_attribute_names(self):
         """
@@ -346,47 +685,19 @@ class OKTAValueFormatter(object):
         """
         return self.attribute_names
 
-    @staticmethod
-    def get_extended_attribute_dict(attributes):
-
-        attr_dict = {}
-        for attribute in attributes:
-            if attribute not in attr_dict:
-                attr_dict.update({attribute: str})
-
-        return attr_dict
-
     def generate_value(self, record):
         """
         :type record: dict
         :rtype (unicode, unicode)
         """
-        result = None
-        attribute_name = None
-        if self.string_format is not None:
-            values = {}
-            for attribute_name in self.attribute_names:
-                value = self.get_profile_value(record, attribute_name)
-                if value is None:
-                    values = None
-                    break
-                values[attribute_name] = value
-            if values is not None:
-                result = self.string_format.format(**values)
-        return result, attribute_name
+        return self.format_record(record)
 
     @classmethod
     def get_profile_value(cls, record, attribute_name):
         """
         The attribute value type must be decodable (str in py2, bytes in py3)
-        :type record: okta.models.user.User
+        :type record: user_sync.connector.okta_client.OktaObject
         :type attribute_name: unicode
         """
-        if hasattr(record.profile, attribute_name):
-            attribute_values = getattr(record.profile,attribute_name)
-            if attribute_values:
-                try:
-                    return attribute_values
-                except UnicodeError as e:
-                    raise AssertionException("Encoding error in value of attribute '%s': %s" % (attribute_name, e))
-        return None
+        profile = record.get('profile')
+        return (profile.get(attribute_name) or None) if profile else None
@@ -19,6 +19,15 @@
 # SOFTWARE.
 
 import logging
+import string
+import sys
+
+import six
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
 
 def create_logger(options):
@@ -33,17 +42,175 @@ def create_logger(options):
 
 def create_blank_user():
     """
-    :rtype dict
+    :rtype DirectoryUser
+    """
+    return DirectoryUser()
+
+
+class DirectoryUser(MutableMapping):
+    """
+    A user read from a directory.  It can be used like a dict with the keys of create_blank_user, but keeps the
+    standard fields in slots, so that each user takes far less memory than a dict: syncs with a million users
+    hold several references to each of them.  Identity type, domain and country values are interned, since
+    they are shared by many users, and groups are kept in a tuple (use add_group to add one).  Keys other than
+    the standard fields are kept in a dict that only exists if there are any.
     """
-    user = {
-        "identity_type": None,
-        "username": None,
-        "domain": None,
-        "firstname": None,
-        "lastname": None,
-        "email": None,
-        "groups": [],
-        "country": None,
-    }
-    return user
+    FIELDS = ('identity_type', 'username', 'domain', 'firstname', 'lastname', 'email', 'groups', 'country',
+              'source_attributes', 'member_groups', 'uid')
+    INTERNED_FIELDS = frozenset(('identity_type', 'domain', 'country'))
+    # fields that are only present once they are set, as they are not part of a blank user
+    OPTIONAL_FIELDS = frozenset(('source_attributes', 'member_groups', 'uid'))
+
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, *args, **kwargs):
+        self.identity_type = None
+        self.username = None
+        self.domain = None
+        self.firstname = None
+        self.lastname = None
+        self.email = None
+        self.groups = ()
+        self.country = None
+        self.source_attributes = _MISSING
+        self.member_groups = _MISSING
+        self.uid = _MISSING
+        self.extra = None
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def add_group(self, group):
+        """
+        :type group: str
+        """
+        self.groups += (group,)
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            if value is not _MISSING:
+                return value
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _FIELD_SET:
+            if key == 'groups':
+                value = tuple(value)
+            elif key in self.INTERNED_FIELDS and value.__class__ is str:
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.OPTIONAL_FIELDS and getattr(self, key) is not _MISSING:
+            setattr(self, key, _MISSING)
+        elif key in _FIELD_SET:
+            # standard fields can't be removed, like they are never missing from a blank user
+            raise KeyError(key)
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in _FIELD_SET:
+            return getattr(self, key) is not _MISSING
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if getattr(self, key) is not _MISSING:
+                yield key
+        if self.extra is not None:
+            for key in self.extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        """
+        :rtype DirectoryUser
+        """
+        return DirectoryUser(self)
+
+    def __getstate__(self):
+        return dict(self)
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+
+_FIELD_SET = frozenset(DirectoryUser.FIELDS)
+_MISSING = object()
+
+
+def compile_value_format(string_format, get_value):
+    """
+    Compile a format string such as "{givenName}.{sn}@example.com" into a function that formats a record.
+    The function returns the formatted value (None if any of the attributes has no value) and the name of the
+    last attribute it looked at, like the value formatters of the directory connectors always have.
+    The format string is only parsed here, and a format that is just one attribute needs no formatting at all.
+    :type string_format: str
+    :param get_value: function (record, attribute name) returning the attribute value, or None if there is none
+    :rtype function
+    """
+    if string_format is None:
+        return lambda record: (None, None)
+    string_format = six.text_type(string_format)
+    parts = list(string.Formatter().parse(string_format))
+    fields = [(literal, six.text_type(name), spec, conversion) for literal, name, spec, conversion in parts if name]
+    if not fields:
+        return lambda record: (string_format.format(), None)
+
+    if len(parts) == 1 and not fields[0][0] and not fields[0][2] and not fields[0][3]:
+        attribute_name = fields[0][1]
+
+        def format_attribute(record):
+            value = get_value(record, attribute_name)
+            if value is None or isinstance(value, six.text_type):
+                return value, attribute_name
+            return format(value, ''), attribute_name
+        return format_attribute
+
+    attribute_names = [name for _, name, _, _ in fields]
+    if any(conversion or '{' in spec or not name.isidentifier() for _, name, spec, conversion in fields):
+        def format_values(record):
+            values = {}
+            for attribute_name in attribute_names:
+                value = get_value(record, attribute_name)
+                if value is None:
+                    return None, attribute_name
+                values[attribute_name] = value
+            return string_format.format(**values), attribute_name
+        return format_values
+
+    # each piece is either literal text or an (attribute name, format spec) pair
+    pieces = []
+    for literal, name, spec, _ in parts:
+        if literal:
+            pieces.append(literal)
+        if name:
+            pieces.append((six.text_type(name), spec or ''))
+    last_attribute_name = attribute_names[-1]
 
+    def format_pieces(record):
+        result = []
+        for piece in pieces:
+            if piece.__class__ is tuple:
+                value = get_value(record, piece[0])
+                if value is None:
+                    return None, piece[0]
+                result.append(format(value, piece[1]))
+            else:
+                result.append(piece)
+        return six.text_type('').join(result), last_attribute_name
+    return format_pieces
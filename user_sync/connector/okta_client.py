@@ -0,0 +1,230 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+import time
+
+import requests
+import requests.adapters
+import six
+
+
+class OktaClientError(Exception):
+    pass
+
+
+class OktaObject(dict):
+    """
+    A JSON object from Okta.  Its members can also be read as attributes (user.profile.email), like those of
+    the SDK's models, which is what all_users_filter expressions use.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    @classmethod
+    def from_value(cls, value):
+        """
+        Convert the dicts in a JSON value (such as one read back from a file) to OktaObjects
+        :type value: object
+        :rtype object
+        """
+        if isinstance(value, dict):
+            return cls((key, cls.from_value(item)) for key, item in six.iteritems(value))
+        if isinstance(value, list):
+            return [cls.from_value(item) for item in value]
+        return value
+
+
+class RateLimiter(object):
+    """
+    Keeps requests under the org's rate limit, using the X-Rate-Limit headers of Okta's responses.  When the
+    requests left in the current window fall to the headroom (a percentage of the limit), callers wait for the
+    window to reset.  Shared by all the threads that make requests.
+    """
+
+    def __init__(self, headroom, logger):
+        """
+        :type headroom: int
+        :type logger: logging.Logger
+        """
+        self.headroom = headroom
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset_time = None
+
+    def acquire(self):
+        """
+        Wait until a request can be made
+        """
+        while True:
+            with self.lock:
+                if self.remaining is None or self.remaining > self.limit * self.headroom / 100.0:
+                    if self.remaining is not None:
+                        # count the request now, as other threads may send theirs before it returns
+                        self.remaining -= 1
+                    return
+                delay = self.reset_time - time.time()
+                if delay <= 0:
+                    # a new window has started; the next response tells how many requests are left
+                    self.remaining = None
+                    return
+                remaining, limit = self.remaining, self.limit
+            # windows last a minute, so don't wait longer than that whatever the clocks say
+            delay = min(delay, 60) + 1
+            self.logger.info('Okta rate limit nearly reached (%d of %d requests left); waiting %d seconds',
+                             remaining, limit, delay)
+            time.sleep(delay)
+
+    def exhausted(self):
+        """
+        Note that the rate limit was exceeded (a 429 response), so that no request is made until the window resets
+        :return: False if the reset time of the window isn't known
+        :rtype bool
+        """
+        with self.lock:
+            if self.reset_time is None or self.reset_time <= time.time():
+                return False
+            self.remaining = 0
+            return True
+
+    def update(self, headers):
+        """
+        Update the state of the rate limit from the headers of a response
+        :type headers: dict
+        """
+        try:
+            limit = int(headers['X-Rate-Limit-Limit'])
+            remaining = int(headers['X-Rate-Limit-Remaining'])
+            reset_time = int(headers['X-Rate-Limit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            if reset_time == self.reset_time and self.remaining is not None:
+                # responses may arrive out of order, so keep the lowest count of the window
+                remaining = min(remaining, self.remaining)
+            self.limit, self.remaining, self.reset_time = limit, remaining, reset_time
+
+
+class OktaClient(object):
+    """
+    A minimal client for the parts of the Okta API that the connector reads: group search, group members and
+    users.  Responses are parsed straight into OktaObjects, and all the requests share one session, so
+    connections are kept alive (and responses gzipped) across requests and threads.
+    """
+    max_attempts = 4
+
+    def __init__(self, host, api_token, rate_limiter, pool_size=1, timeout=120):
+        """
+        :type host: str
+        :type api_token: str
+        :type rate_limiter: RateLimiter
+        :type pool_size: int
+        :type timeout: int
+        """
+        self.base_url = host.rstrip('/') + '/api/v1'
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip',
+            'Authorization': 'SSWS ' + api_token,
+        })
+
+    def get(self, url, params=None):
+        """
+        Make a GET request, waiting and retrying if the rate limit is exceeded
+        :type url: str
+        :type params: dict
+        :rtype requests.Response
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                raise OktaClientError('Request to %s failed: %s' % (url, e))
+            self.rate_limiter.update(response.headers)
+            if response.status_code == 429 and attempt < self.max_attempts:
+                # wait for the rate limit window to reset, or back off if the headers don't say when that is
+                if not self.rate_limiter.exhausted():
+                    time.sleep(2 ** (attempt - 1))
+                continue
+            if not 200 <= response.status_code < 300:
+                try:
+                    summary = response.json().get('errorSummary')
+                except ValueError:
+                    summary = None
+                raise OktaClientError('HTTP %d from %s: %s' % (response.status_code, url,
+                                                               summary or response.reason))
+            return response
+
+    def iter_pages(self, path, params=None):
+        """
+        Yield each page of a list resource, as a list of OktaObjects, following the next links
+        :type path: str
+        :type params: dict
+        :rtype iterator(list(OktaObject))
+        """
+        url = self.base_url + path
+        while url:
+            response = self.get(url, params)
+            try:
+                page = response.json(object_pairs_hook=OktaObject)
+            except ValueError as e:
+                raise OktaClientError('Invalid response from %s: %s' % (url, e))
+            yield page
+            # the next link includes the query parameters
+            url = response.links.get('next', {}).get('url')
+            params = None
+
+    def get_groups(self, query):
+        """
+        Return the groups found by a search (the first page of results)
+        :type query: str
+        :rtype list(OktaObject)
+        """
+        for page in self.iter_pages('/groups', {'q': query}):
+            return page
+        return []
+
+    def iter_group_member_pages(self, group_id):
+        """
+        :type group_id: str
+        :rtype iterator(list(OktaObject))
+        """
+        return self.iter_pages('/groups/%s/users' % group_id)
+
+    def iter_user_pages(self, search=None):
+        """
+        :type search: str
+        :rtype iterator(list(OktaObject))
+        """
+        return self.iter_pages('/users', {'search': search} if search else None)
@@ -0,0 +1,116 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import base64
+import datetime
+import hashlib
+import json
+import os
+
+import six
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from user_sync.error import AssertionException
+
+SNAPSHOT_VERSION = 1
+UTC = datetime.timezone.utc
+
+
+def options_fingerprint(values):
+    """
+    Return a digest of the settings a snapshot was built with, so that a snapshot built with different settings
+    is not reused.
+    :type values: dict
+    :rtype str
+    """
+    text = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+def load_snapshot(file_path, fingerprint, logger):
+    """
+    Read a snapshot file.  Returns None (so that a full sync is done) if there is no snapshot, if it can't be
+    read, or if it was built with different settings.
+    :type file_path: str
+    :type fingerprint: str
+    :type logger: logging.Logger
+    :rtype dict
+    """
+    if not os.path.exists(file_path):
+        logger.info('No snapshot found at: %s', file_path)
+        return None
+    try:
+        with open(file_path, 'r') as f:
+            snapshot = json.load(f, object_hook=_decode_value)
+    except (IOError, ValueError) as e:
+        logger.warning('Ignoring unreadable snapshot %s: %s', file_path, e)
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('fingerprint') != fingerprint:
+        logger.info('Ignoring snapshot %s: it was written with different settings', file_path)
+        return None
+    return snapshot
+
+
+def save_snapshot(file_path, fingerprint, snapshot):
+    """
+    Write a snapshot file.  The file is replaced in one step, so an interrupted write leaves the old snapshot.
+    :type file_path: str
+    :type fingerprint: str
+    :type snapshot: dict
+    """
+    snapshot = dict(snapshot, version=SNAPSHOT_VERSION, fingerprint=fingerprint)
+    temp_path = file_path + '.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f, default=_encode_value)
+        os.replace(temp_path, file_path)
+    except (IOError, OSError) as e:
+        raise AssertionException('Unable to write snapshot %s: %s' % (file_path, e))
+
+
+def _encode_value(value):
+    if isinstance(value, six.binary_type):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            return {'__datetime__': value.astimezone(UTC).strftime('%Y%m%d%H%M%S.%fZ')}
+        return {'__datetime__': value.strftime('%Y%m%d%H%M%S.%f')}
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError('Cannot store value of type %s in a snapshot' % type(value).__name__)
+
+
+def _decode_value(obj):
+    if len(obj) == 1:
+        if '__bytes__' in obj:
+            return base64.b64decode(obj['__bytes__'])
+        if '__datetime__' in obj:
+            value = obj['__datetime__']
+            if value.endswith('Z'):
+                return datetime.datetime.strptime(value[:-1], '%Y%m%d%H%M%S.%f').replace(tzinfo=UTC)
+            return datetime.datetime.strptime(value, '%Y%m%d%H%M%S.%f')
+    return obj
@@ -18,10 +18,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
+import itertools
 import json
 import logging
 # import helper
 import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import jwt
 import six
@@ -57,7 +63,19 @@ class UmapiConnector(object):
         builder.set_string_value('logger_name', self.name)
         builder.set_bool_value('test_mode', False)
         builder.set_bool_value('ssl_cert_verify', True)
+        builder.set_int_value('send_threads', 1)
+        builder.set_int_value('send_queue_size', 10)
+        builder.set_int_value('page_fetch_width', 1)
+        builder.set_int_value('group_action_threshold', 0)
         options = builder.get_options()
+        if options['page_fetch_width'] < 1:
+            raise AssertionException('%s: page_fetch_width must be at least 1' % self.name)
+        if options['group_action_threshold'] < 0:
+            raise AssertionException('%s: group_action_threshold must not be negative' % self.name)
+        if options['send_threads'] < 0:
+            raise AssertionException('%s: send_threads must not be negative' % self.name)
+        if options['send_queue_size'] < 1:
+            raise AssertionException('%s: send_queue_size must be at least 1' % self.name)
 
         server_config = caller_config.get_dict_config('server', True)
         server_builder = user_sync.config.OptionsBuilder(server_config)
@@ -109,32 +127,62 @@ class UmapiConnector(object):
                 retry_max_attempts=server_options['retries'] + 1,
                 ssl_verify=options['ssl_cert_verify']
             )
+            # queries get no retries from the client, as the page fetcher backs off all its requests together
+            query_connection = umapi_client.Connection(
+                org_id=org_id,
+                auth=connection.auth,
+                user_management_endpoint=um_endpoint,
+                user_agent="user-sync/" + app_version,
+                logger=self.logger,
+                timeout_seconds=float(server_options['timeout']),
+                retry_max_attempts=1,
+                ssl_verify=options['ssl_cert_verify']
+            )
         except Exception as e:
             raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
         logger.debug('%s: connection established', self.name)
+        self.page_fetcher = PageFetcher(query_connection, options['page_fetch_width'],
+                                        server_options['retries'] + 1, logger)
+
+        def make_send_connection():
+            # a connection queues the actions it is sent, so each sending thread gets its own
+            return umapi_client.Connection(
+                org_id=org_id,
+                auth=connection.auth,
+                user_management_endpoint=um_endpoint,
+                test_mode=options['test_mode'],
+                user_agent="user-sync/" + app_version,
+                logger=self.logger,
+                timeout_seconds=float(server_options['timeout']),
+                retry_max_attempts=server_options['retries'] + 1,
+                ssl_verify=options['ssl_cert_verify']
+            )
+
         # wrap the connection in an action manager
-        self.action_manager = ActionManager(connection, org_id, logger)
+        self.action_manager = ActionManager(connection, org_id, logger, options['send_threads'],
+                                            options['send_queue_size'], options['group_action_threshold'],
+                                            make_send_connection)
 
     def get_users(self):
         return list(self.iter_users())
 
     def iter_users(self, in_group=None):
-        users = {}
+        """
+        Yield the users of the org (or of a group), in page order, once for each email
+        :type in_group: str
+        :rtype iterator(dict)
+        """
+        emails = set()
         total_count = 0
-        page_count = 0
-        page_size = 0
-        page_number = 0
         try:
-            u_query = umapi_client.UsersQuery(self.connection, in_group=in_group)
-            for i, u in enumerate(u_query):
-                total_count, page_count, page_size, page_number = u_query.stats()
-                email = u['email']
-                if not (email in users):
-                    users[email] = u
-                    yield u
-
-                if (i + 1) % page_size == 0:
-                    self.logger.progress(len(users), total_count)
+            pages = self.page_fetcher.iter_pages('user', [in_group] if in_group else None, {'directOnly': True})
+            for page, total_count in pages:
+                for u in page:
+                    email = u['email']
+                    if email not in emails:
+                        emails.add(email)
+                        yield u
+                self.logger.progress(len(emails), total_count)
             self.logger.progress(total_count, total_count)
 
         except umapi_client.UnavailableError as e:
@@ -164,7 +212,8 @@ class UmapiConnector(object):
         if name:
             group = umapi_client.UserGroupAction(group_name=name)
             group.create(description="Automatically created by User Sync Tool")
-            return self.connection.execute_single(group)
+            # sent at once, so that no action is left in the connection's queue when batches are sent in threads
+            return self.connection.execute_single(group, immediate=True)
 
     def get_action_manager(self):
         return self.action_manager
@@ -175,10 +224,291 @@ class UmapiConnector(object):
         :type callback: callable(dict)
         """
         if len(commands) > 0:
-            action_manager = self.get_action_manager()
-            action = action_manager.create_action(commands)
-            if action is not None:
-                action_manager.add_action(action, callback)
+            self.get_action_manager().add_commands(commands, callback)
+
+
+class PageFetcher(object):
+    """
+    Fetches the pages of a UMAPI query, up to width pages at a time, and yields them in page order.  When the
+    server asks for a pause (a 429 or 5xx response), all the fetching threads wait for it before their next
+    request, rather than each of them backing off on its own.
+    """
+    retry_statuses = (429, 502, 503, 504)
+    retry_first_delay = 15
+    retry_random_delay = 5
+
+    def __init__(self, connection, width, max_attempts, logger):
+        """
+        :type connection: umapi_client.Connection
+        :type width: int
+        :type max_attempts: int
+        :type logger: logging.Logger
+        """
+        self.connection = connection
+        self.width = width
+        self.max_attempts = max_attempts
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.resume_time = 0
+
+    def iter_pages(self, object_type, url_params=None, query_params=None):
+        """
+        Yield (page of objects, total count) for each page of a query
+        :type object_type: str
+        :type url_params: list(str)
+        :type query_params: dict
+        :rtype iterator(list(dict), int)
+        """
+        def fetch(page_index):
+            return self.fetch_page(object_type, page_index, url_params, query_params)
+
+        values, last_page, total_count, page_count = fetch(0)
+        yield values, total_count
+        if last_page:
+            return
+        if self.width <= 1:
+            page_index = 1
+            while True:
+                values, last_page, total_count, _ = fetch(page_index)
+                yield values, total_count
+                if last_page:
+                    return
+                page_index += 1
+
+        # keep width pages in flight; the page count of the first page tells how far to go, but users may be
+        # added while the pages are read, so the pages after it are still read until one is the last
+        self.logger.debug('Fetching %d %s pages with %d concurrent requests', page_count, object_type, self.width)
+        executor = ThreadPoolExecutor(max_workers=self.width)
+        pending = collections.deque()
+        next_page = 1
+        try:
+            while True:
+                limit = page_count if next_page < page_count else next_page + 1
+                while len(pending) < self.width and next_page < limit:
+                    pending.append(executor.submit(fetch, next_page))
+                    next_page += 1
+                values, last_page, total_count, _ = pending.popleft().result()
+                yield values, total_count
+                if last_page:
+                    return
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def fetch_page(self, object_type, page_index, url_params, query_params):
+        """
+        Fetch a page of a query, waiting for any pause the server asked for, and retrying
+        :type object_type: str
+        :type page_index: int
+        :type url_params: list(str)
+        :type query_params: dict
+        :rtype (list(dict), bool, int, int)
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            with self.lock:
+                delay = self.resume_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                result = self.connection.query_multiple(object_type, page_index, url_params, query_params)
+            except umapi_client.UnavailableError as e:
+                status = getattr(e.result, 'status_code', None)
+                if attempt == self.max_attempts or (e.result is not None and status not in self.retry_statuses):
+                    raise
+                delay = self.get_retry_delay(e.result, attempt)
+                self.logger.warning('UMAPI query failed (status %s); pausing queries for %d seconds',
+                                    status, delay)
+                with self.lock:
+                    self.resume_time = max(self.resume_time, time.time() + delay)
+                continue
+            values, last_page = result[0], result[1]
+            # older clients only return the values and whether the page is the last
+            total_count, page_count = (result[2], result[3]) if len(result) > 3 else (0, 0)
+            return values, last_page or not values, total_count, page_count
+
+    def get_retry_delay(self, response, attempt):
+        """
+        The delay the server asked for (in a Retry-After header), or an exponential back-off
+        :type response: requests.Response
+        :type attempt: int
+        :rtype int
+        """
+        try:
+            return max(int(response.headers['Retry-After']), 1)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return 2 ** (attempt - 1) * self.retry_first_delay + random.randint(0, self.retry_random_delay)
+
+
+class UserCallback(object):
+    """
+    The callback for a user whose changes are split between several actions: it is called once, when all of them
+    are sent, with the errors of all of them
+    """
+
+    def __init__(self, callback):
+        """
+        :type callback: callable(dict)
+        """
+        self.callback = callback
+        self.parts = 0
+        self.parts_done = 0
+        self.planned = False
+        self.action = None
+        self.errors = []
+
+    def part_done(self, action, errors):
+        """
+        :type action: umapi_client.Action
+        :type errors: list
+        """
+        self.parts_done += 1
+        if self.action is None:
+            self.action = action
+        if errors:
+            self.errors.extend(errors)
+        self.check_done()
+
+    def check_done(self):
+        if self.planned and self.parts_done == self.parts and callable(self.callback):
+            self.callback({
+                "action": self.action,
+                "is_success": not self.errors,
+                "errors": self.errors
+            })
+
+
+class GroupActionPlanner(object):
+    """
+    Holds the group changes of existing users until the action manager is flushed, then regroups them by group.
+    The groups with at least threshold users to add or remove get group actions, with many users in each command;
+    the other changes of each user go in an action for the user.  Users being created, removed, renamed (email or
+    username update) or having all their groups removed keep a single action for the user, as do Adobe IDs, which
+    group actions can't tell apart from other users with the same email.
+    """
+
+    def __init__(self, action_manager, threshold):
+        """
+        :type action_manager: ActionManager
+        :type threshold: int
+        """
+        self.action_manager = action_manager
+        self.threshold = threshold
+        connection = action_manager.connection
+        self.users_per_command = getattr(connection, 'throttle_groups', 10)
+        self.commands_per_action = getattr(connection, 'throttle_commands', 10)
+        # (user commands, callback, groups to add, groups to remove) for each user held
+        self.users = []
+
+    def has_work(self):
+        return len(self.users) > 0
+
+    def add_commands(self, commands, callback):
+        """
+        Hold the group changes of the commands if they can be done with group actions
+        :type commands: Commands
+        :type callback: callable(dict)
+        :return: the commands left to send for the user, and the callback for the user if changes were held
+        :rtype (Commands, UserCallback)
+        """
+        if commands.identity_type == user_sync.identity_type.ADOBEID_IDENTITY_TYPE or not commands.email:
+            return commands, None
+        groups_to_add, groups_to_remove, other_commands = set(), set(), []
+        for command_name, command_param in commands.do_list:
+            if command_name in ('create', 'remove_from_organization') or \
+                    (command_name == 'remove_from_groups' and 'groups' not in command_param):
+                return commands, None
+            if command_name == 'update' and ('email' in command_param or 'username' in command_param):
+                # the group actions would name the user by the email or username being changed
+                return commands, None
+            if command_name == 'add_to_groups':
+                groups_to_add.update(command_param['groups'])
+            elif command_name == 'remove_from_groups':
+                groups_to_remove.update(command_param['groups'])
+            else:
+                other_commands.append((command_name, command_param))
+        if not groups_to_add and not groups_to_remove:
+            return commands, None
+        user_callback = UserCallback(callback)
+        user_commands = Commands(commands.identity_type, commands.email, commands.username, commands.domain)
+        self.users.append((user_commands, user_callback, groups_to_add, groups_to_remove))
+        remaining = Commands(commands.identity_type, commands.email, commands.username, commands.domain)
+        remaining.do_list = other_commands
+        if other_commands:
+            user_callback.parts += 1
+        return remaining, user_callback
+
+    def drop_user(self, user_callback):
+        """
+        Forget a user whose action couldn't be created
+        :type user_callback: UserCallback
+        """
+        self.users = [user for user in self.users if user[1] is not user_callback]
+
+    def add_actions(self):
+        """
+        Add the actions for the changes held: group actions for the groups with enough of them, and actions for
+        each user for the rest
+        """
+        users, self.users = self.users, []
+        if not users:
+            return
+        adds_by_group, removes_by_group = collections.defaultdict(list), collections.defaultdict(list)
+        for user in users:
+            for group in user[2]:
+                adds_by_group[group].append(user)
+            for group in user[3]:
+                removes_by_group[group].append(user)
+        bulk_adds = set(group for group, members in six.iteritems(adds_by_group) if len(members) >= self.threshold)
+        bulk_removes = set(group for group, members in six.iteritems(removes_by_group)
+                           if len(members) >= self.threshold)
+        action_manager = self.action_manager
+        with action_manager.lock:
+            for user_commands, user_callback, groups_to_add, groups_to_remove in users:
+                user_callback.parts += len(groups_to_add & bulk_adds) + len(groups_to_remove & bulk_removes)
+        group_count = len(bulk_adds) + len(bulk_removes)
+        if group_count:
+            self.action_manager.logger.info('Changing the members of %d groups with group actions', group_count)
+
+        # the changes left for each user go in one action, as usual
+        for user_commands, user_callback, groups_to_add, groups_to_remove in users:
+            user_commands.remove_groups(groups_to_remove - bulk_removes)
+            user_commands.add_groups(groups_to_add - bulk_adds)
+            if len(user_commands) > 0:
+                with action_manager.lock:
+                    user_callback.parts += 1
+                action = action_manager.create_action(user_commands)
+                if action is not None:
+                    action_manager.add_action(action, parts=[user_callback])
+                else:
+                    with action_manager.lock:
+                        user_callback.parts -= 1
+
+        for command_name, members_by_group, groups in (('remove_users', removes_by_group, bulk_removes),
+                                                       ('add_users', adds_by_group, bulk_adds)):
+            for group in sorted(groups):
+                self.add_group_actions(group, command_name, members_by_group[group])
+
+        with action_manager.lock:
+            for _, user_callback, _, _ in users:
+                user_callback.planned = True
+                user_callback.check_done()
+
+    def add_group_actions(self, group, command_name, members):
+        """
+        :type group: str
+        :type command_name: str
+        :type members: list
+        """
+        users_per_action = self.users_per_command * self.commands_per_action
+        for start in range(0, len(members), users_per_action):
+            action_members = members[start:start + users_per_action]
+            action = umapi_client.UserGroupAction(group_name=group,
+                                                  requestID=self.action_manager.get_next_request_id())
+            for command_start in range(0, len(action_members), self.users_per_command):
+                command_members = action_members[command_start:command_start + self.users_per_command]
+                getattr(action, command_name)(users=[user[0].email for user in command_members])
+            self.action_manager.add_action(action, parts=[user[1] for user in action_members])
 
 
 class Commands(object):
@@ -269,13 +599,28 @@ class Commands(object):
 
 
 class ActionManager(object):
-    next_request_id = 1
-
-    def __init__(self, connection, org_id, logger):
+    """
+    Sends actions to UMAPI in batches.  With send_threads more than 0, full batches are handed to that many
+    background threads, so that the caller can go on computing actions while earlier batches are being sent.  At
+    most send_queue_size batches wait for a thread, after which add_action blocks until one is free.  With
+    send_threads 0, each batch is sent by the caller when it fills.  Either way, flush sends the last partial
+    batch and waits until every batch is sent and its callbacks are done.
+
+    With a group_action_threshold, the group changes of existing users are held until flush, and the groups with
+    at least that many users to add or remove are changed with group actions (many users per command) rather than
+    with an action for each user.
+    """
+    def __init__(self, connection, org_id, logger, send_threads=0, send_queue_size=10, group_action_threshold=0,
+                 connection_factory=None):
         """
         :type connection: umapi_client.Connection
         :type org_id: str
         :type logger: logging.Logger
+        :type send_threads: int
+        :type send_queue_size: int
+        :type group_action_threshold: int
+        :type connection_factory: callable() # makes a connection for each sending thread; if None, the sending
+        threads take turns with the connection
         """
         self.action_count = 0
         self.error_count = 0
@@ -283,15 +628,38 @@ class ActionManager(object):
         self.connection = connection
         self.org_id = org_id
         self.logger = logger.getChild('action')
+        self.batch_size = getattr(connection, 'throttle_actions', 10)
+        self.send_threads = send_threads
+        # counts and callbacks are updated by the sending threads
+        self.lock = threading.RLock()
+        self.request_ids = itertools.count(1)
+        self.connection_factory = connection_factory
+        self.thread_connections = threading.local()
+        self.send_lock = threading.Lock()
+        self.executor = None
+        self.batch_slots = threading.BoundedSemaphore(send_threads + send_queue_size)
+        self.futures = []
+        self.group_planner = GroupActionPlanner(self, group_action_threshold) if group_action_threshold else None
 
     def get_statistics(self):
         """Return the count of actions sent so far, and how many had errors."""
-        return self.action_count, self.error_count
+        with self.lock:
+            return self.action_count, self.error_count
 
     def get_next_request_id(self):
-        request_id = 'action_%d' % ActionManager.next_request_id
-        ActionManager.next_request_id += 1
-        return request_id
+        return 'action_%d' % next(self.request_ids)
+
+    def get_send_connection(self):
+        """
+        Return the connection of the current sending thread, making it on first use
+        :rtype umapi_client.Connection
+        """
+        if not self.send_threads or self.connection_factory is None:
+            return self.connection
+        connection = getattr(self.thread_connections, 'connection', None)
+        if connection is None:
+            connection = self.thread_connections.connection = self.connection_factory()
+        return connection
 
     def create_action(self, commands):
         identity_type = commands.identity_type
@@ -321,64 +689,139 @@ class ActionManager(object):
             command_function(**command_param)
         return action
 
-    def add_action(self, action, callback=None):
+    def add_commands(self, commands, callback=None):
         """
-        :type action: umapi_client.UserAction
+        Add the action for the commands, unless the group planner holds them (or some of them) until flush
+        :type commands: Commands
+        :type callback: callable(dict)
+        """
+        user_callback = None
+        if self.group_planner is not None:
+            commands, user_callback = self.group_planner.add_commands(commands, callback)
+            if not commands.do_list:
+                return
+        action = self.create_action(commands)
+        if action is not None:
+            if user_callback is not None:
+                self.add_action(action, parts=[user_callback])
+            else:
+                self.add_action(action, callback)
+        elif user_callback is not None:
+            self.group_planner.drop_user(user_callback)
+
+    def add_action(self, action, callback=None, parts=None):
+        """
+        :type action: umapi_client.Action
         :type callback: callable(umapi_client.UserAction, bool, dict)
+        :type parts: list(UserCallback) # the users the action does part of the changes of
         """
         item = {
             'action': action,
-            'callback': callback
+            'callback': callback,
+            'parts': parts or [],
         }
         self.items.append(item)
-        self.action_count += 1
+        with self.lock:
+            self.action_count += 1
         self.logger.debug('Added action: %s', json.dumps(action.wire_dict()))
-        self._execute_action(action)
+        if len(self.items) >= self.batch_size:
+            self._send_batch()
 
     def has_work(self):
-        return len(self.items) > 0
+        return (len(self.items) > 0 or len(self.futures) > 0 or
+                (self.group_planner is not None and self.group_planner.has_work()))
 
-    def _execute_action(self, action):
+    def _send_batch(self):
         """
-        :type action: umapi_client.UserAction
+        Send the actions added since the last batch, or hand them to a sending thread
         """
+        items, self.items = self.items, []
+        if not self.send_threads:
+            self._execute_batch(items)
+            return
+        self._check_sent_batches()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.send_threads)
+        self.batch_slots.acquire()
         try:
-            _, sent, _ = self.connection.execute_single(action)
-        except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
-        except umapi_client.UnavailableError as e:
-            raise AssertionException("Error contacting UMAPI server: %s" % e)
-        else:
-            self.process_sent_items(sent)
-
-    def flush(self):
+            future = self.executor.submit(self._execute_batch, items)
+        except Exception:
+            self.batch_slots.release()
+            raise
+        future.add_done_callback(lambda _: self.batch_slots.release())
+        self.futures.append(future)
+
+    def _check_sent_batches(self, wait=False):
+        """
+        Forget the batches that have been sent (all of them if wait is true, after waiting for them), raising the
+        error of any that couldn't be sent
+        :type wait: bool
+        """
+        futures, self.futures = self.futures, []
+        for index, future in enumerate(futures):
+            if wait or future.done():
+                try:
+                    future.result()
+                except Exception:
+                    self.futures.extend(futures[index + 1:])
+                    raise
+            else:
+                self.futures.append(future)
+
+    def _execute_batch(self, items):
+        """
+        :type items: list(dict)
+        """
+        actions = [item['action'] for item in items]
+        connection = self.get_send_connection()
         try:
-            _, sent, _ = self.connection.execute_queued()
+            if connection is self.connection:
+                # the connection queues the actions it is given, so senders sharing it mustn't overlap
+                with self.send_lock:
+                    connection.execute_multiple(actions)
+            else:
+                connection.execute_multiple(actions)
         except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
+            self.process_sent_items(items, e)
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
         else:
-            self.process_sent_items(sent)
+            self.process_sent_items(items)
 
-    def process_sent_items(self, total_sent, batch_error=None):
+    def flush(self, wait=True):
+        """
+        Send the last partial batch, and wait until every batch has been sent (unless wait is false)
+        :type wait: bool
+        """
+        if self.group_planner is not None:
+            self.group_planner.add_actions()
+        if self.items:
+            self._send_batch()
+        if wait:
+            self._check_sent_batches(wait=True)
+
+    def process_sent_items(self, sent_items, batch_error=None):
         """
         Note items as sent, log any processing errors, and invoke any callbacks
-        :param total_sent: number of sent items from queue, must be >= 0
+        :param sent_items: the items of the batch that was sent
         :param batch_error: exception for a batch-level error that affected all items, if there was one
         :return: 
         """
-        # update queue
-        sent_items, self.items = self.items[:total_sent], self.items[total_sent:]
+        with self.lock:
+            self._process_sent_items(sent_items, batch_error)
 
+    def _process_sent_items(self, sent_items, batch_error):
         # collect sent actions, their errors, their callbacks
         details = [(item['action'], item['action'].execution_errors(), item['callback']) for item in sent_items]
+        for item, (action, errors, _) in zip(sent_items, details):
+            for part in item['parts']:
+                part.part_done(action, [batch_error] if batch_error else errors)
 
         # log errors
         if batch_error:
             request_ids = str([action.frame.get("requestID") for action, _, _ in details])
             self.logger.critical("Unexpected response! Sent actions %s may have failed: %s", request_ids, batch_error)
-            self.error_count += total_sent
+            self.error_count += len(sent_items)
         else:
             for action, errors, _ in details:
                 if errors:
@@ -21,6 +21,8 @@
 
 import logging
 import six
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 from collections import defaultdict
 
@@ -40,6 +42,7 @@ class RuleProcessor(object):
     default_options = {
         'adobe_group_filter': None,
         'after_mapping_hook': None,
+        'concurrent_orgs': 1,
         'default_country_code': None,
         'delete_strays': False,
         'directory_group_filter': None,
@@ -53,6 +56,7 @@ class RuleProcessor(object):
         'process_groups': False,
         'max_adobe_only_users': 200,
         'new_account_type': user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE,
+        'prefetch_users': False,
         'remove_strays': False,
         'strategy': 'sync',
         'stray_list_input_path': None,
@@ -161,6 +165,9 @@ class RuleProcessor(object):
         # Data to provide to post-sync connectors
         self.post_sync_data = PostSyncData()
 
+        # Adobe users read in the background
+        self.umapi_prefetch = UmapiUserPrefetch(options['concurrent_orgs'], logger)
+
         if logger.isEnabledFor(logging.DEBUG):
             options_to_report = options.copy()
             username_filter_regex = options_to_report['username_filter_regex']
@@ -179,23 +186,29 @@ class RuleProcessor(object):
 
         self.prepare_umapi_infos()
 
-        if directory_connector is not None:
-            load_directory_stats = JobStats("Load from Directory", divider="-")
-            load_directory_stats.log_start(logger)
-            self.read_desired_user_groups(directory_groups, directory_connector)
-            load_directory_stats.log_end(logger)
-
-        for umapi_info in self.umapi_info_by_name.values():
-            self.validate_and_log_additional_groups(umapi_info)
-
-        umapi_stats = JobStats('Push to UMAPI' if self.push_umapi else 'Sync with UMAPI', divider="-")
-        umapi_stats.log_start(logger)
-        if directory_connector is not None:
-            # note: push mode is not supported because if it is, we won't have a list of groups
-            # that exist in the console.  we don't want to attempt to create groups that already exist
-            if self.options.get('process_groups') and not self.push_umapi and self.options.get('auto_create'):
-                self.create_umapi_groups(umapi_connectors)
-            self.sync_umapi_users(umapi_connectors)
+        try:
+            if directory_connector is not None:
+                if self.options['prefetch_users']:
+                    # the Adobe users don't depend on the directory, so they can be read while it's loaded
+                    self.prefetch_umapi_users(umapi_connectors, True)
+                load_directory_stats = JobStats("Load from Directory", divider="-")
+                load_directory_stats.log_start(logger)
+                self.read_desired_user_groups(directory_groups, directory_connector)
+                load_directory_stats.log_end(logger)
+
+            for umapi_info in self.umapi_info_by_name.values():
+                self.validate_and_log_additional_groups(umapi_info)
+
+            umapi_stats = JobStats('Push to UMAPI' if self.push_umapi else 'Sync with UMAPI', divider="-")
+            umapi_stats.log_start(logger)
+            if directory_connector is not None:
+                # note: push mode is not supported because if it is, we won't have a list of groups
+                # that exist in the console.  we don't want to attempt to create groups that already exist
+                if self.options.get('process_groups') and not self.push_umapi and self.options.get('auto_create'):
+                    self.create_umapi_groups(umapi_connectors)
+                self.sync_umapi_users(umapi_connectors)
+        finally:
+            self.umapi_prefetch.stop()
         if self.will_process_strays:
             self.process_strays(umapi_connectors)
         umapi_connectors.execute_actions()
@@ -474,6 +487,9 @@ class RuleProcessor(object):
         else:
             verb = "Sync"
         exclude_unmapped_users = self.will_exclude_unmapped_users()
+        if self.options['concurrent_orgs'] > 1:
+            # the users of the secondary umapis don't depend on the primary, so they can be read while it's synced
+            self.prefetch_umapi_users(umapi_connectors, False)
         # first sync the primary connector, so the users get created in the primary
         if umapi_connectors.get_secondary_connectors():
             self.logger.debug('%sing users to primary umapi...', verb)
@@ -483,7 +499,8 @@ class RuleProcessor(object):
         if self.push_umapi:
             primary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
         else:
-            primary_adds_by_user_key = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+            primary_adds_by_user_key = self.update_umapi_users_for_connector(
+                umapi_info, umapi_connector, self.umapi_prefetch.get_users(PRIMARY_UMAPI_NAME))
         # save groups for new users
 
         total_users = len(primary_adds_by_user_key)
@@ -509,7 +526,8 @@ class RuleProcessor(object):
             if self.push_umapi:
                 secondary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
             else:
-                secondary_adds_by_user_key = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+                secondary_adds_by_user_key = self.update_umapi_users_for_connector(
+                    umapi_info, umapi_connector, self.umapi_prefetch.get_users(umapi_name))
             total_users = len(secondary_adds_by_user_key)
             for user_key, groups_to_add in six.iteritems(secondary_adds_by_user_key):
                 # We only create users who have group mappings in the secondary umapi
@@ -522,6 +540,22 @@ class RuleProcessor(object):
                         self.updated_user_keys.add(user_key)
                     self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector)
 
+    def prefetch_umapi_users(self, umapi_connectors, include_primary):
+        """
+        Start reading the users of the umapis (those with mapped groups), in the background
+        :type umapi_connectors: UmapiConnectors
+        :type include_primary: bool
+        """
+        if self.push_umapi:
+            return
+        connectors = list(six.iteritems(umapi_connectors.get_secondary_connectors()))
+        if include_primary:
+            connectors.insert(0, (PRIMARY_UMAPI_NAME, umapi_connectors.get_primary_connector()))
+        for umapi_name, umapi_connector in connectors:
+            umapi_info = self.get_umapi_info(umapi_name)
+            if umapi_name == PRIMARY_UMAPI_NAME or len(umapi_info.get_mapped_groups()) > 0:
+                self.umapi_prefetch.start(umapi_name, self.iter_umapi_users(umapi_info, umapi_connector))
+
     def create_umapi_groups(self, umapi_connectors):
         """
         This is where we create user-groups. If auto_create is enabled,
@@ -876,7 +910,7 @@ class RuleProcessor(object):
         commands.add_groups(groups_to_add)
         umapi_connector.send_commands(commands)
 
-    def update_umapi_users_for_connector(self, umapi_info, umapi_connector):
+    def update_umapi_users_for_connector(self, umapi_info, umapi_connector, umapi_users=None):
         """
         This is the main function that goes over adobe users and looks for and processes differences.
         It is called with a particular organization that it should manage groups against.
@@ -886,6 +920,7 @@ class RuleProcessor(object):
         The use of this return value by the caller is to create the user and add him to the right groups.
         :type umapi_info: UmapiTargetInfo
         :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :type umapi_users: list(dict) # the users of the umapi, if they have already been read
         :rtype: map(string, set)
         """
         filtered_directory_user_by_user_key = self.filtered_directory_user_by_user_key
@@ -905,10 +940,8 @@ class RuleProcessor(object):
         if self.will_process_strays:
             self.add_stray(umapi_info.get_name(), None)
 
-        if self.options['adobe_group_filter'] is not None:
-            umapi_users = self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
-        else:
-            umapi_users = umapi_connector.iter_users()
+        if umapi_users is None:
+            umapi_users = self.iter_umapi_users(umapi_info, umapi_connector)
         # Walk all the adobe users, getting their group data, matching them with directory users,
         # and adjusting their attribute and group data accordingly.
         for umapi_user in umapi_users:
@@ -985,6 +1018,16 @@ class RuleProcessor(object):
         if '@' in username and username != email:
             self.email_override[username] = email
 
+    def iter_umapi_users(self, umapi_info, umapi_connector):
+        """
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :rtype iterator(dict)
+        """
+        if self.options['adobe_group_filter'] is not None:
+            return self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
+        return umapi_connector.iter_users()
+
     @staticmethod
     def get_umapi_user_in_groups(umapi_info, umapi_connector, groups):
         umapi_users_iters = []
@@ -1219,14 +1262,80 @@ class UmapiConnectors(object):
 
     def execute_actions(self):
         while True:
-            had_work = False
-            for connector in self.connectors:
-                action_manager = connector.get_action_manager()
-                if action_manager.has_work():
-                    action_manager.flush()
-                    had_work = True
-            if not had_work:
+            action_managers = [connector.get_action_manager() for connector in self.connectors]
+            action_managers = [action_manager for action_manager in action_managers if action_manager.has_work()]
+            if not action_managers:
+                break
+            # hand the last batches of all the umapis to their sending threads before waiting for any of them
+            for action_manager in action_managers:
+                action_manager.flush(wait=False)
+            for action_manager in action_managers:
+                action_manager.flush()
+
+
+class UmapiUserPrefetch(object):
+    """
+    Reads the users of umapis in background threads, at most max_workers umapis at a time, keeping them in memory
+    until they are synced.
+    """
+
+    def __init__(self, max_workers, logger):
+        """
+        :type max_workers: int
+        :type logger: logging.Logger
+        """
+        self.max_workers = max_workers
+        self.logger = logger
+        self.executor = None
+        self.users = {}
+        self.stopped = threading.Event()
+
+    def start(self, umapi_name, umapi_users):
+        """
+        Start reading the users of a umapi, unless they are already being read
+        :type umapi_name: str
+        :type umapi_users: iterator(dict)
+        """
+        if umapi_name in self.users:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.logger.debug('Reading the users of %s umapi in the background', umapi_name or 'primary')
+        self.users[umapi_name] = self.executor.submit(self.read_users, umapi_users)
+
+    def read_users(self, umapi_users):
+        """
+        :type umapi_users: iterator(dict)
+        :rtype list(dict)
+        """
+        users = []
+        for umapi_user in umapi_users:
+            if self.stopped.is_set():
                 break
+            users.append(umapi_user)
+        return users
+
+    def get_users(self, umapi_name):
+        """
+        Return the users of a umapi, waiting until they are read, or None if they aren't being read.  Each umapi's
+        users are returned once.
+        :type umapi_name: str
+        :rtype list(dict)
+        """
+        future = self.users.pop(umapi_name, None)
+        return future.result() if future is not None else None
+
+    def stop(self):
+        """
+        Stop reading, and forget the users that were read but not used
+        """
+        self.stopped.set()
+        for future in six.itervalues(self.users):
+            future.cancel()
+        self.users = {}
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
 
 
 class AdobeGroup(object):